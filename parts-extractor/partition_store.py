@@ -0,0 +1,125 @@
+# Copyright 2023 Quarkslab
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from partition_table import (
+    MEMORY_LAYOUT,
+    PartitionTable,
+    find_regions,
+    occupancy_map,
+)
+
+HASH_DIGEST_SIZE = 32
+# Size of the hash of the image path in the name of its manifest
+MANIFEST_DIGEST_SIZE = 4
+# Permissions removed from the files that are created, read once as os.umask sets it
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+class PartitionStore:
+    """
+    Content-addressed store of partitions: every distinct partition is written only
+    once, in objects/<hash[:2]>/<hash> (BLAKE2b of its content), and every image added
+    to the store gets a manifest in manifests/<image name>.<path hash>.json mapping its
+    partitions to their objects (the hash of the absolute path of the image keeps
+    apart the images with the same name in different folders).
+    If sparse is True, objects are written as sparse files and the manifests contain
+    the occupancy map of every partition
+    """
+
+    def __init__(self, folder: str, sparse: bool = False):
+        self.folder = folder
+        self.sparse = sparse
+        self.objects_folder = os.path.join(folder, "objects")
+        self.manifests_folder = os.path.join(folder, "manifests")
+        os.makedirs(self.objects_folder, exist_ok=True)
+        os.makedirs(self.manifests_folder, exist_ok=True)
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.objects_folder, digest[:2], digest)
+
+    def manifest_path(self, image_path: str) -> str:
+        image_path = os.path.abspath(image_path)
+        digest = hashlib.blake2b(
+            image_path.encode(), digest_size=MANIFEST_DIGEST_SIZE
+        ).hexdigest()
+        name = f"{os.path.basename(image_path)}.{digest}.json"
+        return os.path.join(self.manifests_folder, name)
+
+    def add_image(self, image_path: str, layout=MEMORY_LAYOUT) -> tuple[dict, int]:
+        """
+        Hash every partition of the image straight from the memory-mapped file and
+        export the ones that are not in the store yet.
+        Returns the manifest of the image and the number of new objects written
+        """
+        manifest = {"image": os.path.abspath(image_path), "partitions": {}}
+        written = 0
+
+        with PartitionTable(image_path, layout) as table:
+            for partition in table:
+                with table.view(partition.name) as view:
+                    digest = hashlib.blake2b(view, digest_size=HASH_DIGEST_SIZE)
+                    digest = digest.hexdigest()
+                    size = len(view)
+                    regions = find_regions(view) if self.sparse else None
+
+                path = self.object_path(digest)
+                if not os.path.exists(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    # other processes may be writing the same object, each one
+                    # writes its own file and the last rename wins, readers only
+                    # ever see complete objects with the same content
+                    with atomic_path(path) as tmp_path:
+                        table.export(partition.name, tmp_path, regions=regions)
+                    written += 1
+
+                manifest["partitions"][partition.name] = {
+                    "hash": digest,
+                    "offset": partition.offset,
+                    "size": size,
+                }
+                if self.sparse:
+                    manifest["partitions"][partition.name].update(
+                        {"occupancy": occupancy_map(regions)}
+                    )
+
+        with atomic_path(self.manifest_path(image_path)) as tmp_path:
+            with open(tmp_path, "w") as f:
+                f.write(json.dumps(manifest, indent=4))
+
+        return manifest, written
+
+
+@contextmanager
+def atomic_path(path: str):
+    """
+    Give a unique temporary path next to path, which replaces path if the block
+    succeeds and is removed otherwise
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    os.close(fd)
+    # mkstemp creates files only readable by their owner
+    os.chmod(tmp_path, 0o666 & ~UMASK)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -0,0 +1,349 @@
+# Copyright 2023 Quarkslab
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import mmap
+import errno
+import fcntl
+import struct
+
+# Every element of this array is a tuple:
+# (NAME, SIZE (Kb)), Addresses start from 0.
+MEMORY_LAYOUT = [(f"bootfip{i}", 1024) for i in range(4)] + [
+    ("bootterm1", 512),
+    ("bootmask1", 512),
+    ("bootterm2", 512),
+    ("bootmask2", 512),
+    ("fip_a.0", 1024),
+    ("fip_b.0", 1024),
+    ("fip_a.1", 1024),
+    ("fip_b.1", 1024),
+    ("fipterm1", 1024),
+    ("fipterm2", 1024),
+    ("unused", 2816),
+    ("per_vehicle_config_a", 128),
+    ("per_vehicle_config_b", 128),
+    ("mtdoops", 192),
+    ("version_a", 128),
+    ("version_b", 128),
+    ("secrets_a", 128),
+    ("secrets_b", 128),
+    ("sxid", 320),
+    ("linux_a", 32 * 1024),
+    ("linux_b", 32 * 1024),
+    ("sx_a", 24 * 1024),
+    ("sx_b", 24 * 1024),
+    ("edr", 151367),
+    ("dish_config", 32 * 1024),
+]
+
+
+# Size of the buffer used when the kernel cannot copy the data by itself
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Errors meaning that a copy syscall is not supported for the given files
+UNSUPPORTED_COPY_ERRORS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP)
+
+
+def partition_offsets(layout=MEMORY_LAYOUT):
+    """Return a list of tuples (NAME, OFFSET, SIZE), offsets and sizes are in bytes"""
+    partitions = []
+    offset = 0
+    for name, size in layout:
+        partitions.append((name, offset, size * 1024))
+        offset += size * 1024
+    return partitions
+
+
+def copy_range(fd_in, fd_out, offset, size):
+    """
+    Copy size bytes starting from offset in fd_in to the current position of fd_out,
+    the data is moved by the kernel with copy_file_range or sendfile when possible,
+    otherwise it is copied through a fixed-size buffer.
+    Returns the number of bytes copied, which is smaller than size if fd_in is too short
+    """
+    copied = 0
+
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < size:
+                count = os.copy_file_range(
+                    fd_in, fd_out, size - copied, offset + copied
+                )
+                if count == 0:
+                    return copied
+                copied += count
+            return copied
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_COPY_ERRORS:
+                raise
+
+    if hasattr(os, "sendfile"):
+        try:
+            while copied < size:
+                count = os.sendfile(fd_out, fd_in, offset + copied, size - copied)
+                if count == 0:
+                    return copied
+                copied += count
+            return copied
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_COPY_ERRORS:
+                raise
+
+    while copied < size:
+        data = os.pread(fd_in, min(COPY_CHUNK_SIZE, size - copied), offset + copied)
+        if len(data) == 0:
+            break
+        view = memoryview(data)
+        while len(view) > 0:
+            view = view[os.write(fd_out, view) :]
+        copied += len(data)
+    return copied
+
+
+# ioctl cloning a range of a file into another one (reflink), not exported by
+# the fcntl module before python 3.12
+FICLONERANGE = getattr(fcntl, "FICLONERANGE", 0x4020940D)
+
+
+def reflink_range(fd_in, fd_out, offset, size):
+    """
+    Share the extents of size bytes starting from offset in fd_in with the beginning
+    of fd_out, without copying any data. Only works on filesystems supporting reflinks
+    (btrfs, XFS, ...) and raises an OSError otherwise
+    """
+    fcntl.ioctl(fd_out, FICLONERANGE, struct.pack("qQQQ", fd_in, offset, size, 0))
+    return size
+
+
+# Granularity of the empty regions detection, the usual size of a filesystem block
+REGION_BLOCK_SIZE = 4096
+
+# Regions are first compared by chunks of this size, and block by block only
+# when the chunk is neither all 0x00 nor all 0xFF
+REGION_CHUNK_SIZE = 1024 * 1024
+
+REGION_DATA = "data"
+REGION_ZERO = "zero"
+REGION_ERASED = "erased"
+
+REGION_PATTERNS = [(REGION_ZERO, 0x00), (REGION_ERASED, 0xFF)]
+
+
+def classify_block(data: bytes, patterns: list) -> str:
+    for kind, pattern in patterns:
+        if data == pattern[: len(data)]:
+            return kind
+    return REGION_DATA
+
+
+def find_regions(view, block_size=REGION_BLOCK_SIZE):
+    """
+    Split a buffer in runs of blocks that are all 0x00 (REGION_ZERO), all 0xFF
+    (REGION_ERASED, erased flash) or anything else (REGION_DATA).
+    Returns a list of tuples (OFFSET, SIZE, KIND), consecutive runs of the same kind
+    are merged
+    """
+    chunk_patterns = [(k, bytes([p]) * REGION_CHUNK_SIZE) for k, p in REGION_PATTERNS]
+    block_patterns = [(k, bytes([p]) * block_size) for k, p in REGION_PATTERNS]
+    regions = []
+
+    def add_region(offset, size, kind):
+        if len(regions) > 0 and regions[-1][2] == kind:
+            regions[-1] = (regions[-1][0], regions[-1][1] + size, kind)
+        else:
+            regions.append((offset, size, kind))
+
+    for chunk_offset in range(0, len(view), REGION_CHUNK_SIZE):
+        # comparing bytes is a memcmp, comparing memoryviews is not
+        chunk = bytes(view[chunk_offset : chunk_offset + REGION_CHUNK_SIZE])
+        kind = classify_block(chunk, chunk_patterns)
+        if kind != REGION_DATA:
+            add_region(chunk_offset, len(chunk), kind)
+            continue
+
+        for block_offset in range(0, len(chunk), block_size):
+            block = chunk[block_offset : block_offset + block_size]
+            kind = classify_block(block, block_patterns)
+            add_region(chunk_offset + block_offset, len(block), kind)
+
+    return regions
+
+
+def occupancy_map(regions: list) -> dict:
+    """Number of bytes of each kind and list of regions, as written in the JSON files"""
+    occupancy = {REGION_DATA: 0, REGION_ZERO: 0, REGION_ERASED: 0}
+    for _, size, kind in regions:
+        occupancy[kind] += size
+    occupancy["regions"] = [list(region) for region in regions]
+    return occupancy
+
+
+def sparse_copy_range(fd_in, fd_out, offset, regions):
+    """
+    Same as copy_range, but the REGION_ZERO regions (relative to offset) are
+    skipped by seeking in fd_out, so that they become holes in a sparse file.
+    Erased (0xFF) regions have to be written since holes are read as zeros
+    """
+    size = 0
+    for region_offset, region_size, kind in regions:
+        if kind == REGION_ZERO:
+            os.lseek(fd_out, region_size, os.SEEK_CUR)
+        else:
+            copy_range(fd_in, fd_out, offset + region_offset, region_size)
+        size += region_size
+    os.ftruncate(fd_out, os.lseek(fd_out, 0, os.SEEK_CUR))
+    return size
+
+
+class Partition:
+    def __init__(self, name: str, offset: int, size: int):
+        self.name = name
+        self.offset = offset
+        self.size = size
+
+    def __str__(self):
+        return f"{self.name} (offset: {self.offset:#x}, size: {self.size:#x})"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class PartitionFile(io.RawIOBase):
+    """Read-only, seekable file-like window on a single partition of the image"""
+
+    def __init__(self, view: memoryview):
+        super().__init__()
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        elif whence != io.SEEK_SET:
+            raise ValueError(f"Invalid whence: {whence}")
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, buffer):
+        data = self._view[self._pos : self._pos + len(buffer)]
+        with memoryview(buffer) as view, view.cast("B") as out:
+            out[: len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+
+class PartitionTable:
+    """
+    Lazy view of the partitions of a raw disk image: the image is memory-mapped once
+    and every partition is exposed without copying it, as a memoryview, as a file-like
+    object, or exported to a file sharing its extents with the image when possible.
+
+    All the views and files have to be released/closed before closing the table
+    """
+
+    def __init__(self, image, layout=MEMORY_LAYOUT):
+        self._owns_file = isinstance(image, (str, bytes, os.PathLike))
+        self._file = open(image, "rb") if self._owns_file else image
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._data)
+
+        # Dictionary: partition name -> Partition
+        self.partitions = {
+            name: Partition(name, offset, size)
+            for name, offset, size in partition_offsets(layout)
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __iter__(self):
+        return iter(self.partitions.values())
+
+    def __getitem__(self, name: str) -> memoryview:
+        return self.view(name)
+
+    def get(self, name: str) -> Partition:
+        partition = self.partitions.get(name)
+        if partition == None:
+            raise KeyError(f'Invalid partition name: "{name}"')
+        return partition
+
+    def view(self, name: str) -> memoryview:
+        """Zero-copy view of the partition (shorter than expected if the image is)"""
+        partition = self.get(name)
+        return self._view[partition.offset : partition.offset + partition.size]
+
+    def open(self, name: str) -> PartitionFile:
+        return PartitionFile(self.view(name))
+
+    def regions(self, name: str) -> list:
+        """Empty (0x00) and erased (0xFF) regions of the partition, see find_regions"""
+        with self.view(name) as view:
+            return find_regions(view)
+
+    def export(
+        self, name: str, path: str, reflink: bool = True, regions: list = None
+    ) -> int:
+        """
+        Write the partition to path, sharing the extents of the image (reflink) when
+        the filesystem supports it and copying the data kernel-side otherwise.
+        If the regions of the partition are given, the zero regions are not written
+        and left as holes.
+        Returns the number of bytes written
+        """
+        partition = self.get(name)
+        size = max(0, min(partition.size, len(self._data) - partition.offset))
+        fd_in = self._file.fileno()
+        with open(path, "wb") as file_out:
+            if reflink:
+                try:
+                    return reflink_range(
+                        fd_in, file_out.fileno(), partition.offset, size
+                    )
+                except OSError:
+                    pass
+            if regions != None:
+                return sparse_copy_range(
+                    fd_in, file_out.fileno(), partition.offset, regions
+                )
+            return copy_range(fd_in, file_out.fileno(), partition.offset, size)
+
+    def close(self):
+        self._view.release()
+        self._data.close()
+        if self._owns_file:
+            self._file.close()
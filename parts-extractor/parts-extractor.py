@@ -14,43 +14,38 @@
 
 import sys
 import os
+import json
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from partition_table import PartitionTable, occupancy_map
+from partition_store import PartitionStore
 
-# Every element of this array is a tuple:
-# (NAME, SIZE (Kb)), Addresses start from 0.
-MEMORY_LAYOUT = [(f"bootfip{i}", 1024) for i in range(4)] + [
-    ("bootterm1", 512),
-    ("bootmask1", 512),
-    ("bootterm2", 512),
-    ("bootmask2", 512),
-    ("fip_a.0", 1024),
-    ("fip_b.0", 1024),
-    ("fip_a.1", 1024),
-    ("fip_b.1", 1024),
-    ("fipterm1", 1024),
-    ("fipterm2", 1024),
-    ("unused", 2816),
-    ("per_vehicle_config_a", 128),
-    ("per_vehicle_config_b", 128),
-    ("mtdoops", 192),
-    ("version_a", 128),
-    ("version_b", 128),
-    ("secrets_a", 128),
-    ("secrets_b", 128),
-    ("sxid", 320),
-    ("linux_a", 32 * 1024),
-    ("linux_b", 32 * 1024),
-    ("sx_a", 24 * 1024),
-    ("sx_b", 24 * 1024),
-    ("edr", 151367),
-    ("dish_config", 32 * 1024),
-]
 
+def handle_file(file_in, output_folder, sparse=False):
+    occupancy = dict()
+    with PartitionTable(file_in) as table:
+        for partition in table:
+            path = os.path.join(output_folder, partition.name)
+            if sparse:
+                regions = table.regions(partition.name)
+                occupancy[partition.name] = occupancy_map(regions)
+                table.export(partition.name, path, regions=regions)
+            else:
+                table.export(partition.name, path)
 
-def handle_file(file_in, output_folder):
-    for file in MEMORY_LAYOUT:
-        with open(os.path.join(output_folder, file[0]), "wb") as file_out:
-            file_out.write(file_in.read(file[1] * 1024))
+    if sparse:
+        with open(os.path.join(output_folder, "occupancy.json"), "w") as f:
+            f.write(json.dumps(occupancy, indent=4))
+
+
+def handle_batch(input_files, output_folder, jobs, sparse=False):
+    store = PartitionStore(output_folder, sparse)
+    with ProcessPoolExecutor(jobs) as pool:
+        results = pool.map(store.add_image, input_files)
+        for input_file, (manifest, written) in zip(input_files, results):
+            print(
+                f"{input_file}: {written} partitions written, {len(manifest['partitions']) - written} already in the store"
+            )
 
 
 if __name__ == "__main__":
@@ -58,15 +53,42 @@ if __name__ == "__main__":
     parser.add_argument(
         "input_file",
         type=str,
-        help="Path to the input file (the raw disk image you extracted from the dish)",
+        nargs="+",
+        help="Path to the input file (the raw disk image you extracted from the dish), several files can be given with --batch",
     )
     parser.add_argument(
         "output_folder",
         type=str,
         help="Path of the folder in which partitions will be written (will overwrite any existing file with the same names)",
     )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        action="store_true",
+        default=False,
+        help="Extract all the input files in a content-addressed store: identical partitions are only written once, in output_folder/objects, and every image gets a manifest in output_folder/manifests",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of images extracted in parallel in batch mode (default = number of CPUs)",
+    )
+    parser.add_argument(
+        "-s",
+        "--sparse",
+        action="store_true",
+        default=False,
+        help="Detect regions that are all 0x00 or all 0xFF, do not write the 0x00 ones (holes in sparse files) and write the map of the regions of each partition (occupancy.json, or the manifests in batch mode)",
+    )
     args = parser.parse_args()
 
-    os.mkdir(args.output_folder)
-    with open(args.input_file, "rb") as file_in:
-        handle_file(file_in, args.output_folder)
+    if args.batch:
+        handle_batch(args.input_file, args.output_folder, args.jobs, args.sparse)
+    else:
+        if len(args.input_file) != 1:
+            parser.error("only one input file can be given without --batch")
+        os.mkdir(args.output_folder)
+        with open(args.input_file[0], "rb") as file_in:
+            handle_file(file_in, args.output_folder, args.sparse)
@@ -202,27 +202,38 @@ async function displayService(service_name) {
 
     window.last_id = undefined;
 
-    function updateTableData(first = false) {
-        if (first || sniffing) {
-            getMessages(service_name, window.last_id).then((messages) => {
-                if (messages.length > 0) {
-                    window.last_id = messages[messages.length - 1][0];
-                    table.rows.add(messages.map(m => ([m[0], ...m[1]])));
-                    table.draw(false);
-                    hilight_changes(table);
-                    if (!first) {
-                        scroll_tobottom();
-                    }
-                }
-            });
+    function addMessages(messages, first = false) {
+        // skip the messages that were already received
+        if (window.last_id !== undefined) {
+            messages = messages.filter(m => m[0] > window.last_id);
+        }
+        if (messages.length > 0) {
+            window.last_id = messages[messages.length - 1][0];
+            table.rows.add(messages.map(m => ([m[0], ...m[1]])));
+            table.draw(false);
+            hilight_changes(table);
+            if (!first) {
+                scroll_tobottom();
+            }
         }
     }
 
+    function streamMessages() {
+        // new messages are pushed by the server, starting after the last one we have
+        const url = `/stream?services=${service_name}` + (window.last_id !== undefined ? `&last_id=${window.last_id}` : "");
+        const source = new EventSource(url);
+        source.addEventListener(service_name, (event) => {
+            addMessages(JSON.parse(event.data));
+        });
+    }
+
     initStatus();
     render_column_chooser(table);
     handle_autoscroll();
-    updateTableData(true);
-    setInterval(updateTableData, 1000);
+    getMessages(service_name).then((messages) => {
+        addMessages(messages, true);
+        streamMessages();
+    });
 }
 
 function hilight_changes(table) {
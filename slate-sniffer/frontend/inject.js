@@ -81,16 +81,36 @@ function injectMessage(service, message) {
         $.ajax("/inject", {
             data : JSON.stringify({
                 service,
-                message
+                message,
+                wait: false
             }),
             contentType : 'application/json',
             type : 'POST',
-            success: (data) => {
-                resolve();
+            success: (job) => {
+                checkInjection(job, resolve, reject);
             },
             error: () => {
                 reject();
             }
         });
     });
-}
\ No newline at end of file
+}
+
+function checkInjection(job, resolve, reject) {
+    // the job can already be finished when the injection is answered
+    if (job.status === "done") {
+        resolve();
+    } else if (job.status === "failed") {
+        reject();
+    } else {
+        setTimeout(() => waitInjection(job.id, resolve, reject), 500);
+    }
+}
+
+function waitInjection(id, resolve, reject) {
+    $.get(`/inject/${id}`, (job) => {
+        checkInjection(job, resolve, reject);
+    }).fail(() => {
+        reject();
+    });
+}
@@ -313,7 +313,7 @@ def main(
     services = Service.parse(
         "./config/service_directory.json", "./config/process_info.json"
     )
-    slates = list(map(Slate.from_service, services))
+    slates = Slate.from_services(services)
     assert len(services) == len(slates)
 
     slate = filter(lambda s: s.service.name == service, slates).__next__()
@@ -0,0 +1,695 @@
+# Copyright 2023 Quarkslab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import sys
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Lock, Thread
+from typing import Any, Callable, Mapping
+from urllib.parse import quote
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_etags
+from .broadcast import Broadcaster, Subscriber
+from .capture_log import CaptureLog
+from .injector import BatchReport, Injector
+from .service import Service
+from .slate import Slate
+from .sniffer import Sniffer
+from .storage import SlateStorage
+from .target import Target
+from . import serialize
+
+# Maximum number of messages returned by a historical query
+HISTORY_LIMIT = 10000
+# Seconds between two keep-alive comments of an idle event stream
+STREAM_KEEPALIVE = 15
+# Number of finished injection jobs whose status is kept
+MAX_FINISHED_JOBS = 1000
+
+
+class ApiError(Exception):
+    def __init__(self, status: int):
+        super().__init__(f"HTTP error {status}")
+        self.status = status
+
+
+class ApiResponse:
+    def __init__(
+        self,
+        body: bytes = b"",
+        mimetype: str = "application/json",
+        status: int = 200,
+        headers: dict[str, str] = None,
+    ):
+        self.body = body
+        self.mimetype = mimetype
+        self.status = status
+        self.headers = dict() if headers == None else headers
+
+
+class Capture:
+    """
+    Runs the sniffer in its own thread, it can be started again once it stopped.
+    error is the last exception raised by the sniffer, e.g. if the dish could not be
+    reached
+    """
+
+    def __init__(
+        self,
+        sniffer: Sniffer,
+        handler: Callable[[str, tuple], None],
+        batch_handler: Callable[[str, list], None] = None,
+        raw_handler: Callable[[str, bytes, list[float]], None] = None,
+    ):
+        self.sniffer = sniffer
+        self.handlers = (handler, batch_handler, raw_handler)
+        self.should_stop = False
+        self.thread = None
+        self.error = None
+
+    def start(self):
+        if self.running():
+            return
+        self.should_stop = False
+        self.error = None
+        self.thread = Thread(target=self.run)
+        self.thread.start()
+
+    def run(self):
+        handler, batch_handler, raw_handler = self.handlers
+        try:
+            self.sniffer.sniff(
+                handler, lambda: self.should_stop, batch_handler, raw_handler
+            )
+        except Exception as e:
+            print(e, file=sys.stderr)
+            self.error = str(e)
+
+    def stop(self):
+        self.should_stop = True
+
+    def join(self):
+        if self.thread != None:
+            self.thread.join()
+
+    def running(self) -> bool:
+        return self.thread != None and self.thread.is_alive()
+
+
+class InjectionJob:
+    """
+    send is called with the job to send its messages, batches also have a report
+    of their progress and can be cancelled while they are sent
+    """
+
+    def __init__(
+        self,
+        job_id: int,
+        service: str,
+        send: Callable[["InjectionJob"], Any],
+        report: BatchReport = None,
+    ):
+        self.id = job_id
+        self.service = service
+        self.send = send
+        self.report = report
+        self.status = "pending"
+        self.error = None
+        self.cancelled = False
+        self.submitted = time.time()
+        self.finished = None
+        self.future: Future = None
+
+    def to_dict(self) -> dict:
+        result = {
+            "id": self.id,
+            "service": self.service,
+            "status": self.status,
+            "error": self.error,
+            "submitted": self.submitted,
+            "finished": self.finished,
+        }
+        if self.report != None:
+            result["report"] = self.report.to_dict()
+        return result
+
+
+class InjectionJobs:
+    """
+    Sends the injected messages of a target in the background and in order, so
+    that requests never wait for the SSH setup. Batches are sent in order by their
+    own thread, so that a long replay does not hold back the single messages. The
+    status of the last finished jobs is kept for polling
+    """
+
+    def __init__(self, injector: Injector, max_finished: int = MAX_FINISHED_JOBS):
+        self.injector = injector
+        self.max_finished = max_finished
+        self.executor = ThreadPoolExecutor(1)
+        self.batch_executor = ThreadPoolExecutor(1)
+        self.ids = itertools.count()
+        # Dictionary: job id -> job, in submission order
+        self.jobs: dict[int, InjectionJob] = dict()
+        self.lock = Lock()
+
+    def submit(self, service: str, message: tuple) -> InjectionJob:
+        return self.start(
+            service, lambda job: self.injector.send_message(service, message)
+        )
+
+    def submit_batch(
+        self,
+        service: str,
+        messages: list[tuple],
+        timestamps: list[float] = None,
+        speed: float = 1.0,
+    ) -> InjectionJob:
+        """See Injector.send_batch"""
+        return self.start(
+            service,
+            lambda job: self.injector.send_batch(
+                service, messages, timestamps, speed, job.report, lambda: job.cancelled
+            ),
+            BatchReport(),
+        )
+
+    def start(
+        self,
+        service: str,
+        send: Callable[[InjectionJob], Any],
+        report: BatchReport = None,
+    ) -> InjectionJob:
+        if service not in self.injector.slates:
+            raise Exception(f'Service "{service}" not valid')
+        job = InjectionJob(next(self.ids), service, send, report)
+        self.lock.acquire()
+        self.jobs[job.id] = job
+        finished = [j.id for j in self.jobs.values() if j.finished != None]
+        for job_id in finished[: max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job_id]
+        self.lock.release()
+        executor = self.executor if report == None else self.batch_executor
+        job.future = executor.submit(self.run, job)
+        return job
+
+    def run(self, job: InjectionJob):
+        job.status = "running"
+        try:
+            job.send(job)
+            job.status = "cancelled" if job.cancelled else "done"
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+        job.finished = time.time()
+
+    def cancel(self, job_id: int) -> InjectionJob | None:
+        """Stop a batch, or remove a job that did not start yet"""
+        job = self.jobs.get(job_id)
+        if job == None:
+            return None
+        job.cancelled = True
+        if job.future.cancel():
+            job.status = "cancelled"
+            job.finished = time.time()
+        return job
+
+    def get(self, job_id: int) -> InjectionJob | None:
+        return self.jobs.get(job_id)
+
+    def list(self) -> list[InjectionJob]:
+        return list(self.jobs.values())
+
+    def shutdown(self):
+        for job in self.list():
+            job.cancelled = True
+        self.executor.shutdown(cancel_futures=True)
+        self.batch_executor.shutdown(cancel_futures=True)
+        self.injector.close()
+
+
+class Stream:
+    """
+    Server-Sent Events of a subscriber: one event per service and batch of new
+    messages, whose data is the list of [id, message]. With a single service, the
+    messages following last_id are sent first
+    """
+
+    def __init__(self, api: "Api", services: set[str] | None, last_id: int = None):
+        self.api = api
+        self.services = services
+        self.last_id = last_id
+        # Dictionary: service name -> id of the last message sent
+        self.last_sent = dict()
+
+    def backlog(self) -> list[str]:
+        if self.services == None or len(self.services) != 1:
+            return []
+        name = next(iter(self.services))
+        messages = self.api.store.get_messages(name, self.last_id)
+        if messages == None or len(messages) == 0:
+            return []
+        self.last_sent[name] = messages[-1][0]
+        return [self.event(name, messages)]
+
+    def events(self, pending: dict[str, list]) -> list[str]:
+        """Format the messages popped from the subscriber, without duplicates"""
+        if len(pending) == 0:
+            return [": keepalive\n\n"]
+        events = []
+        for name, messages in pending.items():
+            after = self.last_sent.get(name, -1)
+            messages = [m for m in messages if m[0] > after]
+            if len(messages) > 0:
+                events.append(self.event(name, messages))
+                self.last_sent[name] = messages[-1][0]
+        return events
+
+    def event(self, name: str, messages: list) -> str:
+        data = serialize.json_encoder.encode(messages)
+        return f"event: {name}\nid: {messages[-1][0]}\ndata: {data}\n\n"
+
+
+class Api:
+    """
+    The endpoints of the server for one target, independent of the web framework:
+    they take the path parameters, the query parameters, the headers and the JSON
+    body of the request, return an ApiResponse and raise ApiError
+    """
+
+    def __init__(
+        self,
+        services: list[Service],
+        slates: list[Slate],
+        sniffer: Sniffer,
+        store: SlateStorage,
+        injector: Injector,
+        log: CaptureLog = None,
+        target: Target = None,
+    ):
+        self.target = Target.default() if target == None else target
+        self.services = services
+        self.sniffer = sniffer
+        self.store = store
+        self.log = log
+        self.parsers = {slate.service.name: slate.message_parser for slate in slates}
+        self.broadcaster = Broadcaster()
+        raw_handler = None if log == None else log.handle_raw
+        self.capture = Capture(
+            sniffer, self.handle_message, self.handle_messages, raw_handler
+        )
+        self.jobs = InjectionJobs(injector)
+        # Dictionary: (path, content encoding) -> (body, ETag), for the responses
+        # that never change
+        self.response_cache = dict()
+
+    def handle_message(self, name: str, message: tuple):
+        msg_id = self.store.handle_message(name, message)
+        self.broadcaster.publish(name, [(msg_id, message)])
+
+    def handle_messages(self, name: str, messages: list):
+        first_id = self.store.handle_messages(name, messages)
+        self.broadcaster.publish(name, list(zip(itertools.count(first_id), messages)))
+
+    def respond(
+        self,
+        body: bytes,
+        headers: Mapping[str, str],
+        mimetype: str = "application/json",
+        encoding: str = None,
+    ) -> ApiResponse:
+        """Compress the body with the encoding preferred by the client"""
+        if encoding == None and len(body) >= serialize.COMPRESS_MIN_SIZE:
+            accepted = parse_accept_header(headers.get("Accept-Encoding"))
+            encoding = serialize.choose_encoding(accepted)
+            body = serialize.compress(body, encoding)
+        response = ApiResponse(body, mimetype, headers={"Vary": "Accept-Encoding"})
+        if encoding != None:
+            response.headers["Content-Encoding"] = encoding
+        return response
+
+    def respond_json(self, value, headers: Mapping[str, str]) -> ApiResponse:
+        return self.respond(serialize.encode_json(value), headers)
+
+    def cached_response(
+        self, path: str, headers: Mapping[str, str], build: Callable[[], bytes]
+    ) -> ApiResponse:
+        """Build and compress a JSON response once, then answer 304 to its ETag"""
+        accepted = parse_accept_header(headers.get("Accept-Encoding"))
+        encoding = serialize.choose_encoding(accepted)
+        key = (path, encoding)
+        if key not in self.response_cache:
+            body = serialize.compress(build(), encoding)
+            self.response_cache[key] = (body, serialize.etag(body))
+        body, etag = self.response_cache[key]
+        if parse_etags(headers.get("If-None-Match")).contains(etag):
+            return ApiResponse(status=304, headers={"ETag": f'"{etag}"'})
+        response = self.respond(body, headers, encoding=encoding)
+        response.headers["ETag"] = f'"{etag}"'
+        return response
+
+    def get_status(self, headers: Mapping[str, str]) -> ApiResponse:
+        status = {"status": self.capture.running(), "error": self.capture.error}
+        return self.respond_json(status, headers)
+
+    def set_status(self, data: dict, headers: Mapping[str, str]) -> ApiResponse:
+        status = data.get("status")
+        if status == True:
+            self.capture.start()
+        else:
+            self.capture.stop()
+        return self.respond_json({"status": status}, headers)
+
+    def get_stats(self, headers: Mapping[str, str]) -> ApiResponse:
+        stats = self.sniffer.stats()
+        stats.update(self.jobs.injector.pool.stats())
+        return self.respond_json(stats, headers)
+
+    def stream(
+        self,
+        args: Mapping[str, str],
+        headers: Mapping[str, str],
+        callback: Callable[[], None] = None,
+    ) -> tuple[Stream, Subscriber]:
+        """Returns the Stream and its Subscriber, which must be unsubscribed"""
+        names = args.get("services")
+        services_filter = None if names == None else set(names.split(","))
+        # browsers send the id of the last event they received when they reconnect
+        last_id = get_arg(headers, "Last-Event-ID", int)
+        if last_id == None:
+            last_id = get_arg(args, "last_id", int)
+        subscriber = self.broadcaster.subscribe(services_filter, callback=callback)
+        return Stream(self, services_filter, last_id), subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.broadcaster.unsubscribe(subscriber)
+
+    def get_services(self, headers: Mapping[str, str]) -> ApiResponse:
+        return self.cached_response(
+            "/services", headers, lambda: serialize.encode_json(self.services)
+        )
+
+    def get_messages(
+        self, name: str, args: Mapping[str, str], headers: Mapping[str, str]
+    ) -> ApiResponse:
+        """
+        The format is chosen by the Accept header, see lib/serialize.py. Raw
+        messages have no timestamps, the id of the first one is in X-First-Id
+        """
+        if name not in self.parsers:
+            raise ApiError(404)
+        fmt = parse_accept_header(headers.get("Accept"), MIMEAccept).best_match(
+            serialize.formats(), default=serialize.JSON
+        )
+        # historical ranges are read from the capture log
+        history = {
+            key: get_arg(args, key, float if key in ("since", "until") else int)
+            for key in ("from_id", "to_id", "since", "until", "limit")
+            if key in args
+        }
+        if len(history) > 0:
+            if self.log == None:
+                raise ApiError(400)
+            if history.get("limit") == None:
+                history["limit"] = HISTORY_LIMIT
+            first_id, columns, timestamps = self.log.get_columns(name, **history)
+            body = serialize.encode_columns(
+                first_id, columns, fmt, self.parsers[name], timestamps
+            )
+        else:
+            last_id = get_arg(args, "last_id", int)
+            if fmt == serialize.JSON:
+                # the stored messages already are rows
+                messages = self.store.get_messages(name, last_id)
+                first_id = messages[0][0] if len(messages) > 0 else None
+                body = serialize.encode_json(messages)
+            else:
+                first_id, columns = self.store.get_columns(name, last_id)
+                body = serialize.encode_columns(
+                    first_id, columns, fmt, self.parsers[name]
+                )
+        response = self.respond(body, headers, fmt)
+        if first_id != None:
+            response.headers["X-First-Id"] = str(first_id)
+        response.headers["Vary"] += ", Accept"
+        return response
+
+    def get_deltas(
+        self, name: str, args: Mapping[str, str], headers: Mapping[str, str]
+    ) -> ApiResponse:
+        deltas = self.store.get_deltas(name, get_arg(args, "last_id", int))
+        if deltas == None:
+            raise ApiError(404)
+        return self.respond_json(deltas, headers)
+
+    def get_aggregate(
+        self, name: str, args: Mapping[str, str], headers: Mapping[str, str]
+    ) -> ApiResponse:
+        if name not in self.store.store:
+            raise ApiError(404)
+        field = args.get("field")
+        operation = args.get("op", "mean")
+        window = get_arg(args, "window", int)
+        try:
+            value = self.store.aggregate(name, field, operation, window)
+        except Exception:
+            raise ApiError(400)
+        return self.respond_json(
+            {"field": field, "op": operation, "value": value}, headers
+        )
+
+    def get_schema(self, name: str, headers: Mapping[str, str]) -> ApiResponse:
+        schema = self.store.get_schema(name)
+        if not schema:
+            raise ApiError(404)
+        return self.cached_response(
+            f"/services/{name}/schema",
+            headers,
+            lambda: serialize.encode_json(
+                list(map(lambda x: {"name": x.name, "type": x.dtype.name}, schema))
+            ),
+        )
+
+    def handle_filter(
+        self, name: str, method: str, data: dict, headers: Mapping[str, str]
+    ) -> ApiResponse:
+        try:
+            if method == "POST":
+                self.sniffer.set_filter(name, data.get("where"), data.get("changes"))
+            elif method == "DELETE":
+                self.sniffer.clear_filter(name)
+            slate_filter = self.sniffer.get_filter(name)
+        except Exception:
+            raise ApiError(400)
+        return self.respond_json(
+            slate_filter.to_dict() if slate_filter != None else None, headers
+        )
+
+    def inject(self, data: dict) -> InjectionJob:
+        """Queue the injection of data["message"] in data["service"]"""
+        try:
+            return self.jobs.submit(data["service"], tuple(data["message"]))
+        except Exception:
+            raise ApiError(400)
+
+    def inject_batch(self, data: dict) -> InjectionJob:
+        """
+        Queue the injection of a batch of messages in data["service"], see
+        batch_messages for where they come from. data["speed"] multiplies their
+        cadence, 0 sends them as fast as possible
+        """
+        try:
+            messages, timestamps = self.batch_messages(data)
+            speed = data.get("speed", 1.0)
+            return self.jobs.submit_batch(data["service"], messages, timestamps, speed)
+        except ApiError:
+            raise
+        except Exception:
+            raise ApiError(400)
+
+    def batch_messages(self, data: dict) -> tuple[list[tuple], list[float] | None]:
+        """
+        The messages are data["messages"], with data["timestamps"] or one every
+        data["interval"] seconds, or they are read from data["source"]: from the
+        capture log with its from_id, to_id, since, until and limit parameters (and
+        then have their capture timestamps), or from the store after its last_id.
+        The source can be another service than the injected one
+        """
+        timestamps = data.get("timestamps")
+        source = data.get("source")
+        if source == None:
+            messages = [tuple(message) for message in data["messages"]]
+        else:
+            name = source.get("service", data["service"])
+            history = {
+                key: source[key]
+                for key in ("from_id", "to_id", "since", "until", "limit")
+                if key in source
+            }
+            if len(history) > 0:
+                if self.log == None:
+                    raise ApiError(400)
+                history.setdefault("limit", HISTORY_LIMIT)
+                records = self.log.get_messages(name, **history)
+                if records == None:
+                    raise ApiError(404)
+                messages = [message for _, message, _ in records]
+                timestamps = [timestamp for _, _, timestamp in records]
+            else:
+                records = self.store.get_messages(name, source.get("last_id"))
+                if records == None:
+                    raise ApiError(404)
+                messages = [message for _, message in records]
+
+        interval = data.get("interval")
+        if interval != None:
+            timestamps = [i * interval for i in range(len(messages))]
+        if timestamps != None and len(timestamps) != len(messages):
+            raise ApiError(400)
+        return messages, timestamps
+
+    def injection_response(
+        self, job: InjectionJob, wait: bool, headers: Mapping[str, str]
+    ) -> ApiResponse:
+        """
+        202 and the job while it is not finished, so that it can be polled at its
+        Location, then the job itself. Only single messages whose client waited get
+        an empty response or 400, as before injections were jobs
+        """
+        if not wait or job.report != None:
+            response = self.respond_json(job.to_dict(), headers)
+            if job.finished == None:
+                response.status = 202
+                # the route of the target, the one without prefix is only valid
+                # for the default target
+                target = quote(self.target.name, safe="")
+                response.headers["Location"] = f"/targets/{target}/inject/{job.id}"
+            return response
+        if job.status == "failed":
+            raise ApiError(400)
+        return ApiResponse(b"", "text/html")
+
+    def cancel_job(self, job_id: int, headers: Mapping[str, str]) -> ApiResponse:
+        job = self.jobs.cancel(job_id)
+        if job == None:
+            raise ApiError(404)
+        return self.respond_json(job.to_dict(), headers)
+
+    def get_job(self, job_id: int, headers: Mapping[str, str]) -> ApiResponse:
+        job = self.jobs.get(job_id)
+        if job == None:
+            raise ApiError(404)
+        return self.respond_json(job.to_dict(), headers)
+
+    def get_jobs(self, headers: Mapping[str, str]) -> ApiResponse:
+        return self.respond_json([job.to_dict() for job in self.jobs.list()], headers)
+
+    def close(self):
+        self.capture.stop()
+        self.capture.join()
+        self.jobs.shutdown()
+        if self.log != None:
+            self.log.close()
+
+
+class TargetsApi:
+    """
+    The Api of every target, the first one also answers the requests that do not
+    name a target, and the queries comparing the targets
+    """
+
+    def __init__(self, apis: list[Api], executor: ProcessPoolExecutor = None):
+        """executor is the decode pool shared by the sniffers, closed with them"""
+        # Dictionary: target name -> Api
+        self.apis = {api.target.name: api for api in apis}
+        self.default = apis[0]
+        self.executor = executor
+
+    def get(self, target: str = None) -> Api:
+        if target == None:
+            return self.default
+        api = self.apis.get(target)
+        if api == None:
+            raise ApiError(404)
+        return api
+
+    def select(self, args: Mapping[str, str]) -> list[Api]:
+        """The targets of the targets parameter (a list of names), all by default"""
+        names = args.get("targets")
+        if names == None:
+            return list(self.apis.values())
+        return [self.get(name) for name in names.split(",")]
+
+    def get_targets(self, headers: Mapping[str, str]) -> ApiResponse:
+        targets = [
+            {
+                "name": api.target.name,
+                "host": api.target.host,
+                "status": api.capture.running(),
+                "error": api.capture.error,
+            }
+            for api in self.apis.values()
+        ]
+        return self.default.respond_json(targets, headers)
+
+    def set_status(self, data: dict, headers: Mapping[str, str]) -> ApiResponse:
+        """Start or stop the capture of all the targets"""
+        for api in self.apis.values():
+            api.set_status(data, headers)
+        return self.get_targets(headers)
+
+    def compare(
+        self, name: str, args: Mapping[str, str], headers: Mapping[str, str]
+    ) -> ApiResponse:
+        """
+        The last message of a service on every target, as target name -> [id,
+        message] (None if there is none yet), or an aggregation of one of its
+        fields if the field, op and window parameters are given, as for
+        /services/<name>/aggregate
+        """
+        apis = self.select(args)
+        if name not in self.default.parsers:
+            raise ApiError(404)
+        field = args.get("field")
+        result = dict()
+        for api in apis:
+            if field == None:
+                result[api.target.name] = api.store.get_last_message(name)
+                continue
+            try:
+                result[api.target.name] = api.store.aggregate(
+                    name, field, args.get("op", "mean"), get_arg(args, "window", int)
+                )
+            except Exception:
+                raise ApiError(400)
+        return self.default.respond_json(result, headers)
+
+    def close(self):
+        for api in self.apis.values():
+            api.capture.stop()
+        for api in self.apis.values():
+            api.close()
+        if self.executor != None:
+            self.executor.shutdown()
+
+
+def get_arg(args: Mapping[str, str], key: str, convert: Callable[[str], Any] = str):
+    """Converted value of a parameter, None if it is missing or invalid"""
+    value = args.get(key)
+    if value == None:
+        return None
+    try:
+        return convert(value)
+    except ValueError:
+        return None
@@ -0,0 +1,226 @@
+# Copyright 2023 Quarkslab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from aiohttp import web
+from .api import Api, ApiError, ApiResponse, TargetsApi, STREAM_KEEPALIVE
+
+# Threads computing the responses that can take a while, such as big histories,
+# so that they do not block the event loop
+API_WORKERS = 4
+FRONTEND_FOLDER = "./frontend"
+
+
+def aiohttp_response(response: ApiResponse) -> web.Response:
+    return web.Response(
+        body=response.body,
+        status=response.status,
+        content_type=response.mimetype,
+        headers=response.headers,
+    )
+
+
+@web.middleware
+async def handle_api_error(request: web.Request, handler):
+    try:
+        return await handler(request)
+    except ApiError as e:
+        return web.Response(status=e.status)
+
+
+def make_app(targets: TargetsApi) -> web.Application:
+    """
+    aiohttp routes of the Api: every client is served by the event loop, the
+    captures run in their own threads and the injections are jobs, so neither of
+    them makes the other requests wait. As with Flask, the routes of a target are
+    also available without the /targets/<target> prefix for the default target
+    """
+    executor = ThreadPoolExecutor(API_WORKERS)
+
+    def target_api(request: web.Request) -> Api:
+        return targets.get(request.match_info.get("target"))
+
+    async def call(function: Callable, *args) -> web.Response:
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(executor, function, *args)
+        return aiohttp_response(response)
+
+    async def get_targets(request: web.Request):
+        return aiohttp_response(targets.get_targets(request.headers))
+
+    async def set_targets_status(request: web.Request):
+        data = await request.json()
+        return aiohttp_response(targets.set_status(data, request.headers))
+
+    async def compare(request: web.Request):
+        name = request.match_info["name"]
+        return await call(targets.compare, name, request.query, request.headers)
+
+    async def get_status(request: web.Request):
+        return aiohttp_response(target_api(request).get_status(request.headers))
+
+    async def set_status(request: web.Request):
+        api = target_api(request)
+        data = await request.json()
+        return aiohttp_response(api.set_status(data, request.headers))
+
+    async def get_stats(request: web.Request):
+        return aiohttp_response(target_api(request).get_stats(request.headers))
+
+    async def stream(request: web.Request):
+        api = target_api(request)
+        loop = asyncio.get_running_loop()
+        wake_up = asyncio.Event()
+        event_stream, subscriber = api.stream(
+            request.query,
+            request.headers,
+            lambda: loop.call_soon_threadsafe(wake_up.set),
+        )
+        response = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
+        )
+        try:
+            await response.prepare(request)
+            for event in event_stream.backlog():
+                await response.write(event.encode())
+            while True:
+                try:
+                    await asyncio.wait_for(wake_up.wait(), STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    pass
+                wake_up.clear()
+                for event in event_stream.events(subscriber.pop(0)):
+                    await response.write(event.encode())
+        except ConnectionResetError:
+            pass
+        finally:
+            api.unsubscribe(subscriber)
+        return response
+
+    async def get_services(request: web.Request):
+        return aiohttp_response(target_api(request).get_services(request.headers))
+
+    async def get_messages(request: web.Request):
+        api = target_api(request)
+        name = request.match_info["name"]
+        return await call(api.get_messages, name, request.query, request.headers)
+
+    async def get_deltas(request: web.Request):
+        api = target_api(request)
+        name = request.match_info["name"]
+        return await call(api.get_deltas, name, request.query, request.headers)
+
+    async def get_aggregate(request: web.Request):
+        api = target_api(request)
+        name = request.match_info["name"]
+        return await call(api.get_aggregate, name, request.query, request.headers)
+
+    async def get_schema(request: web.Request):
+        api = target_api(request)
+        name = request.match_info["name"]
+        return aiohttp_response(api.get_schema(name, request.headers))
+
+    async def handle_filter(request: web.Request):
+        api = target_api(request)
+        name = request.match_info["name"]
+        data = await request.json() if request.method == "POST" else None
+        return aiohttp_response(
+            api.handle_filter(name, request.method, data, request.headers)
+        )
+
+    async def get_jobs(request: web.Request):
+        return aiohttp_response(target_api(request).get_jobs(request.headers))
+
+    async def inject(request: web.Request):
+        api = target_api(request)
+        data = await request.json()
+        job = api.inject(data)
+        wait = data.get("wait", True)
+        if wait:
+            await asyncio.wrap_future(job.future)
+        return aiohttp_response(api.injection_response(job, wait, request.headers))
+
+    async def inject_batch(request: web.Request):
+        api = target_api(request)
+        data = await request.json()
+        job = api.inject_batch(data)
+        # batches can take as long as the capture they replay
+        wait = data.get("wait", False)
+        if wait:
+            await asyncio.wrap_future(job.future)
+        return aiohttp_response(api.injection_response(job, wait, request.headers))
+
+    async def handle_job(request: web.Request):
+        api = target_api(request)
+        try:
+            job_id = int(request.match_info["job_id"])
+        except ValueError:
+            raise ApiError(404)
+        if request.method == "DELETE":
+            return aiohttp_response(api.cancel_job(job_id, request.headers))
+        return aiohttp_response(api.get_job(job_id, request.headers))
+
+    async def index(request: web.Request):
+        return web.FileResponse(f"{FRONTEND_FOLDER}/index.html")
+
+    async def stop_captures(app: web.Application):
+        for api in targets.apis.values():
+            api.capture.stop()
+        for api in targets.apis.values():
+            await asyncio.to_thread(api.capture.join)
+
+    async def close_executor(app: web.Application):
+        executor.shutdown()
+
+    target_routes = [
+        ("GET", "/status", get_status),
+        ("POST", "/status", set_status),
+        ("GET", "/stats", get_stats),
+        ("GET", "/stream", stream),
+        ("GET", "/services", get_services),
+        ("GET", "/services/{name}/messages", get_messages),
+        ("GET", "/services/{name}/deltas", get_deltas),
+        ("GET", "/services/{name}/aggregate", get_aggregate),
+        ("GET", "/services/{name}/schema", get_schema),
+        ("GET", "/services/{name}/filter", handle_filter),
+        ("POST", "/services/{name}/filter", handle_filter),
+        ("DELETE", "/services/{name}/filter", handle_filter),
+        ("GET", "/inject", get_jobs),
+        ("POST", "/inject", inject),
+        ("POST", "/inject/batch", inject_batch),
+        ("GET", "/inject/{job_id}", handle_job),
+        ("DELETE", "/inject/{job_id}", handle_job),
+    ]
+
+    app = web.Application(middlewares=[handle_api_error])
+    app.add_routes(
+        [
+            web.get("/targets", get_targets),
+            web.post("/targets", set_targets_status),
+            web.get("/compare/{name}", compare),
+        ]
+    )
+    for method, path, handler in target_routes:
+        app.router.add_route(method, path, handler)
+        app.router.add_route(method, "/targets/{target}" + path, handler)
+    app.add_routes([web.get("/", index), web.static("/", FRONTEND_FOLDER)])
+    app.on_shutdown.append(stop_captures)
+    app.on_cleanup.append(close_executor)
+    return app
+
+
+def run_app(targets: TargetsApi, host: str, port: int):
+    web.run_app(make_app(targets), host=host, port=port)
@@ -0,0 +1,96 @@
+# Copyright 2023 Quarkslab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from threading import Condition, Lock
+from typing import Callable
+
+# Maximum number of messages waiting to be sent to a subscriber, for each service
+MAX_PENDING = 1000
+
+
+class Subscriber:
+    """
+    Messages waiting to be sent to a client. Messages are grouped by service, so
+    that a slow client gets them in a few big batches, and the oldest ones are
+    dropped when more than max_pending are waiting, instead of slowing down the
+    publisher. callback is called, from the publisher thread, every time messages
+    are pushed, e.g. to wake up an asyncio task
+    """
+
+    def __init__(
+        self,
+        services: set[str] | None = None,
+        max_pending=MAX_PENDING,
+        callback: Callable[[], None] = None,
+    ):
+        self.services = services
+        self.max_pending = max_pending
+        self.callback = callback
+        self.dropped = 0
+        # Dictionary: service name -> list of (id, message)
+        self.pending = dict()
+        self.condition = Condition()
+
+    def push(self, name: str, messages: list):
+        self.condition.acquire()
+        pending = self.pending.setdefault(name, [])
+        pending.extend(messages)
+        if len(pending) > self.max_pending:
+            self.dropped += len(pending) - self.max_pending
+            del pending[: len(pending) - self.max_pending]
+        self.condition.notify()
+        self.condition.release()
+        if self.callback != None:
+            self.callback()
+
+    def pop(self, timeout: float = None) -> dict:
+        """Wait for messages, returns a dictionary: service name -> (id, message) list"""
+        self.condition.acquire()
+        if len(self.pending) == 0:
+            self.condition.wait(timeout)
+        pending = self.pending
+        self.pending = dict()
+        self.condition.release()
+        return pending
+
+
+class Broadcaster:
+    def __init__(self):
+        self.subscribers: list[Subscriber] = []
+        self.lock = Lock()
+
+    def subscribe(
+        self,
+        services: set[str] | None = None,
+        max_pending=MAX_PENDING,
+        callback: Callable[[], None] = None,
+    ) -> Subscriber:
+        """Receive the messages of the given services (all of them if None)"""
+        subscriber = Subscriber(services, max_pending, callback)
+        self.lock.acquire()
+        # the list is copied so that publish can iterate on it without locking
+        self.subscribers = self.subscribers + [subscriber]
+        self.lock.release()
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.lock.acquire()
+        self.subscribers = [s for s in self.subscribers if s != subscriber]
+        self.lock.release()
+
+    def publish(self, name: str, messages: list):
+        """Send a list of (id, message) of a service to its subscribers"""
+        for subscriber in self.subscribers:
+            if subscriber.services == None or name in subscriber.services:
+                subscriber.push(name, messages)
@@ -0,0 +1,348 @@
+# Copyright 2023 Quarkslab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import mmap
+import bisect
+import numpy as np
+from threading import Lock
+from .slate import Slate
+
+# Maximum size of a segment file, a new one is started when it is reached
+SEGMENT_SIZE = 64 * 1024 * 1024
+SEGMENT_SUFFIX = ".log"
+
+
+class Segment:
+    def __init__(self, path: str, first_id: int, count: int):
+        self.path = path
+        self.first_id = first_id
+        self.count = count
+        self.first_timestamp = None
+        self.last_timestamp = None
+        # mmap of the segment once it is full, the active one is mapped at every read
+        self.map = None
+
+
+class ServiceLog:
+    """
+    Append-only log of the raw messages of a slate, split in segment files named
+    after the id of their first message. Each record is the capture timestamp
+    (little-endian double) followed by the raw message, so records have a fixed
+    size and message i of a segment is at offset i * record size.
+
+    Segments are the sparse index: they are found by id or by timestamp with a
+    bisection, then the message is found inside the segment by arithmetic or by a
+    binary search of the mapped timestamps.
+    Segments are deleted, oldest first, when the log is bigger than max_size bytes
+    or older than max_age seconds (compared with the last capture timestamp)
+    """
+
+    def __init__(
+        self,
+        folder: str,
+        slate: Slate,
+        segment_size: int = SEGMENT_SIZE,
+        max_size: int = None,
+        max_age: float = None,
+    ):
+        self.folder = folder
+        self.slate = slate
+        self.max_size = max_size
+        self.max_age = max_age
+        self.lock = Lock()
+
+        size = slate.message_parser.struct.size
+        self.dtype = np.dtype([("timestamp", "<f8"), ("data", f"V{size}")])
+        self.segment_records = max(1, segment_size // self.dtype.itemsize)
+
+        os.makedirs(folder, exist_ok=True)
+        self.check_format()
+        self.segments: list[Segment] = []
+        for name in sorted(os.listdir(folder)):
+            if name.endswith(SEGMENT_SUFFIX):
+                self.segments.append(self.open_segment(os.path.join(folder, name)))
+        self.file = None
+
+    def check_format(self):
+        """The records of a log can only be read with the format they were written"""
+        path = os.path.join(self.folder, "format")
+        fmt = self.slate.message_parser.struct.format
+        if os.path.isfile(path):
+            with open(path) as f:
+                previous = f.read().strip()
+            if previous != fmt:
+                raise Exception(
+                    f"The format of {self.slate.service.name} changed "
+                    f"({previous} -> {fmt}), move {self.folder} away to start a new log"
+                )
+        else:
+            with open(path, "w") as f:
+                f.write(fmt)
+
+    def open_segment(self, path: str) -> Segment:
+        first_id = int(os.path.basename(path)[: -len(SEGMENT_SUFFIX)])
+        size = os.path.getsize(path)
+        count = size // self.dtype.itemsize
+        if count * self.dtype.itemsize != size:
+            # the last record was not completely written
+            os.truncate(path, count * self.dtype.itemsize)
+
+        segment = Segment(path, first_id, count)
+        if count > 0:
+            with open(path, "rb") as f:
+                segment.first_timestamp = self.read_timestamp(f, 0)
+                segment.last_timestamp = self.read_timestamp(f, count - 1)
+        return segment
+
+    def read_timestamp(self, f, index: int) -> float:
+        f.seek(index * self.dtype.itemsize)
+        return float(np.frombuffer(f.read(8), "<f8")[0])
+
+    def next_id(self) -> int:
+        if len(self.segments) == 0:
+            return 0
+        return self.segments[-1].first_id + self.segments[-1].count
+
+    def append(self, data: bytes, timestamps: list[float]):
+        """Append raw messages, stored one after the other, and their timestamps"""
+        records = np.empty(len(timestamps), self.dtype)
+        records["timestamp"] = timestamps
+        records["data"] = np.frombuffer(data, self.dtype["data"], len(timestamps))
+
+        self.lock.acquire()
+        try:
+            pos = 0
+            while pos < len(records):
+                segment = self.active_segment()
+                count = min(len(records) - pos, self.segment_records - segment.count)
+                self.file.write(records[pos : pos + count].tobytes())
+                self.file.flush()
+
+                if segment.count == 0:
+                    segment.first_timestamp = float(records["timestamp"][pos])
+                segment.last_timestamp = float(records["timestamp"][pos + count - 1])
+                segment.count += count
+                pos += count
+            self.apply_retention()
+        finally:
+            self.lock.release()
+
+    def active_segment(self) -> Segment:
+        """Return the segment to write to, starting a new one if needed"""
+        if len(self.segments) > 0 and self.segments[-1].count < self.segment_records:
+            segment = self.segments[-1]
+            if self.file == None:
+                # continue the last segment of a previous run
+                self.file = open(segment.path, "ab")
+            return segment
+
+        if self.file != None:
+            self.file.close()
+        first_id = self.next_id()
+        path = os.path.join(self.folder, f"{first_id:016d}{SEGMENT_SUFFIX}")
+        self.file = open(path, "ab")
+        self.segments.append(Segment(path, first_id, 0))
+        return self.segments[-1]
+
+    def apply_retention(self):
+        total = sum(segment.count for segment in self.segments) * self.dtype.itemsize
+        newest = self.segments[-1].last_timestamp
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            too_big = self.max_size != None and total > self.max_size
+            too_old = (
+                self.max_age != None
+                and oldest.last_timestamp != None
+                and newest - oldest.last_timestamp > self.max_age
+            )
+            if not too_big and not too_old:
+                break
+            self.segments.pop(0)
+            total -= oldest.count * self.dtype.itemsize
+            # a reader may still use the mapping, it is closed once it is released
+            oldest.map = None
+            os.remove(oldest.path)
+
+    def find_id(
+        self, segments: list[tuple[int, np.ndarray]], end: int, timestamp: float
+    ) -> int:
+        """
+        Id of the first message captured at or after timestamp, in a snapshot of the
+        segments (see read)
+        """
+        # the first segment whose last message is not too old
+        index = bisect.bisect_left(
+            [records["timestamp"][-1] for _, records in segments], timestamp
+        )
+        if index == len(segments):
+            return end
+        first_id, records = segments[index]
+        return first_id + int(
+            np.searchsorted(records["timestamp"], timestamp, side="left")
+        )
+
+    def map_records(self, segment: Segment) -> np.ndarray:
+        count = segment.count
+        if segment.map == None:
+            with open(segment.path, "rb") as f:
+                segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if count < self.segment_records:
+                # the active segment grows, it is mapped again at the next read
+                return np.frombuffer(segment_map, self.dtype, count)
+            segment.map = segment_map
+        return np.frombuffer(segment.map, self.dtype, count)
+
+    def read(
+        self,
+        from_id: int = None,
+        to_id: int = None,
+        since: float = None,
+        until: float = None,
+        limit: int = None,
+    ) -> tuple[int, np.ndarray]:
+        """
+        Copy the records with from_id <= id < to_id and since <= timestamp < until,
+        up to limit records. Returns the id of the first record and the records.
+        Only the list of the segments and their mappings is taken under the lock,
+        the records are searched and copied without it, so that long reads never
+        make the capture wait
+        """
+        self.lock.acquire()
+        try:
+            end = self.next_id()
+            segments = [
+                (segment.first_id, self.map_records(segment))
+                for segment in self.segments
+                if segment.count > 0
+            ]
+        finally:
+            self.lock.release()
+        return self.read_records(segments, end, from_id, to_id, since, until, limit)
+
+    def read_records(
+        self,
+        segments: list[tuple[int, np.ndarray]],
+        end: int,
+        from_id: int,
+        to_id: int,
+        since: float,
+        until: float,
+        limit: int,
+    ) -> tuple[int, np.ndarray]:
+        """
+        segments are (id of the first record, mapped records) of the non-empty
+        segments, and end the id of the next record
+        """
+        if len(segments) == 0:
+            return end, np.empty(0, self.dtype)
+
+        start = segments[0][0]
+        if from_id != None:
+            start = max(start, from_id)
+        if since != None:
+            start = max(start, self.find_id(segments, end, since))
+        if to_id != None:
+            end = min(end, to_id)
+        if until != None:
+            end = min(end, self.find_id(segments, end, until))
+        if limit != None:
+            end = min(end, start + limit)
+        if start >= end:
+            return start, np.empty(0, self.dtype)
+
+        chunks = []
+        index = bisect.bisect_right([first_id for first_id, _ in segments], start)
+        for first_id, records in segments[max(index - 1, 0) :]:
+            if first_id >= end:
+                break
+            first = max(start, first_id) - first_id
+            last = min(end, first_id + len(records)) - first_id
+            chunks.append(np.array(records[first:last]))
+        return start, np.concatenate(chunks)
+
+    def get_messages(self, **kwargs) -> list:
+        """Same as read, but returns (id, message, timestamp) tuples"""
+        start, records = self.read(**kwargs)
+        parser = self.slate.message_parser
+        data = records["data"].tobytes()
+        messages = map(parser.message_class._make, parser.struct.iter_unpack(data))
+        timestamps = records["timestamp"].tolist()
+        return list(zip(range(start, start + len(records)), messages, timestamps))
+
+    def get_columns(self, **kwargs) -> tuple[int, dict[str, np.ndarray], list[float]]:
+        """
+        Same as read, but returns the id of the first message, one array per field
+        and the timestamps
+        """
+        start, records = self.read(**kwargs)
+        messages = self.slate.message_parser.parse_buffer(records["data"].tobytes())
+        columns = {name: messages[name] for name in messages.dtype.names}
+        return start, columns, records["timestamp"].tolist()
+
+    def close(self):
+        self.lock.acquire()
+        if self.file != None:
+            self.file.close()
+            self.file = None
+        for segment in self.segments:
+            if segment.map != None:
+                segment.map.close()
+                segment.map = None
+        self.lock.release()
+
+
+class CaptureLog:
+    """One ServiceLog for each slate, in folder/<service name>"""
+
+    def __init__(
+        self,
+        folder: str,
+        slates: list[Slate],
+        segment_size: int = SEGMENT_SIZE,
+        max_size: int = None,
+        max_age: float = None,
+    ):
+        self.logs = {
+            slate.service.name: ServiceLog(
+                os.path.join(folder, slate.service.name),
+                slate,
+                segment_size,
+                max_size,
+                max_age,
+            )
+            for slate in slates
+        }
+
+    def handle_raw(self, name: str, data: bytes, timestamps: list[float]):
+        log = self.logs.get(name)
+        if log == None:
+            raise Exception(f"Invalid slate name: {name}")
+        log.append(data, timestamps)
+
+    def get_messages(self, name: str, **kwargs) -> list | None:
+        log = self.logs.get(name)
+        if log == None:
+            return None
+        return log.get_messages(**kwargs)
+
+    def get_columns(self, name: str, **kwargs) -> tuple | None:
+        log = self.logs.get(name)
+        if log == None:
+            return None
+        return log.get_columns(**kwargs)
+
+    def close(self):
+        for log in self.logs.values():
+            log.close()
@@ -0,0 +1,104 @@
+# Copyright 2023 Quarkslab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+from typing import Any, Callable
+from .slate import SlateMessageParser
+
+
+class SlateFilter:
+    """
+    Selects raw slate messages by looking only at a few of their fields.
+
+    where maps field names to a value, a list of accepted values or a predicate,
+    changes is a list of fields and only keeps the messages where at least one of
+    them differs from the previous accepted message.
+    The fields are unpacked by a struct compiled for this filter, which skips the
+    other fields with pad bytes, so rejected messages are never fully decoded
+    """
+
+    def __init__(
+        self,
+        parser: SlateMessageParser,
+        where: dict[str, Any] = None,
+        changes: list[str] = None,
+    ):
+        self.where = dict() if where == None else where
+        self.changes = [] if changes == None else changes
+
+        # Dictionary: field name -> (offset, param), names use the namedtuple
+        # spelling but the original names are also accepted
+        layout = dict()
+        offset = 0
+        for name, param in zip(parser.message_class._fields, parser.params):
+            layout[name] = (offset, param)
+            layout[param.name] = (offset, param)
+            offset += param.dtype.size()
+
+        names = list(self.where.keys()) + [
+            name for name in self.changes if name not in self.where
+        ]
+        for name in names:
+            if name not in layout:
+                raise Exception(f"Invalid field for slate {parser.name}: {name}")
+
+        # sort the fields by offset and fill the gaps with pad bytes
+        fields = sorted(set(names), key=lambda name: layout[name][0])
+        fmt = ">"
+        position = 0
+        for name in fields:
+            offset, param = layout[name]
+            if offset > position:
+                fmt += f"{offset - position}x"
+            fmt += param.get_struct_letter()
+            position = offset + param.dtype.size()
+        self.struct = struct.Struct(fmt)
+
+        index = {name: i for i, name in enumerate(fields)}
+        self.conditions: list[tuple[int, Callable[[Any], bool]]] = [
+            (index[name], compile_condition(value))
+            for name, value in self.where.items()
+        ]
+        self.watched = [index[name] for name in self.changes]
+        self.previous = None
+
+    def accept(self, message: bytes) -> bool:
+        values = self.struct.unpack_from(message)
+        for i, condition in self.conditions:
+            if not condition(values[i]):
+                return False
+
+        if len(self.watched) > 0:
+            current = tuple(values[i] for i in self.watched)
+            if current == self.previous:
+                return False
+            self.previous = current
+        return True
+
+    def to_dict(self) -> dict:
+        return {
+            "where": {
+                name: value for name, value in self.where.items() if not callable(value)
+            },
+            "changes": self.changes,
+        }
+
+
+def compile_condition(value) -> Callable[[Any], bool]:
+    if callable(value):
+        return value
+    elif isinstance(value, (list, tuple, set)):
+        return set(value).__contains__
+    else:
+        return lambda x: x == value
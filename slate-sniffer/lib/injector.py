@@ -13,13 +13,61 @@
 # limitations under the License.
 
 import socket
-from time import sleep
-from typing import Self, List
+import time
+from typing import Callable, Iterable, Self, List
 from hexdump import hexdump
 from .slate import Slate
 from .service import Service
 from .config import *
 from .tunnel import TcpInjectorTunnel
+from .tunnel_pool import TunnelPool, TUNNEL_IDLE_TIMEOUT
+from . import config
+
+
+# Number of messages packed in the buffer of a batch and sent together, when they
+# are sent as fast as possible
+BATCH_CHUNK_SIZE = 256
+# A batch is aborted after this number of failed sends
+MAX_SEND_ERRORS = 10
+# Number of errors whose message is kept in a BatchReport
+MAX_REPORTED_ERRORS = 100
+
+
+class BatchReport:
+    """Progress of Injector.send_batch, updated while the messages are sent"""
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.send_errors = 0
+        # list of (index of the message, error)
+        self.errors: list[tuple[int, str]] = []
+        # maximum delay between the time a message was due and the time it was sent
+        self.max_delay = 0.0
+        self.started = None
+        self.finished = None
+
+    def error(self, index: int, error: Exception, count: int = 1):
+        self.failed += count
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((index, str(error)))
+
+    def duration(self) -> float:
+        if self.started == None:
+            return 0.0
+        end = self.finished if self.finished != None else time.monotonic()
+        return end - self.started
+
+    def to_dict(self) -> dict:
+        duration = self.duration()
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "errors": self.errors,
+            "duration": duration,
+            "rate": self.sent / duration if duration > 0 else None,
+            "max_delay": self.max_delay,
+        }
 
 
 class InjectorSocket:
@@ -38,6 +86,15 @@ class InjectorSocket:
         self.sock.shutdown(socket.SHUT_RDWR)
         self.sock.close()
 
+    def is_alive(self) -> bool:
+        """The other end did not close the connection"""
+        try:
+            return self.sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) != b""
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
 
 class Injector:
     def __init__(
@@ -48,21 +105,42 @@ class Injector:
         port=SSH_PORT,
         user=SSH_USER,
         proxy_port=PROXY_PORT,
+        idle_timeout=TUNNEL_IDLE_TIMEOUT,
+        relay: bool = False,
     ):
+        """
+        Messages are sent through a pool of tunnels, one for each service, which
+        are closed after idle_timeout seconds without messages. With relay, the
+        tunnels run lib/injector_relay.py on the target instead of socat, so that
+        they keep a single connection open (see TcpInjectorTunnel)
+        """
         self.host = host
         self.password = password
         self.port = port
         self.user = user
         self.proxy_port = proxy_port
+        self.relay = relay
 
         # Dictionary: service name -> slate
         self.slates = {s.service.name: s for s in slates}
+        self.pool = TunnelPool(
+            self.open_pooled_tunnel, self.open_tcp_socket, idle_timeout
+        )
 
     def open_tunnel(self, port: int):
         return TcpInjectorTunnel(
             port, self.host, self.port, self.password, self.user, self.proxy_port
         )
 
+    def open_pooled_tunnel(self, port: int):
+        """
+        Pooled tunnels are open at the same time, they are bound to free local
+        ports instead of proxy_port
+        """
+        return TcpInjectorTunnel(
+            port, self.host, self.port, self.password, self.user, 0, self.relay
+        )
+
     def open_tcp_socket(self, port: int):
         return InjectorSocket(port)
 
@@ -79,20 +157,109 @@ class Injector:
             # if verbose:
             # hexdump(message)
 
-            with self.open_tunnel(slate.service.port) as tunnel:
-                with self.open_tcp_socket(int(tunnel.tunnel.local_bind_port)) as socket:
-                    socket.sock.sendall(message)
-                    sleep(1)
-                    print(f"Message sent")
+            self.pool.send(slate.service.port, [message])
+            if config.verbose == True:
+                print(f"Message sent")
         else:
             raise Exception(f'Service "{service_name}" not valid')
 
+    def send_batch(
+        self,
+        service_name: str,
+        messages: Iterable[tuple],
+        timestamps: Iterable[float] = None,
+        speed: float = 1.0,
+        report: BatchReport = None,
+        should_stop: Callable[[], bool] = lambda: False,
+    ) -> BatchReport:
+        """
+        Send a sequence of messages, which can be a generator, on the warm tunnel of
+        the service.
+
+        With timestamps (e.g. capture timestamps, only their differences matter),
+        every message is sent at its own time, the cadence being multiplied by
+        speed. Without them, or if speed is 0, the messages are packed by chunks in
+        a preallocated buffer and sent as fast as possible. Messages that cannot be
+        packed are skipped, and the batch is aborted after MAX_SEND_ERRORS failed
+        sends
+        """
+        slate = self.slates.get(service_name)
+        if slate == None:
+            raise Exception(f'Service "{service_name}" not valid')
+        parser = slate.message_parser
+        port = slate.service.port
+        size = parser.struct.size
+        timed = timestamps != None and speed != None and speed > 0
+        chunk_size = 1 if timed else BATCH_CHUNK_SIZE
+        buffer = bytearray(size * chunk_size)
+        view = memoryview(buffer)
+        report = BatchReport() if report == None else report
+        report.started = time.monotonic()
+
+        count = 0
+        first = None
+
+        def flush(index: int) -> bool:
+            """Send the packed messages, returns False if the batch was stopped"""
+            nonlocal count
+            # the batch can be stopped while the messages are packed or waited for
+            if should_stop():
+                return False
+            try:
+                chunk = [view[i * size : (i + 1) * size] for i in range(count)]
+                self.pool.send(port, chunk)
+                report.sent += count
+            except Exception as e:
+                report.send_errors += 1
+                report.error(index - count + 1, e, count)
+                if report.send_errors >= MAX_SEND_ERRORS:
+                    raise Exception(f"Too many send errors, last one: {e}")
+            count = 0
+            return True
+
+        if timed:
+            items = zip(messages, timestamps)
+        else:
+            items = ((message, None) for message in messages)
+        try:
+            for index, (message, timestamp) in enumerate(items):
+                if should_stop():
+                    break
+                try:
+                    parser.pack_into(buffer, count * size, message)
+                except Exception as e:
+                    report.error(index, e)
+                    continue
+                count += 1
+
+                if timed:
+                    if first == None:
+                        first = (time.monotonic(), timestamp)
+                    due = first[0] + (timestamp - first[1]) / speed
+                    delay = due - time.monotonic()
+                    report.max_delay = max(report.max_delay, -delay)
+                    # long waits are split to notice should_stop
+                    while delay > 0 and not should_stop():
+                        time.sleep(min(delay, 0.5))
+                        delay = due - time.monotonic()
+                if count == chunk_size and not flush(index):
+                    break
+            if count > 0:
+                flush(index)
+        finally:
+            report.finished = time.monotonic()
+        return report
+
+    def close(self):
+        """Close the tunnels of the pool"""
+        self.pool.close()
+
 
 def main():
     from binascii import unhexlify
 
     services = Service.parse("./config/service_directory.json")
-    slates = list(map(Slate.from_service, services))
+    slates = Slate.from_services(services)
     assert len(services) == len(slates)
     injector = Injector(slates)
 
@@ -143,6 +310,7 @@ def main():
         0,
     )
     injector.send_message("frontend_to_control", message)
+    injector.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,62 @@
+# Copyright 2023 Quarkslab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This script runs on the dish (with micropython or python 3), it receives the
+# injected messages through the SSH tunnel and sends each of them as a datagram.
+# Every message is preceded by its size (2 bytes, big-endian), so that messages
+# sent back to back on the same connection are never merged or split
+
+import socket
+import sys
+
+HEADER_SIZE = 2
+
+
+def recv_exactly(conn, size: int) -> bytes:
+    """Read size bytes, None if the connection is closed before"""
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def main(port: int, udp_port: int):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind(("127.0.0.1", port))
+    s.listen(1)
+    out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # same message as socat, see TcpInjectorTunnel
+    print(f"listening on {port}")
+    while True:
+        conn, _ = s.accept()
+        try:
+            while True:
+                header = recv_exactly(conn, HEADER_SIZE)
+                if header == None:
+                    break
+                message = recv_exactly(conn, int.from_bytes(header, "big"))
+                if message == None:
+                    # the end of an interrupted message is never sent
+                    break
+                out.sendto(message, ("127.0.0.1", udp_port))
+        finally:
+            conn.close()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]), int(sys.argv[2]))
@@ -0,0 +1,255 @@
+# Copyright 2023 Quarkslab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+import sys
+from typing import Callable, Iterator
+
+PCAP_MAGIC = 0xA1B2C3D4
+PCAP_MAGIC_NSEC = 0xA1B23C4D
+PCAPNG_BLOCK_SHB = 0x0A0D0D0A
+PCAPNG_BLOCK_IDB = 0x00000001
+PCAPNG_BLOCK_SPB = 0x00000003
+PCAPNG_BLOCK_EPB = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+PCAPNG_OPTION_END = 0
+PCAPNG_OPTION_TSRESOL = 9
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_VLAN = 0x8100
+AF_INET = 2
+IPPROTO_UDP = 17
+
+UDP_HEADER_SIZE = 8
+
+
+class PcapError(Exception):
+    pass
+
+
+class PcapReader:
+    """
+    Minimal pcap/pcapng reader that only extracts IPv4 UDP datagrams.
+
+    Packets are sliced directly from a memoryview over a large read buffer, and are
+    yielded as (timestamp, source, destination port, payload) tuples, the source
+    being an (IPv4 address, port) tuple. The payload is a memoryview that references
+    the whole read buffer, use bytes(payload) to keep it around.
+
+    read is a function returning at most n bytes (and b"" at the end of the stream),
+    such as the recv method of a paramiko channel or the read1 method of a file.
+    Packets that cannot be parsed are skipped and counted in self.malformed, only
+    errors in the structure of the stream end the iteration
+    """
+
+    def __init__(self, read: Callable[[int], bytes], buffer_size: int = 1024 * 1024):
+        self.read = read
+        self.buffer_size = buffer_size
+        self.buffer = memoryview(b"")
+        self.pos = 0
+        self.malformed = 0
+
+        # (linktype, timestamp resolution) of every pcapng interface (a single one
+        # for pcap)
+        self.interfaces: list[tuple[int, float]] = []
+
+    def from_file(file) -> "PcapReader":
+        return PcapReader(file.read1 if hasattr(file, "read1") else file.read)
+
+    def fill(self, size: int) -> bool:
+        """Make sure size bytes can be parsed, returns False at the end of the stream"""
+        while len(self.buffer) - self.pos < size:
+            data = self.read(max(self.buffer_size, size))
+            if len(data) == 0:
+                return False
+            # only the unread part of the buffer is copied, views on the previous
+            # buffer are left untouched
+            self.buffer = memoryview(bytes(self.buffer[self.pos :]) + data)
+            self.pos = 0
+        return True
+
+    def __iter__(self) -> Iterator[tuple[float, tuple[int, int], int, memoryview]]:
+        if not self.fill(4):
+            return
+        magic = self.buffer[self.pos : self.pos + 4]
+        if int.from_bytes(magic, "little") == PCAPNG_BLOCK_SHB:
+            frames = self.pcapng_frames()
+        else:
+            frames = self.pcap_frames()
+
+        for linktype, timestamp, frame in frames:
+            try:
+                datagram = parse_udp(linktype, frame)
+            except Exception as e:
+                self.skip(e)
+                continue
+            if datagram != None:
+                yield (timestamp,) + datagram
+
+    def skip(self, error: Exception):
+        print(f"Malformed packet: {error}", file=sys.stderr)
+        self.malformed += 1
+
+    def pcap_frames(self) -> Iterator[tuple[int, float, memoryview]]:
+        if not self.fill(24):
+            raise PcapError("Truncated pcap header")
+        header = self.buffer[self.pos : self.pos + 24]
+        for endian in "<>":
+            magic = struct.unpack_from(f"{endian}I", header)[0]
+            if magic in (PCAP_MAGIC, PCAP_MAGIC_NSEC):
+                break
+        else:
+            raise PcapError(f"Invalid pcap magic: {bytes(header[:4]).hex()}")
+        resolution = 1e-9 if magic == PCAP_MAGIC_NSEC else 1e-6
+        linktype = struct.unpack_from(f"{endian}I", header, 20)[0] & 0xFFFF
+        self.interfaces = [(linktype, resolution)]
+        self.pos += 24
+
+        record_header = struct.Struct(f"{endian}IIII")
+        while self.fill(16):
+            seconds, fraction, incl_len, _ = record_header.unpack_from(
+                self.buffer, self.pos
+            )
+            if not self.fill(16 + incl_len):
+                return
+            start = self.pos + 16
+            self.pos = start + incl_len
+            timestamp = seconds + fraction * resolution
+            yield linktype, timestamp, self.buffer[start : self.pos]
+
+    def pcapng_frames(self) -> Iterator[tuple[int, float, memoryview]]:
+        endian = "<"
+        while self.fill(12):
+            block_type, block_len = struct.unpack_from(
+                f"{endian}II", self.buffer, self.pos
+            )
+
+            if block_type == PCAPNG_BLOCK_SHB:
+                # the byte order can change with every section
+                order = struct.unpack_from("<I", self.buffer, self.pos + 8)[0]
+                endian = "<" if order == PCAPNG_BYTE_ORDER_MAGIC else ">"
+                block_len = struct.unpack_from(
+                    f"{endian}I", self.buffer, self.pos + 4
+                )[0]
+                self.interfaces = []
+
+            if block_len < 12 or not self.fill(block_len):
+                return
+            block = self.buffer[self.pos : self.pos + block_len]
+            self.pos += block_len
+
+            if block_type == PCAPNG_BLOCK_IDB:
+                linktype = struct.unpack_from(f"{endian}H", block, 8)[0]
+                resolution = pcapng_resolution(block, endian)
+                self.interfaces.append((linktype, resolution))
+            elif block_type == PCAPNG_BLOCK_EPB:
+                interface, high, low, captured = struct.unpack_from(
+                    f"{endian}IIII", block, 8
+                )
+                if interface >= len(self.interfaces):
+                    self.skip(PcapError(f"Unknown interface: {interface}"))
+                    continue
+                linktype, resolution = self.interfaces[interface]
+                timestamp = ((high << 32) | low) * resolution
+                yield linktype, timestamp, block[28 : 28 + captured]
+            elif block_type == PCAPNG_BLOCK_SPB:
+                # simple packets have no timestamp
+                if len(self.interfaces) == 0:
+                    self.skip(PcapError("Simple packet without interface"))
+                    continue
+                yield self.interfaces[0][0], 0.0, block[12 : block_len - 4]
+
+
+def pcapng_resolution(block: memoryview, endian: str) -> float:
+    """Timestamp resolution in seconds, from the if_tsresol option of an IDB"""
+    pos = 16
+    while pos + 4 <= len(block) - 4:
+        code, length = struct.unpack_from(f"{endian}HH", block, pos)
+        if code == PCAPNG_OPTION_END:
+            break
+        if code == PCAPNG_OPTION_TSRESOL and length >= 1:
+            value = block[pos + 4]
+            if value & 0x80:
+                return 2.0 ** -(value & 0x7F)
+            return 10.0**-value
+        # option values are padded to 32 bits
+        pos += 4 + (length + 3) // 4 * 4
+    return 1e-6
+
+
+def parse_udp(
+    linktype: int, frame: memoryview
+) -> tuple[tuple[int, int], int, memoryview] | None:
+    """
+    Return ((source address, source port), destination port, payload) if the frame
+    contains an IPv4 UDP datagram, None otherwise (other protocols and IP fragments
+    are ignored)
+    """
+    if linktype == LINKTYPE_ETHERNET:
+        ethertype = int.from_bytes(frame[12:14], "big")
+        offset = 14
+        if ethertype == ETHERTYPE_VLAN:
+            ethertype = int.from_bytes(frame[16:18], "big")
+            offset = 18
+        if ethertype != ETHERTYPE_IPV4:
+            return None
+    elif linktype == LINKTYPE_NULL or linktype == LINKTYPE_LOOP:
+        # host byte order for NULL, network byte order for LOOP
+        family = frame[0:4]
+        if AF_INET not in (
+            int.from_bytes(family, "little"),
+            int.from_bytes(family, "big"),
+        ):
+            return None
+        offset = 4
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if int.from_bytes(frame[14:16], "big") != ETHERTYPE_IPV4:
+            return None
+        offset = 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        if int.from_bytes(frame[0:2], "big") != ETHERTYPE_IPV4:
+            return None
+        offset = 20
+    elif linktype == LINKTYPE_RAW or linktype == LINKTYPE_IPV4:
+        offset = 0
+    else:
+        raise PcapError(f"Unsupported linktype: {linktype}")
+
+    if len(frame) < offset + 20:
+        return None
+    version_ihl = frame[offset]
+    if version_ihl >> 4 != 4 or frame[offset + 9] != IPPROTO_UDP:
+        return None
+    # more fragments flag or fragment offset set
+    if int.from_bytes(frame[offset + 6 : offset + 8], "big") & 0x3FFF:
+        return None
+
+    ip_len = int.from_bytes(frame[offset + 2 : offset + 4], "big")
+    ip_end = min(len(frame), offset + ip_len)
+    udp = offset + (version_ihl & 0x0F) * 4
+    if ip_end < udp + UDP_HEADER_SIZE:
+        return None
+    address = int.from_bytes(frame[offset + 12 : offset + 16], "big")
+    sport, dport, udp_len = struct.unpack_from(">HHH", frame, udp)
+    udp_end = min(ip_end, udp + udp_len)
+
+    return (address, sport), dport, frame[udp + UDP_HEADER_SIZE : udp_end]
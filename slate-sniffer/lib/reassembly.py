@@ -0,0 +1,135 @@
+# Copyright 2023 Quarkslab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+from .slate import Slate
+
+# Partial messages older than this (in seconds of capture time) are dropped
+REASSEMBLY_TIMEOUT = 1.0
+# Maximum size of all the partial messages, the oldest ones are dropped first
+REASSEMBLY_MAX_MEMORY = 16 * 1024 * 1024
+
+
+class PartialMessage:
+    __slots__ = ("data", "filled", "fragments", "timestamp")
+
+    def __init__(self, size: int, timestamp: float):
+        self.data = bytearray(size)
+        self.filled = 0
+        self.fragments = 0
+        self.timestamp = timestamp
+
+    def append(self, fragment: memoryview) -> bool:
+        """Copy a fragment at the end of the message, returns True once it is full"""
+        count = min(len(fragment), len(self.data) - self.filled)
+        self.data[self.filled : self.filled + count] = fragment[:count]
+        self.filled += count
+        self.fragments += 1
+        return self.filled == len(self.data)
+
+
+class Reassembler:
+    """
+    Rebuilds slate messages that were sent in several UDP datagrams.
+
+    Every fragment repeats the message header, so partial messages are keyed by
+    (source, destination port, Seq): interleaved senders and messages never mix.
+    Partial messages are preallocated with the size of the slate, expire after
+    timeout seconds and are evicted (oldest first) when they use more than
+    max_memory bytes
+    """
+
+    def __init__(
+        self,
+        timeout: float = REASSEMBLY_TIMEOUT,
+        max_memory: int = REASSEMBLY_MAX_MEMORY,
+    ):
+        self.timeout = timeout
+        self.max_memory = max_memory
+        self.memory = 0
+
+        # Dictionary: (source, port, Seq) -> PartialMessage, oldest first
+        self.pending: OrderedDict[tuple, PartialMessage] = OrderedDict()
+
+        self.completed = 0
+        self.expired = 0
+        self.evicted = 0
+        self.dropped_fragments = 0
+
+    def push(
+        self, slate: Slate, timestamp: float, src: tuple, payload: memoryview
+    ) -> bytes | bytearray | memoryview | None:
+        """
+        Handle a datagram received for a slate, returns the complete message if
+        there is one, None otherwise
+        """
+        self.expire(timestamp)
+
+        parser = slate.message_parser
+        size = parser.struct.size
+        header_size = parser.header_struct.size
+        if len(payload) >= size:
+            return payload
+        if len(payload) < header_size:
+            self.dropped_fragments += 1
+            return None
+
+        seq = parser.header_struct.unpack_from(payload)[2]
+        key = (src, slate.service.port, seq)
+        partial = self.pending.get(key)
+        if partial == None:
+            self.evict(size)
+            partial = PartialMessage(size, timestamp)
+            self.pending[key] = partial
+            self.memory += size
+            done = partial.append(payload)
+        else:
+            # only the first fragment keeps its header
+            done = partial.append(payload[header_size:])
+
+        if not done:
+            return None
+        del self.pending[key]
+        self.memory -= size
+        self.completed += 1
+        return partial.data
+
+    def expire(self, timestamp: float):
+        while len(self.pending) > 0:
+            key, partial = next(iter(self.pending.items()))
+            if timestamp - partial.timestamp <= self.timeout:
+                break
+            self.drop(key)
+            self.expired += 1
+
+    def evict(self, size: int):
+        """Make room for a new partial message of the given size"""
+        while len(self.pending) > 0 and self.memory + size > self.max_memory:
+            self.drop(next(iter(self.pending)))
+            self.evicted += 1
+
+    def drop(self, key: tuple):
+        partial = self.pending.pop(key)
+        self.memory -= len(partial.data)
+        self.dropped_fragments += partial.fragments
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self.pending),
+            "memory": self.memory,
+            "completed": self.completed,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "dropped_fragments": self.dropped_fragments,
+        }
@@ -0,0 +1,135 @@
+# Copyright 2023 Quarkslab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import hashlib
+import json
+import numpy as np
+from .slate import SlateMessageParser
+
+# msgpack and zstandard are optional, the corresponding formats are only offered
+# when they are installed
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# [[id, [values...]], ...], what the web interface uses
+JSON = "application/json"
+# {"first_id": id, "count": n, "fields": {name: [values...]}}
+COLUMNS_JSON = "application/vnd.slate.columns+json"
+# same object as COLUMNS_JSON, in MessagePack
+MSGPACK = "application/msgpack"
+# the messages as they were captured, one after the other, see /schema
+RAW = "application/octet-stream"
+
+# Smaller responses are not worth compressing
+COMPRESS_MIN_SIZE = 1024
+GZIP_LEVEL = 5
+ZSTD_LEVEL = 3
+
+json_encoder = json.JSONEncoder(separators=(",", ":"), default=lambda o: o.__dict__)
+
+
+def formats() -> list[str]:
+    """Available message formats, the first one is the default"""
+    result = [JSON, COLUMNS_JSON]
+    if msgpack != None:
+        result.append(MSGPACK)
+    result.append(RAW)
+    return result
+
+
+def encodings() -> list[str]:
+    """Available content encodings, by order of preference"""
+    return ["zstd", "gzip"] if zstandard != None else ["gzip"]
+
+
+def encode_json(value) -> bytes:
+    return json_encoder.encode(value).encode()
+
+
+def encode_columns(
+    first_id: int,
+    columns: dict[str, np.ndarray | list],
+    fmt: str,
+    parser: SlateMessageParser,
+    timestamps: list[float] = None,
+) -> bytes:
+    """
+    Serialize consecutive messages given as one array or list per field, such as
+    returned by the get_columns methods of the stores and logs, in one of the formats
+    """
+    if fmt == RAW:
+        return encode_records(columns, parser)
+
+    count = len(next(iter(columns.values()))) if len(columns) > 0 else 0
+    if fmt == JSON:
+        # the rows are built from the columns, which is faster than namedtuples
+        rows = zip(*map(to_list, columns.values()))
+        if timestamps != None:
+            rows = zip(range(first_id, first_id + count), rows, timestamps)
+        else:
+            rows = zip(range(first_id, first_id + count), rows)
+        return encode_json(list(rows))
+
+    result = {
+        "first_id": first_id,
+        "count": count,
+        "fields": {name: to_list(column) for name, column in columns.items()},
+    }
+    if timestamps != None:
+        result["timestamps"] = timestamps
+    if fmt == MSGPACK:
+        return msgpack.packb(result)
+    return encode_json(result)
+
+
+def encode_records(columns: dict, parser: SlateMessageParser) -> bytes:
+    """Pack the columns in the big-endian layout of the captured messages"""
+    count = len(next(iter(columns.values()))) if len(columns) > 0 else 0
+    records = np.empty(count, parser.dtype)
+    for name, column in columns.items():
+        records[name] = column
+    return records.tobytes()
+
+
+def to_list(column: np.ndarray | list | tuple) -> list:
+    if isinstance(column, np.ndarray):
+        return column.tolist()
+    return list(column)
+
+
+def choose_encoding(accepted) -> str | None:
+    """Preferred content encoding among the accepted ones, None if there is none"""
+    for encoding in encodings():
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+def compress(data: bytes, encoding: str | None) -> bytes:
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    elif encoding == "gzip":
+        return gzip.compress(data, GZIP_LEVEL, mtime=0)
+    return data
+
+
+def etag(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
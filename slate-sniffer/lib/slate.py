@@ -13,13 +13,16 @@
 # limitations under the License.
 
 import ctypes
-from typing import Self
+from typing import Self, Iterable
 from enum import Enum
 import sys
 import struct
 import os
+import json
+import tempfile
 from collections import namedtuple
 import hexdump
+import numpy as np
 from .service import Service
 from .parse import remove_comments_and_empty_lines
 from . import config
@@ -55,6 +58,17 @@ class DType(Enum):
         elif self.name == "INT64" or self.name == "UINT64" or self.name == "DOUBLE":
             return 8
 
+    def numpy_type(self) -> str:
+        """Big-endian NumPy type with the same size as the struct letter"""
+        if self.name == "FLOAT":
+            return ">f4"
+        elif self.name == "DOUBLE":
+            return ">f8"
+        elif self.name == "BOOL" or self.name.startswith("U"):
+            return f">u{self.size()}"
+        else:
+            return f">i{self.size()}"
+
 
 class Param:
     def __init__(self, name: str, dtype: DType):
@@ -100,6 +114,15 @@ class SlateMessageParser:
             name, " ".join(map(lambda p: p.name, self.params)).replace(".", "_")
         )
         self.struct = struct.Struct(self.generate_struct_string())
+        self.header_struct = struct.Struct(
+            ">" + "".join(map(Param.get_struct_letter, self.header))
+        )
+        self.dtype = np.dtype(
+            [
+                (name, param.dtype.numpy_type())
+                for name, param in zip(self.message_class._fields, self.params)
+            ]
+        )
 
         if config.verbose == True:
             print(
@@ -124,9 +147,34 @@ class SlateMessageParser:
 
         return self.message_class._make(self.struct.unpack(message[: self.struct.size]))
 
+    def parse_buffer(self, data: bytes) -> np.recarray:
+        """
+        Decode a buffer of messages stored one after the other, without any copy.
+        The result has one column for each param, e.g. records.Seq is the array of
+        all the sequence numbers
+        """
+        count = len(data) // self.struct.size
+        return np.frombuffer(data, dtype=self.dtype, count=count).view(np.recarray)
+
+    def parse_batch(self, messages: Iterable[bytes]) -> np.recarray:
+        """Decode many messages at once, see parse_buffer"""
+        size = self.struct.size
+        data = bytearray()
+        for message in messages:
+            if len(message) < size:
+                raise Exception(
+                    f"Received data is too short for slate {self.name}: {len(message)} < {size}"
+                )
+            data += message[:size]
+        return self.parse_buffer(data)
+
     def pack(self, message: tuple) -> bytes:
         return self.struct.pack(*message)
 
+    def pack_into(self, buffer: bytearray, offset: int, message: tuple):
+        """Same as pack, but the message is written in buffer at offset"""
+        self.struct.pack_into(buffer, offset, *message)
+
 
 class Slate:
     def __init__(self, service: Service, params: list[Param]):
@@ -139,37 +187,155 @@ class Slate:
     def parse_message(self, message: bytes) -> tuple:
         return self.message_parser.parse(message)
 
+    def parse_messages(self, messages: Iterable[bytes]) -> np.recarray:
+        return self.message_parser.parse_batch(messages)
+
     def pack_message(self, message: tuple) -> bytes:
         return self.message_parser.pack(message)
 
     def parse_config(name: str, path: str) -> list[Param]:
-        file_path = os.path.join(path, name)
+        return SchemaCompiler(path, cache_file=None).compile(name)
+
+    def from_service(service: Service, compiler: "SchemaCompiler" = None):
+        if compiler == None:
+            compiler = SchemaCompiler()
+            params = compiler.compile(service.name)
+            compiler.save_cache()
+        else:
+            params = compiler.compile(service.name)
+        return Slate(service, params)
+
+    def from_services(services: list[Service]) -> list[Self]:
+        """Same as from_service, but the includes are parsed once for all the slates"""
+        compiler = SchemaCompiler()
+        slates = [Slate.from_service(service, compiler) for service in services]
+        compiler.save_cache()
+        return slates
+
+
+def file_mtime(path: str) -> int | None:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class SchemaCompiler:
+    """
+    Resolves slate definitions and their %include directives. Every file is parsed
+    only once (memoized by path and mtime), even if it is included by many slates,
+    and the resolved param lists are saved in cache_file with the mtimes of all the
+    files they depend on, so that they are not parsed at all in the next runs
+    """
+
+    def __init__(
+        self,
+        path: str = "./config/data_format/",
+        cache_file: str | None = "./config/schema_cache.json",
+    ):
+        self.path = path
+        self.cache_file = cache_file
+        self.cache = self.load_cache()
+        self.cache_changed = False
+
+        # Dictionary: file path -> (mtime, list of Param or included file path)
+        self.files = dict()
+        # Dictionary: file path -> (params, dictionary: dependency path -> mtime)
+        self.resolved = dict()
+
+    def load_cache(self) -> dict:
+        if self.cache_file == None or not os.path.isfile(self.cache_file):
+            return dict()
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(
+                f"Ignoring invalid schema cache {self.cache_file}: {e}",
+                file=sys.stderr,
+            )
+            return dict()
+
+    def save_cache(self):
+        if self.cache_file == None or not self.cache_changed:
+            return
+        # every process compiling schemas may save the cache at the same time, each
+        # one writes its own file and the last replaced one wins
+        fd, tmp_file = tempfile.mkstemp(
+            dir=os.path.dirname(self.cache_file) or ".", suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(json.dumps(self.cache))
+            os.replace(tmp_file, self.cache_file)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+        self.cache_changed = False
+
+    def parse_file(self, file_path: str) -> list:
+        mtime = file_mtime(file_path)
+        parsed = self.files.get(file_path)
+        if parsed != None and parsed[0] == mtime:
+            return parsed[1]
+
         with open(file_path) as f:
             content = f.readlines()
 
-        params: list[Param] = []
-
-        content = filter(remove_comments_and_empty_lines, content)
-
-        for line in content:
+        items = []
+        for line in filter(remove_comments_and_empty_lines, content):
             if line.startswith("%include"):
                 if config.verbose:
-                    print(f"Processing include directive in {name}: {line}")
+                    print(f"Processing include directive in {file_path}: {line}")
                 include = line.split(" ")[1].strip()
-                include_path = os.path.join(path, include)
-                if os.path.isfile(include_path):
-                    if config.verbose:
-                        print(f"Including {include_path} from {name}")
-                    params += Slate.parse_config(include, path)
+                items.append(os.path.join(self.path, include))
             else:
                 p = Param.from_str(line)
                 if p != None:
-                    params.append(p)
+                    items.append(p)
 
-        return params
+        self.files[file_path] = (mtime, items)
+        return items
 
-    def from_service(service: Service):
-        return Slate(service, Slate.parse_config(service.name, "./config/data_format/"))
+    def resolve(self, file_path: str) -> tuple[list[Param], dict]:
+        resolved = self.resolved.get(file_path)
+        if resolved != None:
+            return resolved
+
+        params: list[Param] = []
+        dependencies = {file_path: file_mtime(file_path)}
+        for item in self.parse_file(file_path):
+            if isinstance(item, Param):
+                params.append(item)
+            elif os.path.isfile(item):
+                if config.verbose:
+                    print(f"Including {item} from {file_path}")
+                include_params, include_dependencies = self.resolve(item)
+                params += include_params
+                dependencies.update(include_dependencies)
+            else:
+                # if the file is created later, the cache has to be invalidated
+                dependencies[item] = None
+
+        self.resolved[file_path] = (params, dependencies)
+        return params, dependencies
+
+    def compile(self, name: str) -> list[Param]:
+        file_path = os.path.join(self.path, name)
+
+        cached = self.cache.get(file_path)
+        if cached != None and all(
+            file_mtime(path) == mtime for path, mtime in cached["dependencies"].items()
+        ):
+            return [Param(n, DType[dtype]) for n, dtype in cached["params"]]
+
+        params, dependencies = self.resolve(file_path)
+        self.cache[file_path] = {
+            "dependencies": dependencies,
+            "params": [[p.name, p.dtype.name] for p in params],
+        }
+        self.cache_changed = True
+        return params
 
 
 def main():
@@ -12,16 +12,45 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from scapy.all import *
 import sys
 import paramiko
 import os
-from typing import Callable
+import queue
+import struct
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from threading import Thread
+from typing import Callable, Iterator, List
 import json
+from .pcap import PcapReader
+from .reassembly import Reassembler
+from .filter import SlateFilter
 from .slate import Slate
 from .service import Service
 from .config import *
 
+# Number of processes decoding the messages, 0 to decode them in a thread. Sending
+# a batch to a process and its tuples back costs about ten times more than
+# unpacking it with struct, so processes only pay off for much bigger messages
+DECODE_WORKERS = 0
+# Maximum number of batches waiting to be decoded
+QUEUE_SIZE = 256
+# Maximum number of messages in a batch, and maximum time to wait for a batch
+BATCH_SIZE = 64
+BATCH_INTERVAL = 0.05
+
+# Dictionary: struct format -> struct, cached by every decode worker
+decode_structs = dict()
+
+
+def decode_batch(fmt: str, data: bytes) -> list[tuple]:
+    """Decode a batch of messages stored one after the other"""
+    decoder = decode_structs.get(fmt)
+    if decoder == None:
+        decoder = struct.Struct(fmt)
+        decode_structs[fmt] = decoder
+    return list(decoder.iter_unpack(data))
+
 
 class Sniffer:
     def __init__(
@@ -32,15 +61,36 @@ class Sniffer:
         port=SSH_PORT,
         user=SSH_USER,
         iface=IFACE,
+        decode_workers=DECODE_WORKERS,
+        queue_size=QUEUE_SIZE,
+        batch_size=BATCH_SIZE,
+        executor: ProcessPoolExecutor = None,
     ):
+        """
+        executor is a process pool used to decode the messages instead of starting
+        decode_workers processes at every capture, e.g. to share it between the
+        sniffers of several dishes
+        """
         self.host = host
         self.password = password
         self.port = port
         self.user = user
         self.iface = iface
+        self.decode_workers = decode_workers
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.executor = executor
 
         # Dictionary: port number -> slate
         self.slates = {s.service.port: s for s in slates}
+        self.reassembler = Reassembler()
+        # Dictionary: port number -> SlateFilter
+        self.filters = dict()
+        self.decode_queue = queue.Queue(queue_size)
+        self.store_queue = queue.Queue()
+        # reader of the current capture
+        self.reader: PcapReader = None
+        self.reset_stats()
 
         # generate the command to be sent through SSH
         ports_string = " or ".join(str(s.service.port) for s in slates)
@@ -51,7 +101,15 @@ class Sniffer:
         self,
         handler: Callable[[str, tuple], None],
         should_stop: Callable[[], bool] = lambda: False,
+        batch_handler: Callable[[str, list], None] = None,
+        raw_handler: Callable[[str, bytes, list[float]], None] = None,
     ):
+        """
+        Sniff the slates on the dish, handler is called with every decoded message,
+        or batch_handler with lists of messages of the same slate if it is given.
+        raw_handler is also called with the raw messages of each batch, stored one
+        after the other, and their capture timestamps
+        """
         ssh = paramiko.SSHClient()
         ssh.load_system_host_keys()
 
@@ -66,53 +124,263 @@ class Sniffer:
         print(self.ssh_command)
 
         command = ssh.exec_command(self.ssh_command)
-        reader = PcapReader(command[1])
+        channel = command[1].channel
+        # wake up regularly to flush the batches and check should_stop, even when
+        # there is no traffic
+        channel.settimeout(BATCH_INTERVAL)
+        self.pipeline(channel.recv, handler, should_stop, batch_handler, raw_handler)
+
+        ssh.close()
+
+    def pipeline(
+        self,
+        recv: Callable[[int], bytes],
+        handler: Callable[[str, tuple], None],
+        should_stop: Callable[[], bool] = lambda: False,
+        batch_handler: Callable[[str, list], None] = None,
+        raw_handler: Callable[[str, bytes, list[float]], None] = None,
+    ):
+        """
+        Decode a pcap stream in three stages, so that a slow stage never stalls the
+        capture: the calling thread reads the stream, reassembles the messages and
+        groups them in batches, a pool of worker processes decodes the batches and a
+        store thread calls the handlers. Batches are dropped (and counted) when the
+        decode queue is full, instead of blocking the capture
+        """
+        self.reset_stats()
+        self.decode_queue = queue.Queue(self.queue_size)
+        self.store_queue = queue.Queue(max(self.decode_workers, 1) * 4)
+        executor = self.executor
+        if executor == None and self.decode_workers > 0:
+            executor = ProcessPoolExecutor(self.decode_workers)
+
+        threads = [
+            Thread(target=self.decode_loop, args=(executor,)),
+            Thread(
+                target=self.store_loop, args=(handler, batch_handler, raw_handler)
+            ),
+        ]
+        for thread in threads:
+            thread.start()
+
+        # Dictionary: port -> [slate, messages, number of messages, timestamps]
+        batches = dict()
+        last_flush = time.monotonic()
+
+        def flush():
+            nonlocal last_flush
+            for batch in batches.values():
+                self.submit(*batch)
+            batches.clear()
+            last_flush = time.monotonic()
+
+        def read(size: int) -> bytes:
+            while not should_stop():
+                try:
+                    data = recv(size)
+                except TimeoutError:
+                    flush()
+                    continue
+                self.captured_bytes += len(data)
+                return data
+            return b""
+
+        try:
+            messages = self.messages(PcapReader(read), should_stop)
+            for slate, data, timestamp in messages:
+                self.captured_messages += 1
+                port = slate.service.port
+                size = slate.message_parser.struct.size
+                batch = batches.get(port)
+                if batch == None:
+                    batch = [slate, bytearray(), 0, []]
+                    batches[port] = batch
+                batch[1] += data[:size]
+                batch[2] += 1
+                batch[3].append(timestamp)
+                if batch[2] >= self.batch_size:
+                    del batches[port]
+                    self.submit(*batch)
+
+                if time.monotonic() - last_flush > BATCH_INTERVAL:
+                    flush()
+        finally:
+            flush()
+            self.decode_queue.put(None)
+            for thread in threads:
+                thread.join()
+            if executor != None and executor != self.executor:
+                executor.shutdown()
+
+    def submit(self, slate: Slate, data: bytearray, count: int, timestamps: list):
+        try:
+            self.decode_queue.put_nowait((slate, bytes(data), timestamps))
+        except queue.Full:
+            self.dropped_messages += count
+
+    def decode_loop(self, executor: ProcessPoolExecutor | None):
+        while True:
+            item = self.decode_queue.get()
+            if item == None:
+                break
+            slate, data, timestamps = item
+            fmt = slate.message_parser.struct.format
+            if executor != None:
+                rows = executor.submit(decode_batch, fmt, data)
+            else:
+                rows = Future()
+                rows.set_result(decode_batch(fmt, data))
+            # blocks when the store is late, then the decode queue fills up
+            self.store_queue.put((slate, rows, data, timestamps))
+        self.store_queue.put(None)
+
+    def store_loop(
+        self,
+        handler: Callable[[str, tuple], None],
+        batch_handler: Callable[[str, list], None] = None,
+        raw_handler: Callable[[str, bytes, list[float]], None] = None,
+    ):
+        while True:
+            item = self.store_queue.get()
+            if item == None:
+                break
+            slate, rows, data, timestamps = item
+            if raw_handler != None:
+                try:
+                    raw_handler(slate.service.name, data, timestamps)
+                except Exception as e:
+                    print(e, file=sys.stderr)
+            try:
+                message_class = slate.message_parser.message_class
+                messages = list(map(message_class._make, rows.result()))
+                if batch_handler != None:
+                    batch_handler(slate.service.name, messages)
+                else:
+                    for message in messages:
+                        handler(slate.service.name, message)
+                self.stored_messages += len(messages)
+            except Exception as e:
+                print(e, file=sys.stderr)
+
+    def set_filter(
+        self, name: str, where: dict = None, changes: list[str] = None
+    ) -> SlateFilter:
+        """
+        Only keep the messages of a slate that match a SlateFilter, the others are
+        rejected before being decoded
+        """
+        slate = self.get_slate(name)
+        slate_filter = SlateFilter(slate.message_parser, where, changes)
+        self.filters[slate.service.port] = slate_filter
+        return slate_filter
+
+    def clear_filter(self, name: str):
+        self.filters.pop(self.get_slate(name).service.port, None)
+
+    def get_filter(self, name: str) -> SlateFilter | None:
+        return self.filters.get(self.get_slate(name).service.port)
+
+    def get_slate(self, name: str) -> Slate:
+        for slate in self.slates.values():
+            if slate.service.name == name:
+                return slate
+        raise Exception(f"Invalid slate name: {name}")
 
-        # defragment packets
-        buffered_packets = dict()
+    def reset_stats(self):
+        self.captured_bytes = 0
+        self.captured_messages = 0
+        self.filtered_messages = 0
+        self.dropped_messages = 0
+        self.stored_messages = 0
 
-        for packet in reader:
+    def stats(self) -> dict:
+        return {
+            "captured_bytes": self.captured_bytes,
+            "captured_messages": self.captured_messages,
+            "filtered_messages": self.filtered_messages,
+            "malformed_packets": 0 if self.reader == None else self.reader.malformed,
+            "dropped_messages": self.dropped_messages,
+            "stored_messages": self.stored_messages,
+            "decode_queue": self.decode_queue.qsize(),
+            "store_queue": self.store_queue.qsize(),
+            "reassembly": self.reassembler.stats(),
+        }
+
+    def replay(
+        self,
+        paths: List[str],
+        handler: Callable[[str, tuple], None],
+        should_stop: Callable[[], bool] = lambda: False,
+    ):
+        """Same as sniff, but the packets are read from pcap files or folders"""
+        for path in capture_files(paths):
             if should_stop():
                 break
+            with open(path, "rb") as f:
+                self.dispatch(PcapReader.from_file(f), handler, should_stop)
+
+    def dispatch(
+        self,
+        reader: PcapReader,
+        handler: Callable[[str, tuple], None],
+        should_stop: Callable[[], bool] = lambda: False,
+    ):
+        for slate, data, _ in self.messages(reader, should_stop):
             try:
-                if packet[UDP]:
-                    port = packet[UDP].dport
-                    if port in self.slates:
-                        payload = bytes(packet[UDP].payload)
-                        slate: Slate = self.slates.get(port)
-
-                        # print(f"Incoming message for {slate.service.name}, len = {len(payload)}")
-
-                        if len(payload) < slate.message_parser.struct.size:
-                            # print(f"Received fragmented packet for {slate.service.name} ({len(payload)} < {slate.message_parser.struct.size})")
-                            # hexdump(payload)
-                            if port in buffered_packets:
-                                prev = buffered_packets.get(port)
-
-                                # we need to remove the header from to just get the payload
-                                # out of messages that are not the first fragment
-                                curr = prev + payload[20:]
-                                if len(curr) >= slate.message_parser.struct.size:
-                                    # print(f"Handling the reconstructed packet for {slate.service.name} ({len(curr)} >= {slate.message_parser.struct.size})")
-                                    buffered_packets.pop(port)
-                                    message = slate.parse_message(curr)
-                                    handler(slate.service.name, message)
-                                else:
-                                    buffered_packets.update({port: curr})
-                            else:
-                                buffered_packets.update({port: payload})
-                        else:
-                            message = slate.parse_message(payload)
-                            handler(slate.service.name, message)
+                handler(slate.service.name, slate.parse_message(data))
             except Exception as e:
                 print(e, file=sys.stderr)
 
-        ssh.close()
+    def messages(
+        self,
+        reader: PcapReader,
+        should_stop: Callable[[], bool] = lambda: False,
+    ) -> Iterator[tuple[Slate, bytes, float]]:
+        """
+        Yield (slate, raw message, timestamp) for every complete message in the
+        capture. A packet that cannot be handled is skipped, as the reader does
+        """
+        self.reassembler = Reassembler()
+        self.reader = reader
+
+        for timestamp, src, port, payload in reader:
+            if should_stop():
+                break
+            slate: Slate = self.slates.get(port)
+            if slate != None:
+                try:
+                    message = self.reassembler.push(slate, timestamp, src, payload)
+                    if message == None:
+                        continue
+                    slate_filter = self.filters.get(port)
+                    if slate_filter != None and not slate_filter.accept(message):
+                        self.filtered_messages += 1
+                        continue
+                except Exception as e:
+                    reader.skip(e)
+                    continue
+                yield slate, message, timestamp
+
+
+def capture_files(paths: List[str]) -> List[str]:
+    """Expand folders into the sorted list of the capture files they contain"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in sorted(os.walk(path)):
+                files += [
+                    os.path.join(root, name)
+                    for name in sorted(names)
+                    if name.endswith((".pcap", ".pcapng", ".cap"))
+                ]
+        else:
+            files.append(path)
+    return files
 
 
 def main():
     services = Service.parse("config/service_directory")
-    slates = list(map(Slate.from_service, services))
+    slates = Slate.from_services(services)
     assert len(services) == len(slates)
     sniffer = Sniffer(slates)
 
@@ -13,63 +13,436 @@
 # limitations under the License.
 
 import sys
+import numpy as np
 from threading import Lock
 from .slate import Slate
 from .service import Service
 from .sniffer import Sniffer
-from .utils import binary_search
 
 MAX_MSG_IN_QUEUE = 100
+# Number of messages between two keyframes in delta mode
+KEYFRAME_INTERVAL = 64
+# Number of messages in each block of the columnar store
+COLUMN_BLOCK_SIZE = 65536
+
+AGGREGATIONS = {
+    "min": np.min,
+    "max": np.max,
+    "mean": np.mean,
+    "sum": np.sum,
+    "count": len,
+}
 
 
 class SingleSlateStore:
-    def __init__(self, slate: Slate, max_msg_in_queue=MAX_MSG_IN_QUEUE):
+    """
+    Keeps the last capacity messages of a slate in a ring buffer, message i being in
+    slot i % capacity. Only writers take the lock: readers copy the slots they need
+    and drop the messages that were overwritten during the copy.
+
+    In delta mode, only the fields that changed since the previous message are
+    stored, as a bitmask and the changed values. A complete message (keyframe) is
+    stored every KEYFRAME_INTERVAL messages, and the oldest message is always a
+    keyframe, the deltas that are overwritten being folded into it
+    """
+
+    def __init__(
+        self, slate: Slate, capacity: int = MAX_MSG_IN_QUEUE, delta: bool = False
+    ):
         self.slate = slate
-        self.max_msg_in_queue = max_msg_in_queue
+        self.capacity = capacity
+        self.ring = [None] * capacity
+        # id of the oldest message, and of the next one
+        self.first_msg_id = 0
         self.current_msg_id = 0
-        self.messages = []
         self.lock = Lock()
 
-    def insert(self, message):
+        self.delta = delta
+        self.full_mask = (1 << len(slate.message_parser.params)) - 1
+        # last inserted message, used to compute the next delta
+        self.last = None
+        # fields of the oldest message
+        self.first_fields = None
+
+    def insert(self, message) -> int:
+        return self.insert_many([message])
+
+    def insert_many(self, messages: list) -> int:
+        """Returns the id of the first message"""
         self.lock.acquire()
-        self.messages.append((self.current_msg_id, message))
-        self.current_msg_id += 1
+        first_id = self.current_msg_id
+        if self.delta:
+            messages = self.encode_deltas(self.current_msg_id, messages)
 
-        # if the max size has been reached, remove 10% of the elements
-        if len(self.messages) > self.max_msg_in_queue:
-            self.messages = self.messages[int(self.max_msg_in_queue / 10) :]
+        for entry in messages:
+            msg_id = self.current_msg_id
+            if msg_id >= self.capacity:
+                first_msg_id = msg_id - self.capacity + 1
+                if self.delta:
+                    entry = self.fold(first_msg_id, msg_id, entry)
+                # from now on, readers ignore the message that is overwritten
+                self.first_msg_id = first_msg_id
+            elif self.delta and msg_id == 0:
+                self.first_fields = list(entry[1])
+            self.ring[msg_id % self.capacity] = entry
+            self.current_msg_id = msg_id + 1
         self.lock.release()
+        return first_id
+
+    def encode_deltas(self, first_id: int, messages: list) -> list:
+        deltas = []
+        for msg_id, message in enumerate(messages, first_id):
+            if self.last == None or msg_id % KEYFRAME_INTERVAL == 0:
+                deltas.append((self.full_mask, tuple(message)))
+            else:
+                mask = 0
+                values = []
+                for i, (value, last) in enumerate(zip(message, self.last)):
+                    if value != last:
+                        mask |= 1 << i
+                        values.append(value)
+                deltas.append((mask, tuple(values)))
+            self.last = message
+        return deltas
+
+    def fold(self, first_msg_id: int, msg_id: int, entry: tuple) -> tuple:
+        """
+        Turn the message that becomes the oldest one into a keyframe, before it is
+        published. Returns the entry to store for msg_id
+        """
+        if first_msg_id == msg_id:
+            mask, values = entry
+        else:
+            mask, values = self.ring[first_msg_id % self.capacity]
+        if mask == self.full_mask:
+            self.first_fields = list(values)
+        else:
+            apply_delta(self.first_fields, mask, values)
+        keyframe = (self.full_mask, tuple(self.first_fields))
+
+        if first_msg_id == msg_id:
+            return keyframe
+        self.ring[first_msg_id % self.capacity] = keyframe
+        return entry
+
+    def snapshot(self, last_id: int = None) -> tuple[list, int]:
+        """
+        Copy the messages following last_id, as (id, entry), without locking.
+        The copy starts with the previous message if it is available, and, in delta
+        mode, with the keyframe needed to rebuild it. Returns the copy and the index
+        of the first message following last_id
+        """
+        while True:
+            first = self.first_msg_id
+            end = self.current_msg_id
+            start = first
+            if last_id != None:
+                start = max(first, min(last_id + 1, end))
+            base = max(first, start - 1)
+            if self.delta:
+                base = max(first, base - base % KEYFRAME_INTERVAL)
+
+            entries = [(i, self.ring[i % self.capacity]) for i in range(base, end)]
+            # retry if the writer overwrote some of the copied messages
+            if self.first_msg_id <= base:
+                return entries, start - base
 
     def get_messages(self, last_id: int = None) -> list:
-        if last_id == None or len(self.messages) == 0 or last_id < self.messages[0][0]:
-            return self.messages
-        elif last_id >= self.messages[-1][0]:
+        entries, index = self.snapshot(last_id)
+        if not self.delta:
+            return entries[index:]
+        if index >= len(entries):
             return []
-        else:
-            # here I need to lock
-            self.lock.acquire()
-            index = binary_search(self.messages, last_id, lambda x: x[0])
-            self.lock.release()
-            if index != -1:
-                return self.messages[index + 1 :]
+
+        message_class = self.slate.message_parser.message_class
+        fields = rebuild(entries, index, self.full_mask)
+        result = [(entries[index][0], message_class._make(fields))]
+        for msg_id, (mask, values) in entries[index + 1 :]:
+            apply_delta(fields, mask, values)
+            result.append((msg_id, message_class._make(fields)))
+        return result
+
+    def get_columns(self, last_id: int = None) -> tuple[int, dict[str, list]]:
+        """
+        See ColumnarSlateStore.get_columns, the columns are lists as converting them
+        to arrays costs more than what the serializers save
+        """
+        messages = self.get_messages(last_id)
+        start = messages[0][0] if len(messages) > 0 else self.current_msg_id
+        names = self.slate.message_parser.message_class._fields
+        values = list(zip(*(message for _, message in messages)))
+        if len(values) == 0:
+            values = [()] * len(names)
+        return start, dict(zip(names, values))
+
+    def get_deltas(self, last_id: int = None) -> list:
+        """
+        Same as get_messages, but only the fields that changed since the previous
+        message are returned, as (id, dictionary: field -> value). The first message
+        is complete, unless it directly follows last_id
+        """
+        names = self.slate.message_parser.message_class._fields
+        entries, index = self.snapshot(last_id)
+        if index >= len(entries):
+            return []
+        if not self.delta:
+            previous = entries[index - 1][1] if index > 0 else None
+            return diff_messages(entries[index:], names, previous)
+
+        result = []
+        fields = rebuild(entries, index - 1, self.full_mask) if index > 0 else None
+        for msg_id, (mask, values) in entries[index:]:
+            if mask == self.full_mask:
+                # keyframes are complete, compare them with the previous message
+                changed = diff_messages([(msg_id, values)], names, fields)[0][1]
+                fields = list(values)
             else:
-                return []
+                changed = dict()
+                delta_values = iter(values)
+                for i, name in enumerate(names):
+                    if mask >> i & 1:
+                        changed[name] = next(delta_values)
+                apply_delta(fields, mask, values)
+            result.append((msg_id, changed))
+        return result
+
+    def aggregate(self, field: str, operation: str, window: int = None):
+        """Compute min, max, mean, sum or count of a field over the last messages"""
+        index = self.slate.message_parser.message_class._fields.index(field)
+        last_id = None if window == None else self.current_msg_id - window - 1
+        values = [message[index] for _, message in self.get_messages(last_id)]
+        return aggregate(np.array(values), operation)
+
+
+class ColumnarSlateStore:
+    """
+    Same as SingleSlateStore, but the messages are stored in one NumPy array per
+    field. The arrays are split in blocks of COLUMN_BLOCK_SIZE messages, allocated
+    when they are first needed, and the blocks form a ring buffer, message i being
+    in slot i % capacity. Readers do not lock, as for SingleSlateStore
+    """
+
+    def __init__(self, slate: Slate, capacity: int = MAX_MSG_IN_QUEUE):
+        self.slate = slate
+        self.capacity = capacity
+        self.names = slate.message_parser.message_class._fields
+        # the arrays use the native byte order, which is faster to compute with
+        self.dtype = slate.message_parser.dtype.newbyteorder("=")
+        # every block is a dictionary: field name -> array
+        self.blocks: list[dict[str, np.ndarray] | None] = [None] * (
+            (capacity + COLUMN_BLOCK_SIZE - 1) // COLUMN_BLOCK_SIZE
+        )
+        self.first_msg_id = 0
+        self.current_msg_id = 0
+        self.lock = Lock()
+
+    def insert(self, message) -> int:
+        return self.insert_many([message])
+
+    def insert_many(self, messages: list | np.ndarray) -> int:
+        """
+        Insert a list of messages, or a record array such as parse_buffer's, returns
+        the id of the first message. Message i of the batch has id first id + i, even
+        if the batch is bigger than the capacity and only its end is kept
+        """
+        records = np.asarray(messages, dtype=self.dtype)
+        self.lock.acquire()
+        first_id = self.current_msg_id
+        msg_id = first_id
+        if len(records) > self.capacity:
+            # only the end of the batch is kept, readers must not see the ids of the
+            # messages that are skipped, their slots hold older messages
+            msg_id += len(records) - self.capacity
+            records = records[-self.capacity :]
+            self.first_msg_id = msg_id
+
+        pos = 0
+        while pos < len(records):
+            block, slot, size = self.segment(msg_id, msg_id + len(records) - pos)
+            columns = self.blocks[block]
+            if columns == None:
+                columns = {
+                    name: np.empty(self.block_size(block), self.dtype[name])
+                    for name in self.names
+                }
+                self.blocks[block] = columns
+
+            # from now on, readers ignore the messages that are overwritten
+            self.first_msg_id = max(self.first_msg_id, msg_id + size - self.capacity)
+            for name in self.names:
+                columns[name][slot : slot + size] = records[name][pos : pos + size]
+            msg_id += size
+            self.current_msg_id = msg_id
+            pos += size
+        self.lock.release()
+        return first_id
+
+    def segment(self, start: int, end: int) -> tuple[int, int, int]:
+        """
+        Find the block containing message start, returns the block index, the index
+        of the message in the block and the number of consecutive messages of
+        [start, end) in the block
+        """
+        block, slot = divmod(start % self.capacity, COLUMN_BLOCK_SIZE)
+        return block, slot, min(end - start, self.block_size(block) - slot)
+
+    def block_size(self, block: int) -> int:
+        """The last block is smaller if capacity is not a multiple of the block size"""
+        return min(COLUMN_BLOCK_SIZE, self.capacity - block * COLUMN_BLOCK_SIZE)
+
+    def get_columns(
+        self, last_id: int = None, fields: list[str] = None, previous: bool = False
+    ) -> tuple[int, dict[str, np.ndarray]]:
+        """
+        Copy the given fields of the messages following last_id (and the previous
+        message if it is available and previous is True), returns the id of the
+        first copied message and a dictionary: field name -> array
+        """
+        fields = self.names if fields == None else fields
+        for field in fields:
+            if field not in self.names:
+                name = self.slate.service.name
+                raise Exception(f"Invalid field for slate {name}: {field}")
+
+        while True:
+            first = self.first_msg_id
+            end = self.current_msg_id
+            start = first
+            if last_id != None:
+                start = max(first, min(last_id + 1, end))
+            if previous:
+                start = max(first, start - 1)
+
+            chunks = {field: [] for field in fields}
+            msg_id = start
+            while msg_id < end:
+                block, slot, size = self.segment(msg_id, end)
+                for field in fields:
+                    chunks[field].append(self.blocks[block][field][slot : slot + size])
+                msg_id += size
+            columns = {
+                field: np.concatenate(chunks[field])
+                if len(chunks[field]) > 0
+                else np.empty(0, self.dtype[field])
+                for field in fields
+            }
+            # retry if the writer overwrote some of the copied messages
+            if self.first_msg_id <= start:
+                return start, columns
+
+    def get_messages(self, last_id: int = None) -> list:
+        start, columns = self.get_columns(last_id)
+        message_class = self.slate.message_parser.message_class
+        rows = list(zip(*(columns[name].tolist() for name in self.names)))
+        return list(zip(range(start, start + len(rows)), map(message_class._make, rows)))
+
+    def get_deltas(self, last_id: int = None) -> list:
+        """See SingleSlateStore.get_deltas"""
+        start, columns = self.get_columns(last_id, previous=True)
+        rows = list(zip(*(columns[name].tolist() for name in self.names)))
+        messages = list(zip(range(start, start + len(rows)), rows))
+        if len(messages) == 0:
+            return []
+        if last_id != None and start <= last_id:
+            return diff_messages(messages[1:], self.names, messages[0][1])
+        return diff_messages(messages, self.names)
+
+    def aggregate(self, field: str, operation: str, window: int = None):
+        """Compute min, max, mean, sum or count of a field over the last messages"""
+        last_id = None if window == None else self.current_msg_id - window - 1
+        _, columns = self.get_columns(last_id, [field])
+        return aggregate(columns[field], operation)
+
+
+def aggregate(values: np.ndarray, operation: str):
+    function = AGGREGATIONS.get(operation)
+    if function == None:
+        raise Exception(f"Invalid aggregation: {operation}")
+    if len(values) == 0:
+        return None
+    result = function(values)
+    return result.item() if isinstance(result, np.generic) else result
+
+
+def rebuild(messages: list, index: int, full_mask: int) -> list:
+    """Rebuild the fields of a message stored as a delta, from the previous keyframe"""
+    start = index
+    while start > 0 and messages[start][1][0] != full_mask:
+        start -= 1
+    fields = list(messages[start][1][1])
+    for _, (mask, values) in messages[start + 1 : index + 1]:
+        apply_delta(fields, mask, values)
+    return fields
+
+
+def apply_delta(fields: list, mask: int, values: tuple):
+    i = 0
+    for value in values:
+        while not mask >> i & 1:
+            i += 1
+        fields[i] = value
+        i += 1
+
+
+def diff_messages(messages: list, names: list[str], previous=None) -> list:
+    result = []
+    for msg_id, message in messages:
+        if previous == None:
+            changed = dict(zip(names, message))
+        else:
+            changed = {
+                name: value
+                for name, value, last in zip(names, message, previous)
+                if value != last
+            }
+        result.append((msg_id, changed))
+        previous = message
+    return result
 
 
 class SlateStorage:
-    def __init__(self, slates: list[Slate]):
+    def __init__(
+        self,
+        slates: list[Slate],
+        delta: bool = False,
+        capacity: int = MAX_MSG_IN_QUEUE,
+        capacities: dict[str, int] = None,
+        columnar: bool = False,
+    ):
+        """
+        capacities overrides the number of messages kept for some services, with
+        columnar the messages are stored in NumPy arrays instead of tuples (delta is
+        then ignored)
+        """
         self.store = dict()
 
         for slate in slates:
-            self.store.update({slate.service.name: SingleSlateStore(slate)})
+            name = slate.service.name
+            if capacities != None:
+                slate_capacity = capacities.get(name, capacity)
+            else:
+                slate_capacity = capacity
+            if columnar:
+                store = ColumnarSlateStore(slate, slate_capacity)
+            else:
+                store = SingleSlateStore(slate, slate_capacity, delta=delta)
+            self.store.update({name: store})
 
-    def handle_message(self, name: str, message):
+    def handle_message(self, name: str, message) -> int:
         store = self.store.get(name)
         if store == None:
             raise Exception(f"Invalid slate name: {name}")
         else:
-            store.insert(message)
-            # print(f"Message received for slate {name}, # messages in queue: {len(store.messages)}")
+            return store.insert(message)
+            # print(f"Message received for slate {name}, # messages in queue: {store.current_msg_id - store.first_msg_id}")
+
+    def handle_messages(self, name: str, messages: list) -> int:
+        """Returns the id of the first message"""
+        store = self.store.get(name)
+        if store == None:
+            raise Exception(f"Invalid slate name: {name}")
+        else:
+            return store.insert_many(messages)
 
     def get_messages(self, name: str, last_id: int = None) -> list | None:
         store: SingleSlateStore = self.store.get(name)
@@ -77,6 +450,35 @@ class SlateStorage:
             return None
         return store.get_messages(last_id)
 
+    def get_columns(
+        self, name: str, last_id: int = None
+    ) -> tuple[int, dict[str, np.ndarray | list]] | None:
+        """Messages following last_id, as the first id and one column per field"""
+        store: SingleSlateStore | ColumnarSlateStore = self.store.get(name)
+        if store == None:
+            return None
+        return store.get_columns(last_id)
+
+    def get_last_message(self, name: str) -> tuple | None:
+        """(id, message) of the last message of a service, None if there is none"""
+        store: SingleSlateStore | ColumnarSlateStore = self.store.get(name)
+        if store == None:
+            return None
+        messages = store.get_messages(store.current_msg_id - 2)
+        return messages[-1] if len(messages) > 0 else None
+
+    def get_deltas(self, name: str, last_id: int = None) -> list | None:
+        store: SingleSlateStore = self.store.get(name)
+        if store == None:
+            return None
+        return store.get_deltas(last_id)
+
+    def aggregate(self, name: str, field: str, operation: str, window: int = None):
+        store: SingleSlateStore | ColumnarSlateStore = self.store.get(name)
+        if store == None:
+            raise Exception(f"Invalid slate name: {name}")
+        return store.aggregate(field, operation, window)
+
     def get_schema(self, name: str) -> list | None:
         store = self.store.get(name)
         if store == None:
@@ -86,14 +488,14 @@ class SlateStorage:
 
 def main():
     services = Service.parse("./config/service_directory")
-    slates = list(map(Slate.from_service, services))
+    slates = Slate.from_services(services)
     sniffer = Sniffer(slates)
     store = SlateStorage(slates)
 
     def handler(name, message):
         store.handle_message(name, message)
 
-    sniffer.sniff(handler)
+    sniffer.sniff(handler, batch_handler=store.handle_messages)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,64 @@
+# Copyright 2023 Quarkslab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Self
+import json
+from .config import *
+
+# Name of the target when none is configured, which uses the settings of config.py
+DEFAULT_TARGET = "default"
+
+
+class Target:
+    """
+    A dish or an emulator, reached through SSH. proxy_port is the local port of its
+    injection tunnels, 0 lets the system choose a free one
+    """
+
+    def __init__(
+        self,
+        name: str,
+        host: str = SSH_HOST,
+        port: int = SSH_PORT,
+        user: str = SSH_USER,
+        password: str = SSH_PASSWD,
+        iface: str = IFACE,
+        proxy_port: int = 0,
+    ):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.iface = iface
+        self.proxy_port = proxy_port
+
+    def __str__(self):
+        return f"{self.name} -> {self.user}@{self.host}:{self.port}"
+
+    def __repr__(self):
+        return self.__str__()
+
+    def default() -> Self:
+        return Target(DEFAULT_TARGET, proxy_port=PROXY_PORT)
+
+    def parse(targets_file: str) -> list[Self]:
+        """
+        Read a JSON file such as {"dish1": {"host": "192.168.100.1"}, ...}, the
+        missing settings take the values of config.py
+        """
+        with open(targets_file, "r") as f:
+            content = json.loads(f.read())
+
+        return [Target(name, **settings) for name, settings in content.items()]
@@ -15,9 +15,23 @@
 from typing import Self
 from sshtunnel import SSHTunnelForwarder
 from paramiko import SSHClient
+import os
 import random
+import struct
+import sys
 from .config import *
 
+# Interpreter running the relay of the framed tunnels on the dish, and its path
+REMOTE_PYTHON = "micropython"
+RELAY_PATH = "/tmp/injector_relay.py"
+# Size of a message, sent before it in a framed tunnel
+FRAME_HEADER = struct.Struct(">H")
+
+
+def frame(message: bytes) -> bytes:
+    """A message as it is sent in a framed tunnel, see lib/injector_relay.py"""
+    return FRAME_HEADER.pack(len(message)) + message
+
 
 class InjectorTunnel:
     """
@@ -44,6 +58,12 @@ class TcpInjectorTunnel(InjectorTunnel):
     port
 
     Once the tunnel is open requests have to be sent to 127.0.0.1:{self.tunnel.local_bind_port}
+
+    socat turns every read of the TCP stream into a datagram, so a connection can
+    only carry one message. If framed is True, lib/injector_relay.py is run instead
+    of socat: every message is preceded by its size (see frame) and sent as its own
+    datagram, so that many messages can be sent on the same connection. If the relay
+    cannot be started on the target, socat is used and framed is set to False
     """
 
     def __init__(
@@ -54,6 +74,7 @@ class TcpInjectorTunnel(InjectorTunnel):
         password=SSH_PASSWD,
         user=SSH_USER,
         local_port=PROXY_PORT,
+        framed: bool = False,
     ):
         self.host = host
         self.ssh_port = ssh_port
@@ -61,6 +82,7 @@ class TcpInjectorTunnel(InjectorTunnel):
         self.user = user
         self.local_port = local_port
         self.remote_port = remote_port
+        self.framed = framed
 
     def __enter__(self):
         ssh = SSHClient()
@@ -74,22 +96,16 @@ class TcpInjectorTunnel(InjectorTunnel):
             username=self.user,
             password=self.password,
         )
-        print(
-            f"Connected. Executing socat to forward TCP message to UDP messages, choosing a free port"
-        )
-        while True:
-            remote_port = random.randrange(1025, 65536)
-            command = f"socat -dd tcp4-listen:{remote_port},reuseaddr,fork UDP:127.0.0.1:{self.remote_port}"
-            print(f"Executing: {command}")
-            stdin, stdout, stderr = ssh.exec_command(command, get_pty=True)
+        remote_port = None
+        if self.framed:
+            remote_port = self.start_relay()
+            if remote_port == None:
+                print("The relay could not be started, using socat", file=sys.stderr)
+                self.framed = False
+        if remote_port == None:
+            remote_port = self.start_socat()
 
-            output = stderr.channel.recv(512)
-            if b"listening on" in output:
-                break
-            else:
-                print("Port already in use...")
-
-        print(f"socat listening on port {remote_port}, opening ssh tunnel to that port")
+        print(f"Listening on port {remote_port}, opening ssh tunnel to that port")
 
         try:
             tunnel = SSHTunnelForwarder(
@@ -98,7 +114,7 @@ class TcpInjectorTunnel(InjectorTunnel):
                 ssh_password=self.password,
                 host_pkey_directories="/tmp",
                 remote_bind_address=("127.0.0.1", remote_port),
-                local_bind_address=("127.0.0.1", 12345),
+                local_bind_address=("127.0.0.1", self.local_port),
             )
             self.tunnel = tunnel
             tunnel.start()
@@ -111,10 +127,75 @@ class TcpInjectorTunnel(InjectorTunnel):
             print(e)
             raise e
 
+    def start_socat(self) -> int:
+        print(
+            f"Connected. Executing socat to forward TCP message to UDP messages, choosing a free port"
+        )
+        while True:
+            remote_port = random.randrange(1025, 65536)
+            command = f"socat -dd tcp4-listen:{remote_port},reuseaddr,fork UDP:127.0.0.1:{self.remote_port}"
+            print(f"Executing: {command}")
+            stdin, stdout, stderr = self.ssh.exec_command(command, get_pty=True)
+
+            output = stderr.channel.recv(512)
+            if b"listening on" in output:
+                self.process = stderr.channel
+                return remote_port
+            else:
+                print("Port already in use...")
+
+    def start_relay(self) -> int | None:
+        """
+        Copy lib/injector_relay.py to the target and run it on a free port, returns
+        the port or None if the relay cannot run there
+        """
+        print(f"Connected. Copying the relay to {RELAY_PATH}")
+        relay = os.path.join(os.path.dirname(__file__), "injector_relay.py")
+        try:
+            sftp = self.ssh.open_sftp()
+            try:
+                sftp.put(relay, RELAY_PATH)
+            finally:
+                sftp.close()
+        except Exception as e:
+            print(f"Could not copy the relay: {e}", file=sys.stderr)
+            return None
+
+        while True:
+            remote_port = random.randrange(1025, 65536)
+            command = f"{REMOTE_PYTHON} {RELAY_PATH} {remote_port} {self.remote_port}"
+            print(f"Executing: {command}")
+            stdin, stdout, stderr = self.ssh.exec_command(command, get_pty=True)
+
+            output = stderr.channel.recv(512)
+            if b"listening on" in output:
+                self.process = stderr.channel
+                return remote_port
+            # micropython and python do not name the error the same way
+            if b"EADDRINUSE" not in output and b"in use" not in output:
+                print(output.decode(errors="replace"), file=sys.stderr)
+                stderr.channel.close()
+                return None
+            print("Port already in use...")
+
     def __exit__(self, type, value, traceback):
         self.tunnel.close()
         self.ssh.close()
 
+    def is_alive(self) -> bool:
+        """The SSH connections are up and socat (or the relay) is still running"""
+        # socat logs every connection, its output is discarded so that it never
+        # blocks on a full channel
+        while self.process.recv_ready():
+            self.process.recv(4096)
+        transport = self.ssh.get_transport()
+        return (
+            transport != None
+            and transport.is_active()
+            and self.tunnel.is_active
+            and not self.process.exit_status_ready()
+        )
+
 
 class UdpInjectorTunnel(InjectorTunnel):
     """
@@ -0,0 +1,235 @@
+# Copyright 2023 Quarkslab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import time
+from threading import Event, Lock, Thread
+from typing import Callable
+from .tunnel import TcpInjectorTunnel, frame
+
+# Seconds after which an unused tunnel is closed
+TUNNEL_IDLE_TIMEOUT = 300
+# Seconds between two checks for idle or broken tunnels
+TUNNEL_CHECK_INTERVAL = 10
+
+
+class PooledTunnel:
+    """
+    An open tunnel to a service port. Framed tunnels also keep a socket connected
+    through them, with socat every message is sent on a new connection
+    """
+
+    def __init__(
+        self, tunnel: TcpInjectorTunnel, open_socket: Callable[[int], object], sock
+    ):
+        self.tunnel = tunnel
+        self.open_socket = open_socket
+        self.socket = sock
+        self.last_used = time.monotonic()
+        # number of sends using the tunnel, it is not closed by check_loop meanwhile
+        self.users = 0
+        # held while sending, so that messages are never interleaved
+        self.lock = Lock()
+
+    def is_alive(self) -> bool:
+        return self.tunnel.is_alive() and (
+            self.socket == None or self.socket.is_alive()
+        )
+
+    def send(self, messages: list[bytes]):
+        if self.socket != None:
+            self.socket.sock.sendall(b"".join(map(frame, messages)))
+            return
+        # socat sends what it reads from a connection as a datagram
+        for message in messages:
+            with self.open_socket(int(self.tunnel.tunnel.local_bind_port)) as sock:
+                sock.sock.sendall(message)
+
+    def close(self):
+        resources = [self.tunnel] if self.socket == None else [self.socket, self.tunnel]
+        for resource in resources:
+            try:
+                resource.__exit__(None, None, None)
+            except Exception as e:
+                print(e, file=sys.stderr)
+
+
+class TunnelPool:
+    """
+    Keeps a tunnel (and a connected socket if it is framed) open for each service
+    port, so that only the first message sent to a port waits for the SSH
+    connections and socat or the relay. Tunnels are checked before every use and
+    periodically by a background thread, which also closes the ones that were not
+    used for idle_timeout seconds. Tunnels are never closed with the pool locked.
+
+    open_tunnel returns a new (not yet entered) tunnel to a service port, and
+    open_socket a socket (not yet entered) connected to a local port
+    """
+
+    def __init__(
+        self,
+        open_tunnel: Callable[[int], TcpInjectorTunnel],
+        open_socket: Callable[[int], object],
+        idle_timeout: float = TUNNEL_IDLE_TIMEOUT,
+        check_interval: float = TUNNEL_CHECK_INTERVAL,
+    ):
+        self.open_tunnel = open_tunnel
+        self.open_socket = open_socket
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        # Dictionary: service port -> PooledTunnel
+        self.tunnels: dict[int, PooledTunnel] = dict()
+        # Dictionary: service port -> lock held while its tunnel is opened, so that
+        # a port is only opened once and the other ports are not kept waiting
+        self.opening: dict[int, Lock] = dict()
+        self.lock = Lock()
+        self.closed = Event()
+        self.checker = None
+        self.opened = 0
+        self.evicted = 0
+        self.broken = 0
+
+    def get(self, port: int) -> PooledTunnel:
+        """
+        The tunnel to a service port, opened if there is none or it is broken. It is
+        counted as used until release is called
+        """
+        self.lock.acquire()
+        opening = self.opening.setdefault(port, Lock())
+        self.lock.release()
+
+        opening.acquire()
+        try:
+            broken = None
+            self.lock.acquire()
+            try:
+                if self.closed.is_set():
+                    raise Exception("The tunnel pool is closed")
+                pooled = self.tunnels.get(port)
+                if pooled != None and not pooled.is_alive():
+                    self.broken += 1
+                    broken = self.remove(port)
+                    pooled = None
+                if pooled != None:
+                    pooled.users += 1
+            finally:
+                self.lock.release()
+            if broken != None:
+                broken.close()
+            if pooled != None:
+                return pooled
+
+            # the SSH connections take a while, the pool is not locked meanwhile
+            pooled = self.open(port)
+            self.lock.acquire()
+            closed = self.closed.is_set()
+            if not closed:
+                self.tunnels[port] = pooled
+                pooled.users += 1
+            self.lock.release()
+            if closed:
+                pooled.close()
+                raise Exception("The tunnel pool is closed")
+            return pooled
+        finally:
+            opening.release()
+
+    def release(self, pooled: PooledTunnel):
+        self.lock.acquire()
+        pooled.users -= 1
+        self.lock.release()
+
+    def open(self, port: int) -> PooledTunnel:
+        tunnel = self.open_tunnel(port).__enter__()
+        sock = None
+        if tunnel.framed:
+            try:
+                sock = self.open_socket(int(tunnel.tunnel.local_bind_port)).__enter__()
+            except Exception:
+                tunnel.__exit__(None, None, None)
+                raise
+        self.lock.acquire()
+        self.opened += 1
+        if self.checker == None:
+            self.checker = Thread(target=self.check_loop, daemon=True)
+            self.checker.start()
+        self.lock.release()
+        return PooledTunnel(tunnel, self.open_socket, sock)
+
+    def remove(self, port: int) -> PooledTunnel | None:
+        """Remove the tunnel of a port (with the pool locked), the caller closes it"""
+        return self.tunnels.pop(port, None)
+
+    def send(self, port: int, messages: list[bytes]):
+        """
+        Send messages to a service port, each of them as its own datagram. If it
+        fails, the tunnel is closed, since some of the messages may have been sent,
+        and the next send opens a new one
+        """
+        pooled = self.get(port)
+        try:
+            pooled.lock.acquire()
+            try:
+                pooled.send(messages)
+                pooled.last_used = time.monotonic()
+            except OSError:
+                self.lock.acquire()
+                broken = self.tunnels.get(port) == pooled
+                if broken:
+                    self.broken += 1
+                    self.remove(port)
+                self.lock.release()
+                if broken:
+                    pooled.close()
+                raise
+            finally:
+                pooled.lock.release()
+        finally:
+            self.release(pooled)
+
+    def check_loop(self):
+        while not self.closed.wait(self.check_interval):
+            removed = []
+            self.lock.acquire()
+            now = time.monotonic()
+            for port, pooled in list(self.tunnels.items()):
+                if pooled.users > 0:
+                    continue
+                if now - pooled.last_used > self.idle_timeout:
+                    self.evicted += 1
+                    removed.append(self.remove(port))
+                elif not pooled.is_alive():
+                    self.broken += 1
+                    removed.append(self.remove(port))
+            self.lock.release()
+            for pooled in removed:
+                pooled.close()
+
+    def stats(self) -> dict:
+        return {
+            "open_tunnels": len(self.tunnels),
+            "opened_tunnels": self.opened,
+            "evicted_tunnels": self.evicted,
+            "broken_tunnels": self.broken,
+        }
+
+    def close(self):
+        self.lock.acquire()
+        self.closed.set()
+        removed = [self.remove(port) for port in list(self.tunnels.keys())]
+        self.lock.release()
+        for pooled in removed:
+            pooled.close()
+        if self.checker != None:
+            self.checker.join()
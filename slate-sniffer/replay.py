@@ -0,0 +1,197 @@
+# Copyright 2023 Quarkslab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import os
+import shutil
+import sys
+import time
+import numpy as np
+from lib.service import Service
+from lib.slate import Slate
+from lib.sniffer import Sniffer, capture_files
+from lib.pcap import PcapReader
+from lib import config
+
+# Sniffer of the current worker process, slates cannot be pickled so they are
+# loaded once by every worker
+worker_sniffer: Sniffer = None
+# Number of messages of a slate decoded and written to disk at once by a worker
+WRITE_CHUNK_MESSAGES = 16384
+
+
+def init_worker(services: list[Service]):
+    global worker_sniffer
+    worker_sniffer = Sniffer(Slate.from_services(services))
+
+
+def native_dtype(slate: Slate) -> np.dtype:
+    """Messages written by the workers, in the byte order of the machine like numpy"""
+    return slate.message_parser.dtype.newbyteorder("=")
+
+
+def decode_capture(path: str, part: str) -> tuple[dict[str, int], int]:
+    """
+    Decode all the messages of a capture file and write those of each slate to
+    <part>.<slate name>, one after the other (see native_dtype), by chunks of
+    WRITE_CHUNK_MESSAGES. Returns a dictionary slate name -> number of messages
+    and the size of the file
+    """
+    slates = worker_sniffer.slates.values()
+    buffers = {slate.service.name: bytearray() for slate in slates}
+    counts = {slate.service.name: 0 for slate in slates}
+    # Dictionary: slate name -> part file, opened with the first message
+    files = dict()
+
+    def write(slate: Slate):
+        name = slate.service.name
+        records = slate.message_parser.parse_buffer(buffers[name])
+        if name not in files:
+            files[name] = open(f"{part}.{name}", "wb")
+        files[name].write(records.astype(native_dtype(slate)).tobytes())
+        counts[name] += len(records)
+        # the records are a view of the buffer, it cannot be resized
+        buffers[name] = bytearray()
+
+    done = False
+    try:
+        with open(path, "rb") as f:
+            for slate, data, _ in worker_sniffer.messages(PcapReader.from_file(f)):
+                parser = slate.message_parser
+                buffer = buffers[slate.service.name]
+                buffer += data[: parser.struct.size]
+                if len(buffer) >= WRITE_CHUNK_MESSAGES * parser.struct.size:
+                    write(slate)
+            size = f.tell()
+        for slate in slates:
+            if len(buffers[slate.service.name]) > 0:
+                write(slate)
+        done = True
+    finally:
+        for name, file in files.items():
+            file.close()
+            if not done:
+                os.remove(f"{part}.{name}")
+    return counts, size
+
+
+def replay(
+    services: list[Service],
+    input_files: list[str],
+    output_folder: str,
+    jobs: int = None,
+):
+    """
+    The messages are not sent back to this process: every worker writes those of
+    its file to disk by chunks, and they are appended to the output of their slate
+    as soon as the file is done, so the memory used does not depend on the size of
+    the capture or of its files. The temporary files are removed if it fails
+    """
+    files = capture_files(input_files)
+    if len(files) == 0:
+        print("No capture file found", file=sys.stderr)
+        return
+
+    # the schemas are compiled and their cache saved once, before the workers load
+    # them from the cache
+    slates = {slate.service.name: slate for slate in Slate.from_services(services)}
+
+    os.makedirs(output_folder, exist_ok=True)
+    parts = [os.path.join(output_folder, f".part{i}") for i in range(len(files))]
+    start = time.perf_counter()
+    total_size = 0
+    # Dictionary: slate name -> number of messages appended to its output
+    totals: dict[str, int] = dict()
+    executor = ProcessPoolExecutor(
+        max_workers=jobs, initializer=init_worker, initargs=(services,)
+    )
+    try:
+        for path, part, (counts, size) in zip(
+            files, parts, executor.map(decode_capture, files, parts)
+        ):
+            print(f"{path}: {sum(counts.values())} messages")
+            total_size += size
+            for name, count in counts.items():
+                if count == 0:
+                    continue
+                with open(f"{part}.{name}", "rb") as f_in, open(
+                    os.path.join(output_folder, f".{name}.records"), "ab"
+                ) as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+                os.remove(f"{part}.{name}")
+                totals[name] = totals.get(name, 0) + count
+        executor.shutdown()
+        elapsed = time.perf_counter() - start
+
+        # one file per slate, with one array per field, written from the mapped
+        # records so that they are never loaded at once
+        for name, count in totals.items():
+            records_path = os.path.join(output_folder, f".{name}.records")
+            dtype = native_dtype(slates[name])
+            messages = np.memmap(records_path, dtype=dtype, mode="r", shape=(count,))
+            np.savez(
+                os.path.join(output_folder, f"{name}.npz"),
+                **{field: messages[field] for field in messages.dtype.names},
+            )
+            del messages
+            os.remove(records_path)
+            print(f"{name}: {count} messages")
+    finally:
+        # the files that are left when a worker or the conversion failed, the
+        # workers still running are waited for, those not started are cancelled
+        executor.shutdown(cancel_futures=True)
+        temporary = [f"{part}.{name}" for part in parts for name in slates]
+        temporary += [os.path.join(output_folder, f".{name}.records") for name in slates]
+        for path in temporary:
+            if os.path.exists(path):
+                os.remove(path)
+
+    total_messages = sum(totals.values())
+    print(
+        f"Decoded {total_messages} messages from {len(files)} files in {elapsed:.2f}s "
+        f"({total_size / elapsed / 1e6:.1f} MB/s, {total_messages / elapsed:.0f} msg/s)"
+    )
+
+
+def main(args):
+    services = Service.parse("./config/service_directory.json")
+    replay(services, args.input_files, args.output, args.jobs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="replay",
+        description="Decode slate messages from pcap files into one .npz file per service",
+    )
+    parser.add_argument(
+        "input_files", nargs="+", help="Capture files, or folders of capture files"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="./replay",
+        help="Output folder (default = ./replay)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of worker processes (default = number of CPUs)",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", default=False)
+    args = parser.parse_args()
+    config.verbose = args.verbose
+    main(args)
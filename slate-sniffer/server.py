@@ -12,116 +12,222 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from flask import Flask, abort, request, Response, send_from_directory, redirect
-from threading import Thread
+from flask import Flask, request, Response, send_from_directory
 import argparse
-import json
-from typing import Callable
-from lib.sniffer import Sniffer
+from concurrent.futures import ProcessPoolExecutor
+from lib.sniffer import Sniffer, DECODE_WORKERS
 from lib.service import Service
 from lib.slate import Slate
 from lib.injector import Injector
-from lib.storage import SlateStorage
+from lib.storage import SlateStorage, MAX_MSG_IN_QUEUE
+from lib.capture_log import CaptureLog
+from lib.api import Api, ApiError, ApiResponse, TargetsApi, STREAM_KEEPALIVE
+from lib.target import Target
 from lib import config
 
-thread_should_stop = False
-sniff_thread = None
+HOST = "127.0.0.1"
+PORT = 5000
 
 
-def thread_should_stop_cb():
-    global thread_should_stop
-    return thread_should_stop
+def flask_response(response: ApiResponse) -> Response:
+    return Response(
+        response.body,
+        status=response.status,
+        mimetype=response.mimetype,
+        headers=response.headers,
+    )
 
 
-def start_thread(sniffer: Sniffer, handler: Callable[[str, tuple], None]):
-    global sniff_thread
-    global thread_should_stop
-    thread_should_stop = False
-    sniff_thread = Thread(
-        target=Sniffer.sniff, args=(sniffer, handler, thread_should_stop_cb)
-    )
-    sniff_thread.start()
+def flask_app(targets: TargetsApi) -> Flask:
+    """
+    Flask routes of the Api, each request is served by a thread. Every route of a
+    target is also available without the /targets/<target> prefix for the default
+    target
+    """
+    app = Flask(__name__)
 
+    def route(rule: str, **options):
+        def decorator(function):
+            app.route(rule, defaults={"target": None}, **options)(function)
+            app.route(f"/targets/<target>{rule}", **options)(function)
+            return function
 
-def main():
-    services = Service.parse("./config/service_directory.json")
-    slates = list(map(Slate.from_service, services))
-    sniffer = Sniffer(slates)
-    store = SlateStorage(slates)
-    injector = Injector(slates)
+        return decorator
 
-    def handler(name: str, message: tuple):
-        store.handle_message(name, message)
+    @app.errorhandler(ApiError)
+    def handle_api_error(error: ApiError):
+        return ("", error.status)
 
-    api = Flask(__name__)
+    @app.route("/targets", methods=["GET", "POST"])
+    def handle_targets():
+        if request.method == "GET":
+            return flask_response(targets.get_targets(request.headers))
+        return flask_response(targets.set_status(request.json, request.headers))
 
-    json_encoder = json.JSONEncoder(default=lambda o: o.__dict__)
+    @app.route("/compare/<name>", methods=["GET"])
+    def compare(name: str):
+        return flask_response(targets.compare(name, request.args, request.headers))
 
-    @api.route("/status", methods=["GET", "POST"])
-    def handle_status():
-        global sniff_thread
-        global thread_should_stop
+    @route("/status", methods=["GET", "POST"])
+    def handle_status(target: str):
+        api = targets.get(target)
         if request.method == "GET":
-            return Response(
-                json_encoder.encode(
-                    {"status": sniff_thread != None and sniff_thread.is_alive()}
-                ),
-                mimetype="application/json",
-            )
-        elif request.method == "POST":
-            data = request.json
-            newStatus = data.get("status")
-            if newStatus == True:
-                start_thread(sniffer, handler)
-            else:
-                thread_should_stop = True
-            return Response(
-                json_encoder.encode({"status": newStatus}), mimetype="application/json"
-            )
+            return flask_response(api.get_status(request.headers))
+        return flask_response(api.set_status(request.json, request.headers))
 
-    @api.route("/services", methods=["GET"])
-    def get_services():
-        return Response(json_encoder.encode(services), mimetype="application/json")
+    @route("/stats", methods=["GET"])
+    def get_stats(target: str):
+        return flask_response(targets.get(target).get_stats(request.headers))
 
-    @api.route("/services/<name>/messages", methods=["GET"])
-    def get_messages(name: str):
-        last_id = request.args.get("last_id", default=None, type=int)
-        messages = store.get_messages(name, last_id)
-        if messages != None:
-            return Response(json_encoder.encode(messages), mimetype="application/json")
-        else:
-            abort(404)
-
-    @api.route("/services/<name>/schema", methods=["GET"])
-    def get_schema(name: str):
-        schema = store.get_schema(name)
-        if schema:
-            return Response(
-                json_encoder.encode(
-                    list(map(lambda x: {"name": x.name, "type": x.dtype.name}, schema))
-                ),
-                mimetype="application/json",
-            )
-        else:
-            abort(404)
+    @route("/stream", methods=["GET"])
+    def stream(target: str):
+        api = targets.get(target)
+        event_stream, subscriber = api.stream(request.args, request.headers)
+
+        def events():
+            try:
+                yield from event_stream.backlog()
+                while True:
+                    yield from event_stream.events(subscriber.pop(STREAM_KEEPALIVE))
+            finally:
+                api.unsubscribe(subscriber)
+
+        return Response(
+            events(),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
+        )
 
-    @api.route("/inject", methods=["POST"])
-    def inject():
+    @route("/services", methods=["GET"])
+    def get_services(target: str):
+        return flask_response(targets.get(target).get_services(request.headers))
+
+    @route("/services/<name>/messages", methods=["GET"])
+    def get_messages(target: str, name: str):
+        api = targets.get(target)
+        return flask_response(api.get_messages(name, request.args, request.headers))
+
+    @route("/services/<name>/deltas", methods=["GET"])
+    def get_deltas(target: str, name: str):
+        api = targets.get(target)
+        return flask_response(api.get_deltas(name, request.args, request.headers))
+
+    @route("/services/<name>/aggregate", methods=["GET"])
+    def get_aggregate(target: str, name: str):
+        api = targets.get(target)
+        return flask_response(api.get_aggregate(name, request.args, request.headers))
+
+    @route("/services/<name>/schema", methods=["GET"])
+    def get_schema(target: str, name: str):
+        return flask_response(targets.get(target).get_schema(name, request.headers))
+
+    @route("/services/<name>/filter", methods=["GET", "POST", "DELETE"])
+    def handle_filter(target: str, name: str):
+        api = targets.get(target)
+        data = request.json if request.method == "POST" else None
+        return flask_response(
+            api.handle_filter(name, request.method, data, request.headers)
+        )
+
+    @route("/inject", methods=["GET", "POST"])
+    def inject(target: str):
+        api = targets.get(target)
+        if request.method == "GET":
+            return flask_response(api.get_jobs(request.headers))
         data = request.json
-        service = data["service"]
-        message = data["message"]
-        try:
-            injector.send_message(service, tuple(message))
-            return ("", 200)
-        except:
-            abort(400)
-
-    @api.route("/", defaults={"path": "index.html"})
-    @api.route("/<path:path>", methods=["GET"])
+        job = api.inject(data)
+        wait = data.get("wait", True)
+        if wait:
+            job.future.result()
+        return flask_response(api.injection_response(job, wait, request.headers))
+
+    @route("/inject/batch", methods=["POST"])
+    def inject_batch(target: str):
+        api = targets.get(target)
+        data = request.json
+        job = api.inject_batch(data)
+        # batches can take as long as the capture they replay
+        wait = data.get("wait", False)
+        if wait:
+            job.future.result()
+        return flask_response(api.injection_response(job, wait, request.headers))
+
+    @route("/inject/<int:job_id>", methods=["GET", "DELETE"])
+    def handle_job(target: str, job_id: int):
+        api = targets.get(target)
+        if request.method == "DELETE":
+            return flask_response(api.cancel_job(job_id, request.headers))
+        return flask_response(api.get_job(job_id, request.headers))
+
+    @app.route("/", defaults={"path": "index.html"})
+    @app.route("/<path:path>", methods=["GET"])
     def static_files(path):
         return send_from_directory("./frontend", path)
 
-    api.run()
+    return app
+
+
+def main(args):
+    services = Service.parse("./config/service_directory.json")
+    slates = Slate.from_services(services)
+    capacities = dict()
+    for value in args.service_capacity:
+        name, capacity = value.split("=")
+        capacities[name] = int(capacity)
+    if args.targets != None:
+        targets = Target.parse(args.targets)
+    else:
+        targets = [Target.default()]
+    # the messages of all the targets are decoded by the same processes
+    executor = None
+    if args.decode_workers > 0:
+        executor = ProcessPoolExecutor(args.decode_workers)
+
+    apis = []
+    for target in targets:
+        sniffer = Sniffer(
+            slates,
+            target.host,
+            target.password,
+            target.port,
+            target.user,
+            target.iface,
+            decode_workers=args.decode_workers,
+            executor=executor,
+        )
+        store = SlateStorage(
+            slates, args.delta, args.capacity, capacities, columnar=args.columnar
+        )
+        injector = Injector(
+            slates,
+            target.host,
+            target.password,
+            target.port,
+            target.user,
+            target.proxy_port,
+            relay=args.relay,
+        )
+        log = None
+        if args.log != None:
+            log = CaptureLog(
+                args.log if args.targets == None else f"{args.log}/{target.name}",
+                slates,
+                max_size=None if args.log_max_size == None else args.log_max_size << 20,
+                max_age=args.log_max_age,
+            )
+        apis.append(Api(services, slates, sniffer, store, injector, log, target))
+
+    api = TargetsApi(apis, executor)
+    try:
+        if args.use_async:
+            # aiohttp is only needed by this mode
+            from lib.async_server import run_app
+
+            run_app(api, args.host, args.port)
+        else:
+            flask_app(api).run(args.host, args.port)
+    finally:
+        api.close()
 
 
 if __name__ == "__main__":
@@ -130,6 +236,84 @@ if __name__ == "__main__":
         description="Sniff slate messages in a remote dish and present them in a web interface",
     )
     parser.add_argument("-v", "--verbose", action="store_true", default=False)
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("-p", "--port", type=int, default=PORT)
+    parser.add_argument(
+        "-t",
+        "--targets",
+        default=None,
+        metavar="FILE",
+        help="JSON file of the dishes to sniff, instead of the one of lib/config.py",
+    )
+    parser.add_argument(
+        "-w",
+        "--decode-workers",
+        type=int,
+        default=DECODE_WORKERS,
+        help=f"Processes decoding the messages of all the dishes (default = {DECODE_WORKERS})",
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        default=False,
+        help="Serve the API with asyncio (aiohttp) instead of the Flask server",
+    )
+    parser.add_argument(
+        "--relay",
+        action="store_true",
+        default=False,
+        help="Inject through lib/injector_relay.py (micropython) instead of socat",
+    )
+    parser.add_argument(
+        "-d",
+        "--delta",
+        action="store_true",
+        default=False,
+        help="Only store the fields that changed between consecutive messages",
+    )
+    parser.add_argument(
+        "--columnar",
+        action="store_true",
+        default=False,
+        help="Store the messages in NumPy arrays, to keep millions of them",
+    )
+    parser.add_argument(
+        "-l",
+        "--log",
+        default=None,
+        metavar="FOLDER",
+        help="Also write the raw messages to an on-disk log in the given folder",
+    )
+    parser.add_argument(
+        "--log-max-size",
+        type=int,
+        default=None,
+        metavar="MB",
+        help="Delete the oldest messages of a service when its log is bigger",
+    )
+    parser.add_argument(
+        "--log-max-age",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="Delete the messages that are older than this",
+    )
+    parser.add_argument(
+        "-c",
+        "--capacity",
+        type=int,
+        default=MAX_MSG_IN_QUEUE,
+        help=f"Number of messages kept for each service (default = {MAX_MSG_IN_QUEUE})",
+    )
+    parser.add_argument(
+        "-C",
+        "--service-capacity",
+        action="append",
+        default=[],
+        metavar="NAME=CAPACITY",
+        help="Number of messages kept for a given service, can be repeated",
+    )
     args = parser.parse_args()
     config.verbose = args.verbose
-    main()
+    main(args)
@@ -0,0 +1,36 @@
+# Copyright 2023 Quarkslab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import pytest
+
+# the server is run from its folder and imports lib as a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.service import Service
+from lib.slate import DType, Param, Slate
+
+
+@pytest.fixture
+def slate() -> Slate:
+    """A slate with a few fields after the header, the configuration is not shipped"""
+    service = Service("test_slate", "localhost", 6500, "sender", "receiver", 0)
+    params = [
+        Param("Value", DType.UINT32),
+        Param("Flag", DType.BOOL),
+        Param("Level", DType.INT16),
+        Param("Padding", DType.UINT8),
+    ]
+    return Slate(service, params)
@@ -0,0 +1,136 @@
+# Copyright 2023 Quarkslab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import threading
+import time
+import pytest
+import server
+from lib.api import Api, ApiError, TargetsApi
+from lib.injector import Injector
+from lib.sniffer import Sniffer
+from lib.storage import SlateStorage
+from lib.target import Target
+
+MESSAGE = [288, 0, 1, 0, 5, True, -1, 7]
+
+
+class FakeSend:
+    """Replaces Injector.send_message, the messages are sent once release is set"""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.sent = []
+        self.error = None
+
+    def __call__(self, service: str, message: tuple):
+        self.release.wait(5)
+        if self.error != None:
+            raise Exception(self.error)
+        self.sent.append((service, message))
+
+
+@pytest.fixture
+def send() -> FakeSend:
+    return FakeSend()
+
+
+@pytest.fixture
+def targets(slate, send):
+    """A single target, whose capture is never started"""
+    injector = Injector([slate])
+    injector.send_message = send
+    target = Target("dish1", host="localhost")
+    sniffer = Sniffer([slate], host="localhost")
+    store = SlateStorage([slate])
+    targets = TargetsApi(
+        [Api([slate.service], [slate], sniffer, store, injector, None, target)]
+    )
+    yield targets
+    send.release.set()
+    targets.close()
+
+
+@pytest.fixture
+def api(targets) -> Api:
+    return targets.default
+
+
+@pytest.fixture
+def client(targets):
+    return server.flask_app(targets).test_client()
+
+
+def inject(api: Api, send: FakeSend, finished: bool):
+    job = api.inject({"service": "test_slate", "message": MESSAGE})
+    if finished:
+        send.release.set()
+        job.future.result()
+    return job
+
+
+@pytest.mark.parametrize("finished", [False, True])
+def test_no_wait(api, send, finished):
+    job = inject(api, send, finished)
+    response = api.injection_response(job, False, {})
+    body = json.loads(response.body)
+    assert (body["id"], body["service"]) == (job.id, "test_slate")
+    if finished:
+        assert (response.status, body["status"]) == (200, "done")
+        assert "Location" not in response.headers
+    else:
+        assert response.status == 202
+        assert body["status"] in ("pending", "running")
+        assert response.headers["Location"] == f"/targets/dish1/inject/{job.id}"
+
+
+def test_wait(api, send):
+    job = inject(api, send, finished=True)
+    response = api.injection_response(job, True, {})
+    assert (response.status, response.body) == (200, b"")
+    assert send.sent == [("test_slate", tuple(MESSAGE))]
+
+    send.error = "Connection refused"
+    job = inject(api, send, finished=True)
+    with pytest.raises(ApiError) as error:
+        api.injection_response(job, True, {})
+    assert error.value.status == 400
+
+
+def test_route_no_wait(client, send):
+    data = {"service": "test_slate", "message": MESSAGE, "wait": False}
+    response = client.post("/targets/dish1/inject", json=data)
+    assert response.status_code == 202
+    job = response.get_json()
+    assert response.headers["Location"] == f"/targets/dish1/inject/{job['id']}"
+
+    send.release.set()
+    for _ in range(100):
+        job = client.get(response.headers["Location"]).get_json()
+        if job["status"] == "done":
+            break
+        time.sleep(0.05)
+    assert job["status"] == "done"
+
+    # already finished when the response is built
+    response = client.post("/targets/dish1/inject", json=data)
+    assert response.status_code in (200, 202)
+    assert response.get_json()["service"] == "test_slate"
+
+
+def test_route_wait(client, send):
+    send.release.set()
+    data = {"service": "test_slate", "message": MESSAGE}
+    response = client.post("/inject", json=data)
+    assert (response.status_code, response.data) == (200, b"")
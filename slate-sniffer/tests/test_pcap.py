@@ -0,0 +1,171 @@
+# Copyright 2023 Quarkslab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+import pytest
+from lib.pcap import (
+    LINKTYPE_ETHERNET,
+    PCAP_MAGIC,
+    PCAPNG_BLOCK_EPB,
+    PCAPNG_BLOCK_IDB,
+    PCAPNG_BLOCK_SHB,
+    PCAPNG_BLOCK_SPB,
+    PCAPNG_BYTE_ORDER_MAGIC,
+    PcapError,
+    PcapReader,
+)
+
+SOURCE = (0x7F000001, 40000)
+
+
+def udp_frame(port: int, payload: bytes, flags: int = 0) -> bytes:
+    """Ethernet frame of a UDP datagram sent by SOURCE"""
+    udp = struct.pack(">HHHH", SOURCE[1], port, 8 + len(payload), 0) + payload
+    ip = struct.pack(
+        ">BBHHHBBHII", 0x45, 0, 20 + len(udp), 0, flags, 64, 17, 0, SOURCE[0], 1
+    )
+    return bytes(12) + b"\x08\x00" + ip + udp
+
+
+def pcap(frames: list[bytes], linktype: int = LINKTYPE_ETHERNET) -> bytes:
+    data = struct.pack("<IHHiIII", PCAP_MAGIC, 2, 4, 0, 0, 65535, linktype)
+    for i, frame in enumerate(frames):
+        data += struct.pack("<IIII", 100 + i, 500000, len(frame), len(frame)) + frame
+    return data
+
+
+def pcapng_block(block_type: int, body: bytes) -> bytes:
+    body += bytes(-len(body) % 4)
+    size = 12 + len(body)
+    return struct.pack("<II", block_type, size) + body + struct.pack("<I", size)
+
+
+def pcapng(blocks: list[bytes]) -> bytes:
+    shb = struct.pack("<IHHq", PCAPNG_BYTE_ORDER_MAGIC, 1, 0, -1)
+    return pcapng_block(PCAPNG_BLOCK_SHB, shb) + b"".join(blocks)
+
+
+def idb(linktype: int = LINKTYPE_ETHERNET) -> bytes:
+    return pcapng_block(PCAPNG_BLOCK_IDB, struct.pack("<HHI", linktype, 0, 65535))
+
+
+def epb(frame: bytes, interface: int = 0, timestamp: int = 1500000) -> bytes:
+    high, low = timestamp >> 32, timestamp & 0xFFFFFFFF
+    header = struct.pack("<IIIII", interface, high, low, len(frame), len(frame))
+    return pcapng_block(PCAPNG_BLOCK_EPB, header + frame)
+
+
+def read_all(data: bytes, chunk: int = None) -> tuple[list, PcapReader]:
+    """Read a capture, chunk bytes at a time to split the records between reads"""
+    pos = 0
+
+    def read(size: int) -> bytes:
+        nonlocal pos
+        size = size if chunk == None else min(size, chunk)
+        pos += size
+        return data[pos - size : pos]
+
+    reader = PcapReader(read)
+    packets = [(t, src, port, bytes(payload)) for t, src, port, payload in reader]
+    return packets, reader
+
+
+@pytest.mark.parametrize("chunk", [None, 1, 7, 100])
+def test_pcap(chunk):
+    data = pcap([udp_frame(6500, b"first"), udp_frame(6501, b"second")])
+    packets, reader = read_all(data, chunk)
+    assert packets == [
+        (100.5, SOURCE, 6500, b"first"),
+        (101.5, SOURCE, 6501, b"second"),
+    ]
+    assert reader.malformed == 0
+
+
+def test_truncated_record():
+    data = pcap([udp_frame(6500, b"first"), udp_frame(6500, b"second")])
+    for cut in (1, 10, 20):
+        packets, _ = read_all(data[:-cut])
+        assert [payload for _, _, _, payload in packets] == [b"first"]
+
+
+def test_empty_capture():
+    assert read_all(b"")[0] == []
+
+
+def test_truncated_header():
+    with pytest.raises(PcapError):
+        read_all(pcap([])[:20])
+
+
+def test_invalid_magic():
+    with pytest.raises(PcapError):
+        read_all(b"\x00" * 24 + pcap([udp_frame(6500, b"first")])[24:])
+
+
+def test_unsupported_linktype():
+    packets, reader = read_all(pcap([udp_frame(6500, b"first")] * 3, linktype=999))
+    assert packets == []
+    assert reader.malformed == 3
+
+
+def test_ignored_frames():
+    frames = [
+        # truncated IP header, truncated UDP header, IP fragment
+        udp_frame(6500, b"x")[:30],
+        udp_frame(6500, b"x")[:36],
+        udp_frame(6500, b"x", flags=0x2000),
+        b"",
+        udp_frame(6500, b"kept"),
+    ]
+    packets, reader = read_all(pcap(frames))
+    assert [payload for _, _, _, payload in packets] == [b"kept"]
+    assert reader.malformed == 0
+
+
+def test_udp_length_is_bounded_by_the_frame():
+    frame = bytearray(udp_frame(6500, b"payload"))
+    # UDP length bigger than what was captured
+    frame[38:40] = (1000).to_bytes(2, "big")
+    packets, _ = read_all(pcap([bytes(frame)]))
+    assert packets[0][3] == b"payload"
+
+
+@pytest.mark.parametrize("chunk", [None, 3])
+def test_pcapng(chunk):
+    data = pcapng([idb(), epb(udp_frame(6500, b"first"))])
+    packets, reader = read_all(data, chunk)
+    assert packets == [(1.5, SOURCE, 6500, b"first")]
+    assert reader.malformed == 0
+
+
+def test_pcapng_unknown_interface():
+    blocks = [
+        pcapng_block(PCAPNG_BLOCK_SPB, struct.pack("<I", 0) + udp_frame(6500, b"x")),
+        idb(),
+        epb(udp_frame(6500, b"lost"), interface=1),
+        epb(udp_frame(6500, b"kept")),
+    ]
+    packets, reader = read_all(pcapng(blocks))
+    assert [payload for _, _, _, payload in packets] == [b"kept"]
+    assert reader.malformed == 2
+
+
+def test_pcapng_truncated_block():
+    data = pcapng([idb(), epb(udp_frame(6500, b"first")), epb(udp_frame(6500, b"x"))])
+    packets, _ = read_all(data[:-8])
+    assert [payload for _, _, _, payload in packets] == [b"first"]
+
+    # a block shorter than its header ends the capture
+    data = pcapng([idb(), struct.pack("<II", PCAPNG_BLOCK_EPB, 4) + bytes(8)])
+    assert read_all(data)[0] == []
@@ -0,0 +1,111 @@
+# Copyright 2023 Quarkslab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+from lib.reassembly import Reassembler
+from lib.slate import Slate
+
+A = (1, 40000)
+B = (2, 40000)
+
+
+def message(slate: Slate, seq: int, value: int = 0) -> bytes:
+    return slate.pack_message((288, 0, seq, 0, value, True, -1, 7))
+
+
+def fragments(slate: Slate, data: bytes, cut: int) -> tuple[bytes, bytes]:
+    """Split a message in two datagrams, the second one repeating the header"""
+    header_size = slate.message_parser.header_struct.size
+    return data[:cut], data[:header_size] + data[cut:]
+
+
+def push(reassembler: Reassembler, slate: Slate, timestamp: float, src, payload):
+    result = reassembler.push(slate, timestamp, src, memoryview(payload))
+    return None if result == None else bytes(result)
+
+
+def test_complete_datagram(slate):
+    reassembler = Reassembler()
+    data = message(slate, 1)
+    assert push(reassembler, slate, 0.0, A, data) == data
+    assert reassembler.stats()["pending"] == 0
+
+
+def test_fragments(slate):
+    reassembler = Reassembler()
+    data = message(slate, 1, 1234)
+    first, second = fragments(slate, data, 25)
+    assert push(reassembler, slate, 0.0, A, first) == None
+    assert reassembler.stats()["memory"] == len(data)
+    assert push(reassembler, slate, 0.1, A, second) == data
+    stats = reassembler.stats()
+    assert (stats["pending"], stats["memory"], stats["completed"]) == (0, 0, 1)
+
+
+def test_interleaved_senders(slate):
+    reassembler = Reassembler()
+    # same Seq from two sources, and two messages of the same source
+    a1, b1, a2 = message(slate, 1, 1), message(slate, 1, 2), message(slate, 2, 3)
+    a1_first, a1_second = fragments(slate, a1, 22)
+    b1_first, b1_second = fragments(slate, b1, 28)
+    a2_first, a2_second = fragments(slate, a2, 30)
+    results = [
+        push(reassembler, slate, 0.0, A, a1_first),
+        push(reassembler, slate, 0.0, B, b1_first),
+        push(reassembler, slate, 0.0, A, a2_first),
+        push(reassembler, slate, 0.0, B, b1_second),
+        push(reassembler, slate, 0.0, A, a2_second),
+        push(reassembler, slate, 0.0, A, a1_second),
+    ]
+    assert [r for r in results if r != None] == [b1, a2, a1]
+
+
+def test_timeout(slate):
+    reassembler = Reassembler(timeout=1.0)
+    first, second = fragments(slate, message(slate, 1), 25)
+    push(reassembler, slate, 0.0, A, first)
+    # still pending at the timeout
+    push(reassembler, slate, 1.0, A, message(slate, 2))
+    assert reassembler.stats()["pending"] == 1
+
+    push(reassembler, slate, 1.5, A, message(slate, 3))
+    stats = reassembler.stats()
+    assert (stats["pending"], stats["memory"]) == (0, 0)
+    assert (stats["expired"], stats["dropped_fragments"]) == (1, 1)
+    # the end of the expired message starts a new partial message
+    assert push(reassembler, slate, 1.6, A, second) == None
+    assert reassembler.stats()["pending"] == 1
+
+
+def test_memory_cap(slate):
+    size = slate.message_parser.struct.size
+    reassembler = Reassembler(max_memory=2 * size)
+    parts = [fragments(slate, message(slate, seq, seq), 25) for seq in range(3)]
+    for first, _ in parts:
+        push(reassembler, slate, 0.0, A, first)
+    stats = reassembler.stats()
+    assert (stats["pending"], stats["memory"], stats["evicted"]) == (2, 2 * size, 1)
+
+    # the oldest message was evicted, the others can still be completed
+    assert push(reassembler, slate, 0.0, A, parts[0][1]) == None
+    assert push(reassembler, slate, 0.0, A, parts[2][1]) == message(slate, 2, 2)
+    assert reassembler.stats()["memory"] <= 2 * size
+
+
+@pytest.mark.parametrize("size", [0, 1, 19])
+def test_short_datagram(slate, size):
+    reassembler = Reassembler()
+    assert push(reassembler, slate, 0.0, A, message(slate, 1)[:size]) == None
+    stats = reassembler.stats()
+    assert (stats["pending"], stats["dropped_fragments"]) == (0, 1)
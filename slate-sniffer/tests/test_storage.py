@@ -0,0 +1,106 @@
+# Copyright 2023 Quarkslab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+from lib import storage
+from lib.slate import Slate
+from lib.storage import ColumnarSlateStore, SingleSlateStore
+
+CAPACITY = 20
+
+
+def make_messages(slate: Slate, first: int, count: int) -> list[tuple]:
+    """Messages where some fields change at every message and others rarely do"""
+    message_class = slate.message_parser.message_class
+    return [
+        message_class(288, 0, i, i // 7, i % 3, i % 5 == 0, -(i // 4), 1)
+        for i in range(first, first + count)
+    ]
+
+
+@pytest.fixture
+def stores(slate, monkeypatch) -> dict:
+    # several blocks, the last one being smaller, and keyframes wrapping around
+    monkeypatch.setattr(storage, "COLUMN_BLOCK_SIZE", 8)
+    monkeypatch.setattr(storage, "KEYFRAME_INTERVAL", 6)
+    return {
+        "plain": SingleSlateStore(slate, CAPACITY),
+        "delta": SingleSlateStore(slate, CAPACITY, delta=True),
+        "columnar": ColumnarSlateStore(slate, CAPACITY),
+    }
+
+
+def insert(stores: dict, messages: list) -> int:
+    first_ids = {store.insert_many(messages) for store in stores.values()}
+    assert len(first_ids) == 1
+    return first_ids.pop()
+
+
+def check_parity(stores: dict, expected: list):
+    """expected is the list of (id, message) kept by the stores"""
+    end = expected[-1][0] + 1 if len(expected) > 0 else 0
+    last_ids = [None, -5, -1, 0, end - 25, end - 10, end - 2, end - 1, end, end + 3]
+    for last_id in last_ids:
+        kept = [m for m in expected if last_id == None or m[0] > last_id]
+        for name, store in stores.items():
+            messages = store.get_messages(last_id)
+            assert [(i, tuple(m)) for i, m in messages] == kept, (name, last_id)
+
+        deltas = {name: store.get_deltas(last_id) for name, store in stores.items()}
+        assert deltas["delta"] == deltas["plain"], last_id
+        assert deltas["columnar"] == deltas["plain"], last_id
+        assert [i for i, _ in deltas["plain"]] == [i for i, _ in kept]
+
+
+def test_empty(stores):
+    for store in stores.values():
+        for last_id in (None, -1, 0, 5):
+            assert store.get_messages(last_id) == []
+            assert store.get_deltas(last_id) == []
+        start, columns = store.get_columns()
+        assert start == 0
+        assert all(len(column) == 0 for column in columns.values())
+
+
+def test_parity(stores, slate):
+    expected = []
+    for count in (1, 5, 3, 12, 1, 9, 20, 2):
+        messages = make_messages(slate, len(expected), count)
+        first_id = insert(stores, messages)
+        assert first_id == len(expected)
+        expected += [(first_id + i, tuple(m)) for i, m in enumerate(messages)]
+        check_parity(stores, expected[-CAPACITY:])
+
+
+def test_deltas(stores, slate):
+    insert(stores, make_messages(slate, 0, 10))
+    for store in stores.values():
+        deltas = store.get_deltas(4)
+        # the first message only has the fields that changed since message 4
+        assert deltas[0] == (5, {"Seq": 5, "Value": 2, "Flag": True})
+        assert deltas[1] == (6, {"Seq": 6, "Value": 0, "Flag": False})
+        # without last_id, the first message is complete
+        fields = slate.message_parser.message_class._fields
+        assert set(store.get_deltas()[0][1]) == set(fields)
+
+
+def test_batch_bigger_than_capacity(stores, slate):
+    insert(stores, make_messages(slate, 0, 3))
+    messages = make_messages(slate, 3, 2 * CAPACITY + 5)
+    assert insert(stores, messages) == 3
+    # message i of the batch has id 3 + i, only the end of the batch is kept
+    expected = [(3 + i, tuple(m)) for i, m in enumerate(messages)][-CAPACITY:]
+    check_parity(stores, expected)
+    for store in stores.values():
+        assert (store.first_msg_id, store.current_msg_id) == (expected[0][0], 48)
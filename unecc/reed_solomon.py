@@ -0,0 +1,215 @@
+# Copyright 2023 Quarkslab
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Table-driven Reed-Solomon decoder over GF(2^8) using the same conventions
+# as the rscode library (primitive polynomial 0x11d, generator roots a^1..a^NPAR,
+# parity bytes appended after the message, first byte is the highest degree)
+from functools import lru_cache
+
+# NumPy is optional, it makes the bulk syndrome check about ten times faster
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+NPAR = 32
+GF_PRIMITIVE = 0x11D
+GF_SIZE = 255
+
+GF_EXP = [0] * (2 * GF_SIZE)
+GF_LOG = [0] * (GF_SIZE + 1)
+
+_x = 1
+for _i in range(GF_SIZE):
+    GF_EXP[_i] = _x
+    GF_LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= GF_PRIMITIVE
+for _i in range(GF_SIZE, 2 * GF_SIZE):
+    GF_EXP[_i] = GF_EXP[_i - GF_SIZE]
+
+# MUL_TABLES[k] maps every byte x to x * a^k, it can be used with bytes.translate
+# to multiply a whole buffer by a constant at once
+MUL_TABLES = [
+    bytes([0] + [GF_EXP[GF_LOG[x] + k] for x in range(1, 256)]) for k in range(GF_SIZE)
+]
+
+
+class ReedSolomonError(Exception):
+    pass
+
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+
+def gf_div(a, b):
+    if b == 0:
+        raise ZeroDivisionError()
+    if a == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_SIZE - GF_LOG[b]]
+
+
+def poly_eval(poly, x):
+    """Evaluate a polynomial, stored lowest degree first, in x"""
+    y = 0
+    for coef in reversed(poly):
+        y = gf_mul(y, x) ^ coef
+    return y
+
+
+def syndromes(codeword, nsym=NPAR):
+    """Return the syndromes S_j = c(a^(j + 1)), they are all zero if there are no errors"""
+    synd = []
+    for j in range(nsym):
+        alpha = GF_EXP[j + 1]
+        s = 0
+        for byte in codeword:
+            s = gf_mul(s, alpha) ^ byte
+        synd.append(s)
+    return synd
+
+
+def find_bad_codewords(data, n, count, nsym=NPAR):
+    """
+    Return the indexes of the codewords with non-zero syndromes among the `count`
+    codewords of length `n` stored one after the other in `data`.
+
+    The syndromes of all the codewords are computed together: column i of the
+    codewords is multiplied by a^((j + 1) * (n - 1 - i)) with a translation table
+    and the columns are xored together as big integers
+    """
+    if np is not None:
+        return find_bad_codewords_numpy(data, n, count, nsym)
+
+    columns = [data[i : n * count : n] for i in range(n)]
+    bad = 0
+    for j in range(nsym):
+        acc = 0
+        for i, column in enumerate(columns):
+            table = MUL_TABLES[((j + 1) * (n - 1 - i)) % GF_SIZE]
+            acc ^= int.from_bytes(column.translate(table), "big")
+        bad |= acc
+
+    if bad == 0:
+        return []
+    return [i for i, s in enumerate(bad.to_bytes(count, "big")) if s != 0]
+
+
+@lru_cache
+def syndrome_tables(n, nsym):
+    """
+    tables[i][x] is the contribution of the byte x at index i of a codeword of length n
+    to its nsym syndromes, packed in 64-bit words so that they are xored together
+    """
+    # the exponents are reduced first, so that the sums stay within GF_EXP
+    exponents = np.arange(1, nsym + 1) * np.arange(n - 1, -1, -1)[:, None] % GF_SIZE
+    log = np.array(GF_LOG, np.int32)
+    tables = np.array(GF_EXP, np.uint8)[log[:, None] + exponents[:, None, :]]
+    tables[:, 0] = 0
+    words = (nsym + 7) // 8
+    packed = np.zeros((n, 256, words * 8), np.uint8)
+    packed[:, :, :nsym] = tables
+    return packed.view(np.uint64)
+
+
+def find_bad_codewords_numpy(data, n, count, nsym=NPAR):
+    """
+    Same as find_bad_codewords, the syndromes are the xor of one table lookup per
+    column of the codewords
+    """
+    tables = syndrome_tables(n, nsym)
+    columns = np.frombuffer(data, np.uint8, n * count).reshape(count, n).T.copy()
+    synd = np.zeros((count, tables.shape[2]), np.uint64)
+    for i in range(n):
+        np.bitwise_xor(synd, tables[i].take(columns[i], axis=0), out=synd)
+    return np.flatnonzero(synd.any(axis=1)).tolist()
+
+
+def correct_codeword(codeword, nsym=NPAR):
+    """
+    Correct up to nsym / 2 errors in a codeword, using Berlekamp-Massey to find the
+    error locator, a Chien search to find the error positions and Forney's algorithm
+    to compute their values.
+    Returns the corrected codeword and the number of corrected bytes, raises a
+    ReedSolomonError if the codeword cannot be corrected
+    """
+    synd = syndromes(codeword, nsym)
+    if not any(synd):
+        return bytes(codeword), 0
+
+    # Berlekamp-Massey, polynomials are stored lowest degree first
+    err_loc = [1]
+    prev_loc = [1]
+    length = 0
+    shift = 1
+    prev_delta = 1
+    for k in range(nsym):
+        delta = synd[k]
+        for i in range(1, length + 1):
+            delta ^= gf_mul(err_loc[i], synd[k - i])
+        if delta == 0:
+            shift += 1
+            continue
+
+        scale = gf_div(delta, prev_delta)
+        update = [0] * shift + [gf_mul(scale, c) for c in prev_loc]
+        new_loc = err_loc + [0] * max(0, len(update) - len(err_loc))
+        for i, c in enumerate(update):
+            new_loc[i] ^= c
+
+        if 2 * length <= k:
+            prev_loc = err_loc
+            prev_delta = delta
+            length = k + 1 - length
+            shift = 1
+        else:
+            shift += 1
+        err_loc = new_loc
+
+    err_loc = err_loc[: length + 1]
+    if 2 * length > nsym:
+        raise ReedSolomonError("Too many errors to correct")
+
+    # Chien search, an error at degree p is a root a^-p of the locator
+    n = len(codeword)
+    positions = [
+        p for p in range(n) if poly_eval(err_loc, GF_EXP[(GF_SIZE - p) % GF_SIZE]) == 0
+    ]
+    if len(positions) != length:
+        raise ReedSolomonError("Could not locate the errors")
+
+    # Forney, with the first consecutive root being a^1 the error value is
+    # omega(X^-1) / err_loc'(X^-1)
+    omega = [0] * nsym
+    for i, c in enumerate(err_loc):
+        for j in range(nsym - i):
+            omega[i + j] ^= gf_mul(c, synd[j])
+    derivative = [c if i % 2 == 0 else 0 for i, c in enumerate(err_loc[1:])]
+
+    corrected = bytearray(codeword)
+    for p in positions:
+        x_inv = GF_EXP[(GF_SIZE - p) % GF_SIZE]
+        value = gf_div(poly_eval(omega, x_inv), poly_eval(derivative, x_inv))
+        corrected[n - 1 - p] ^= value
+
+    if any(syndromes(corrected, nsym)):
+        raise ReedSolomonError("Could not correct the errors")
+
+    return bytes(corrected), length
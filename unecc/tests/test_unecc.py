@@ -0,0 +1,210 @@
+# Copyright 2023 Quarkslab
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import hashlib
+import random
+import pytest
+import unecc
+from reed_solomon import NPAR, GF_EXP, ReedSolomonError, gf_mul, correct_codeword
+from unecc import (
+    ECC_BLOCK_SIZE,
+    ECC_BLOCK_TYPE_INDEX,
+    ECC_DAT_SIZE,
+    ECC_FIRST_DAT_SIZE,
+    ECC_FILE_MAGIC,
+    ECC_FILE_VERSION,
+    EccReader,
+    InvalidImageError,
+)
+
+# generator polynomial of the code, highest degree first
+GENERATOR = [1]
+for i in range(1, NPAR + 1):
+    GENERATOR = [
+        a ^ gf_mul(b, GF_EXP[i]) for a, b in zip(GENERATOR + [0], [0] + GENERATOR)
+    ]
+
+
+def encode(message):
+    """Append the parity bytes to a message, as the ecc binary does"""
+    remainder = list(message) + [0] * NPAR
+    for i in range(len(message)):
+        coef = remainder[i]
+        if coef != 0:
+            for j in range(1, len(GENERATOR)):
+                remainder[i + j] ^= gf_mul(GENERATOR[j], coef)
+    return bytes(message) + bytes(remainder[len(message) :])
+
+
+def make_image(payload):
+    """Protect a payload with the layout of unecc.py: blocks, then the footer"""
+    first = ECC_FILE_MAGIC + ECC_FILE_VERSION + payload[:ECC_FIRST_DAT_SIZE]
+    rest = payload[ECC_FIRST_DAT_SIZE:]
+    chunks = [first] + [
+        rest[i : i + ECC_DAT_SIZE] for i in range(0, len(rest), ECC_DAT_SIZE)
+    ]
+    image = bytearray()
+    for index, chunk in enumerate(chunks):
+        block_type = b"$" if index == len(chunks) - 1 else b"*"
+        image += encode(chunk.ljust(ECC_BLOCK_TYPE_INDEX, b"\0") + block_type)
+    footer = b"!" + len(payload).to_bytes(4, "big") + hashlib.md5(payload).digest()
+    return image + encode(footer)
+
+
+def corrupt(image, block, positions):
+    for position in positions:
+        image[block * ECC_BLOCK_SIZE + position] ^= 0x5A
+
+
+@pytest.fixture
+def payload():
+    return random.Random(0).randbytes(20000)
+
+
+@pytest.fixture
+def image(payload):
+    return make_image(payload)
+
+
+def run(tmp_path, image, correct=True, jobs=1):
+    input_file = tmp_path / "image.ecc"
+    output_file = tmp_path / "image.out"
+    input_file.write_bytes(image)
+    report = unecc.unecc(str(input_file), str(output_file), correct, jobs)
+    return report, output_file.read_bytes()
+
+
+def test_strip(tmp_path, image, payload):
+    report, output = run(tmp_path, image, correct=False)
+    assert report is None
+    assert output == payload
+
+
+def test_clean_image(tmp_path, image, payload):
+    report, output = run(tmp_path, image)
+    assert (report.corrected, report.failed, report.md5_ok) == (0, 0, True)
+    assert output == payload
+
+
+def test_correction_limit():
+    codeword = encode(bytes(range(ECC_BLOCK_SIZE - NPAR)))
+    corrupted = bytearray(codeword)
+    for position in random.Random(1).sample(range(ECC_BLOCK_SIZE), NPAR // 2 + 1):
+        corrupted[position] ^= 0xFF
+    with pytest.raises(ReedSolomonError):
+        correct_codeword(corrupted)
+
+    corrupted = bytearray(codeword)
+    for position in random.Random(1).sample(range(ECC_BLOCK_SIZE), NPAR // 2):
+        corrupted[position] ^= 0xFF
+    assert correct_codeword(corrupted) == (codeword, NPAR // 2)
+
+
+def test_correct_blocks(tmp_path, image, payload):
+    blocks = len(image) // ECC_BLOCK_SIZE
+    # the first block, a data block, the last block and the footer
+    for block in (0, 10, blocks - 1, blocks):
+        corrupt(image, block, range(0, NPAR, 2))
+    report, output = run(tmp_path, image)
+    assert (report.corrected, report.failed, report.md5_ok) == (4, 0, True)
+    assert output == payload
+
+
+def test_uncorrectable_block(tmp_path, image, payload):
+    corrupt(image, 10, range(NPAR // 2 + 1))
+    report, output = run(tmp_path, image)
+    assert (report.corrected, report.failed, report.md5_ok) == (0, 1, False)
+    assert len(output) == len(payload)
+
+
+def test_parallel(tmp_path, payload, monkeypatch):
+    monkeypatch.setattr(unecc, "CHUNK_BLOCKS", 16)
+    image = make_image(payload)
+    corrupt(image, 3, range(NPAR // 2))
+    corrupt(image, 40, range(NPAR // 2 + 1))
+    serial, serial_output = run(tmp_path, image)
+    parallel, parallel_output = run(tmp_path, image, jobs=4)
+    assert (parallel.corrected, parallel.failed) == (serial.corrected, serial.failed)
+    assert (parallel.corrected, parallel.failed) == (1, 1)
+    assert parallel_output == serial_output
+
+
+def test_data_block_marked_last(tmp_path, image, payload):
+    image[10 * ECC_BLOCK_SIZE + ECC_BLOCK_TYPE_INDEX] = ord("$")
+    report, output = run(tmp_path, image)
+    assert (report.corrected, report.failed, report.md5_ok) == (1, 0, True)
+    assert output == payload
+
+
+def test_uncorrectable_footer(tmp_path, image, payload):
+    blocks = len(image) // ECC_BLOCK_SIZE
+    # the type byte of the footer is intact, its size and MD5 are not
+    corrupt(image, blocks, range(1, NPAR + 8))
+    report, _ = run(tmp_path, image)
+    assert report.failed == 1
+    assert report.md5_ok == False
+
+
+def test_uncorrectable_last_block(tmp_path, image, payload):
+    blocks = len(image) // ECC_BLOCK_SIZE
+    corrupt(image, blocks - 1, range(NPAR // 2 + 1))
+    report, output = run(tmp_path, image)
+    assert (report.corrected, report.failed, report.md5_ok) == (0, 1, False)
+    assert len(output) == len(payload)
+
+
+def test_uncorrectable_block_marked_last(tmp_path, image, payload):
+    # not followed by a footer, so it is still handled as a data block
+    corrupt(image, 10, range(NPAR // 2 + 1))
+    image[10 * ECC_BLOCK_SIZE + ECC_BLOCK_TYPE_INDEX] = ord("$")
+    report, output = run(tmp_path, image)
+    assert (report.corrected, report.failed, report.md5_ok) == (0, 1, False)
+    assert len(output) == len(payload)
+
+
+def test_reader(image, payload, tmp_path):
+    path = tmp_path / "image.ecc"
+    path.write_bytes(image)
+    with EccReader(str(path)) as reader:
+        reader.seek(5000)
+        assert reader.read(1000) == payload[5000:6000]
+        reader.seek(-10, 2)
+        assert reader.read() == payload[-10:]
+
+
+def test_empty_file(tmp_path):
+    path = tmp_path / "empty.ecc"
+    path.write_bytes(b"")
+    with open(path, "rb") as file:
+        with pytest.raises(InvalidImageError):
+            EccReader(file)
+        assert not file.closed
+    with pytest.raises(InvalidImageError):
+        unecc.unecc(str(path), str(tmp_path / "empty.out"), True)
+
+
+def test_invalid_layout_closes_file(tmp_path, monkeypatch):
+    path = tmp_path / "invalid.ecc"
+    path.write_bytes(b"*" * ECC_BLOCK_SIZE)
+    files = []
+
+    def record_open(*args):
+        files.append(open(*args))
+        return files[-1]
+
+    monkeypatch.setattr(unecc, "open", record_open, raising=False)
+    with pytest.raises(AssertionError):
+        EccReader(str(path))
+    assert files[0].closed
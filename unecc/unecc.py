@@ -14,9 +14,16 @@
 
 
 # This script removes ECC data from a file
-# (without checking for errors)
+# (optionally correcting errors with the parity bytes)
+import io
+import os
 import sys
+import mmap
+import hashlib
 import argparse
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from reed_solomon import ReedSolomonError, find_bad_codewords, correct_codeword
 
 NPAR = 32
 ECC_BLOCK_SIZE = 255
@@ -35,27 +42,338 @@ ECC_BLOCK_TYPE_FOOTER = ord("!")
 ECC_BLOCK_TYPE_INDEX = ECC_BLOCK_SIZE - NPAR - 1
 
 
-def unecc(input_file, output_file):
+# Number of blocks stripped in a single bulk pass (about 1 MiB of input)
+CHUNK_BLOCKS = 4096
+
+
+class InvalidImageError(Exception):
+    pass
+
+
+class EccReport:
+    """Number of blocks that were corrected or could not be corrected, and MD5 check result"""
+
+    def __init__(self):
+        self.corrected = 0
+        self.failed = 0
+        self.md5_ok = None
+        # indexes of the blocks already counted, a block read again is not counted twice
+        self.corrected_blocks = set()
+        self.failed_blocks = set()
+
+    def add(self, index, corrected):
+        if index in self.corrected_blocks or index in self.failed_blocks:
+            return
+        if corrected:
+            self.corrected_blocks.add(index)
+            self.corrected += 1
+        else:
+            self.failed_blocks.add(index)
+            self.failed += 1
+
+    def merge(self, other):
+        for index in other.corrected_blocks:
+            self.add(index, True)
+        for index in other.failed_blocks:
+            self.add(index, False)
+
+    def __str__(self):
+        md5 = {None: "not checked", True: "OK", False: "MISMATCH"}[self.md5_ok]
+        return f"{self.corrected} blocks corrected, {self.failed} blocks could not be corrected, MD5: {md5}"
+
+
+class EccReader(io.RawIOBase):
+    """
+    Read-only, seekable file-like object giving access to the payload of an ECC file
+    without writing it to disk. The payload is decoded CHUNK_BLOCKS blocks at a time
+    and the last decoded chunk is kept, so sequential reads never decode a block twice.
+    If correct is True, errors are corrected and counted in self.report.
+    InvalidImageError is raised if the file is empty
+    """
+
+    def __init__(self, input_file, correct=False):
+        super().__init__()
+        self._owns_file = isinstance(input_file, (str, bytes, os.PathLike))
+        self._file = open(input_file, "rb") if self._owns_file else input_file
+        self._data = None
+        self._pos = 0
+        self._chunk_index = None
+        self._chunk = b""
+        try:
+            if os.fstat(self._file.fileno()).st_size == 0:
+                # mmap cannot map an empty file
+                raise InvalidImageError("Invalid ECC image: the file is empty")
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.report = EccReport() if correct else None
+            self.blocks, self.payload_size, self.payload_md5 = parse_layout(
+                self._data, self.report
+            )
+        except BaseException:
+            self.close()
+            raise
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.payload_size
+        elif whence != io.SEEK_SET:
+            raise ValueError(f"Invalid whence: {whence}")
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, buffer):
+        with memoryview(buffer) as view, view.cast("B") as out:
+            written = 0
+            while written < len(out) and self._pos < self.payload_size:
+                # the block containing the position is found arithmetically
+                index = block_index(self._pos) // CHUNK_BLOCKS
+                chunk = self.read_chunk(index)
+                offset = self._pos - payload_offset(index * CHUNK_BLOCKS)
+                size = min(len(out) - written, len(chunk) - offset)
+                out[written : written + size] = chunk[offset : offset + size]
+                written += size
+                self._pos += size
+        return written
+
+    def read_chunk(self, index):
+        """Return the payload contained in the chunk of blocks with the given index"""
+        if index != self._chunk_index:
+            start = index * CHUNK_BLOCKS
+            stop = min(start + CHUNK_BLOCKS, self.blocks)
+            self._chunk = strip_blocks(
+                self._data, start, stop, self.payload_size, self.report
+            )
+            self._chunk_index = index
+        return self._chunk
+
+    def chunks(self):
+        """Yield the whole payload chunk by chunk, from the beginning"""
+        for index in range((self.blocks + CHUNK_BLOCKS - 1) // CHUNK_BLOCKS):
+            yield self.read_chunk(index)
+
+    def close(self):
+        if not self.closed:
+            self._chunk = b""
+            if self._data is not None:
+                self._data.close()
+            if self._owns_file:
+                self._file.close()
+        super().close()
+
+
+def iter_unecc(input_file, correct=False):
+    """Yield the payload of an ECC file (a path or a binary file) chunk by chunk"""
+    with EccReader(input_file, correct) as reader:
+        yield from reader.chunks()
+
+
+def unecc(input_file, output_file, correct=False, jobs=1):
+    if jobs > 1 and not isinstance(input_file, (str, bytes, os.PathLike)):
+        raise ValueError("The input file must be a path when jobs > 1")
+    with EccReader(input_file, correct) as reader:
+        if jobs > 1:
+            unecc_parallel(
+                input_file,
+                output_file,
+                reader.blocks,
+                reader.payload_size,
+                reader.report,
+                jobs,
+            )
+        else:
+            with open(output_file, "wb") as file_out:
+                for chunk in reader.chunks():
+                    file_out.write(chunk)
+
+    if correct:
+        with open(output_file, "rb") as file_out:
+            digest = hashlib.file_digest(file_out, "md5").digest()
+        reader.report.md5_ok = digest == reader.payload_md5
+    return reader.report
+
+
+def unecc_parallel(input_file, output_file, blocks, payload_size, report, jobs):
+    """
+    Hand ranges of blocks to a pool of processes, every range is stripped (and
+    corrected) independently and written at its own offset in the output file
+    """
+    with open(output_file, "wb") as file_out:
+        file_out.truncate(payload_size)
+
+    starts = range(0, blocks, CHUNK_BLOCKS)
+    stops = [min(start + CHUNK_BLOCKS, blocks) for start in starts]
+    with ProcessPoolExecutor(jobs) as pool:
+        results = pool.map(
+            unecc_range,
+            repeat(input_file),
+            repeat(output_file),
+            starts,
+            stops,
+            repeat(payload_size),
+            repeat(report is not None),
+        )
+        for result in results:
+            if report is not None:
+                report.merge(result)
+
+
+def unecc_range(input_file, output_file, start, stop, payload_size, correct):
+    """Strip the blocks [start, stop) and write them in the preallocated output file"""
+    report = EccReport() if correct else None
     with open(input_file, "rb") as file_in:
-        with open(output_file, "wb") as file_out:
-            size = 0
-            # read the first block
-            block = file_in.read(ECC_BLOCK_SIZE)
-            file_out.write(handle_first_block(block))
-            size += ECC_FIRST_DAT_SIZE
-
-            # read blocks until we reach the last one
-            while block[ECC_BLOCK_TYPE_INDEX] == ECC_BLOCK_TYPE_DATA:
-                block = file_in.read(ECC_BLOCK_SIZE)
-                # if it's the last block, read the footer to compute the padding length
-                if block[ECC_BLOCK_TYPE_INDEX] == ECC_BLOCK_TYPE_LAST:
-                    footer = file_in.read(ECC_FILE_FOOTER_LEN)
-                    payload_size = int.from_bytes(footer[1:5], "big")
-                    last_block_size = payload_size - size
-                    file_out.write(handle_block(block)[:last_block_size])
-                else:
-                    file_out.write(handle_block(block))
-                    size += ECC_DAT_SIZE
+        with mmap.mmap(file_in.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            chunk = strip_blocks(data, start, stop, payload_size, report)
+
+    fd = os.open(output_file, os.O_WRONLY)
+    try:
+        os.pwrite(fd, chunk, payload_offset(start))
+    finally:
+        os.close(fd)
+    return report
+
+
+def parse_layout(data, report=None):
+    """
+    Find the last block of the file and read the payload size and MD5 from the footer
+    that follows it, returns (number of blocks, payload size, payload MD5).
+    If a report is given, the type bytes and the footer are corrected when needed
+    """
+    if report is None:
+        assert data[:ECC_FILE_HEADER_LEN] == ECC_FILE_MAGIC + ECC_FILE_VERSION
+
+    # the type bytes of all the blocks, every block before the last one is a data block
+    types = data[ECC_BLOCK_TYPE_INDEX::ECC_BLOCK_SIZE]
+    last = 0
+    while True:
+        last = len(types) - len(types[last:].lstrip(bytes([ECC_BLOCK_TYPE_DATA])))
+        assert last < len(types)
+        block_type = types[last]
+        if report is not None:
+            block_type = check_block_type(data, last, report)
+        if block_type == ECC_BLOCK_TYPE_LAST:
+            break
+        assert block_type == ECC_BLOCK_TYPE_DATA
+        last += 1
+
+    footer = read_footer(data, last)
+    assert len(footer) == ECC_FILE_FOOTER_LEN
+    if report is not None:
+        try:
+            footer, errors = correct_codeword(footer)
+            if errors > 0:
+                report.add(last + 1, True)
+        except ReedSolomonError:
+            report.add(last + 1, False)
+    assert footer[0] == ECC_BLOCK_TYPE_FOOTER
+    payload_size = int.from_bytes(footer[1:5], "big")
+    payload_md5 = footer[5 : 5 + ECC_MD5_LEN]
+
+    return last + 1, payload_size, payload_md5
+
+
+def read_footer(data, last):
+    """Return the bytes of the footer following the block with index last"""
+    offset = (last + 1) * ECC_BLOCK_SIZE
+    return data[offset : offset + ECC_FILE_FOOTER_LEN]
+
+
+def check_block_type(data, index, report):
+    """
+    Return the type of a block whose type byte is not the one of a data block, read
+    from the corrected block. A block that cannot be corrected is only taken as the
+    last one if a valid footer follows it, it is handled as data otherwise
+    """
+    offset = index * ECC_BLOCK_SIZE
+    try:
+        block, _ = correct_codeword(data[offset : offset + ECC_BLOCK_SIZE])
+        return block[ECC_BLOCK_TYPE_INDEX]
+    except ReedSolomonError:
+        report.add(index, False)
+    if data[offset + ECC_BLOCK_TYPE_INDEX] == ECC_BLOCK_TYPE_LAST:
+        try:
+            footer, _ = correct_codeword(read_footer(data, index))
+            if footer[0] == ECC_BLOCK_TYPE_FOOTER:
+                return ECC_BLOCK_TYPE_LAST
+        except ReedSolomonError:
+            pass
+    return ECC_BLOCK_TYPE_DATA
+
+
+def block_index(offset):
+    """Index of the block containing the given offset of the payload"""
+    if offset < ECC_FIRST_DAT_SIZE:
+        return 0
+    return 1 + (offset - ECC_FIRST_DAT_SIZE) // ECC_DAT_SIZE
+
+
+def payload_offset(index):
+    """Offset in the payload of the data contained in the block with the given index"""
+    if index == 0:
+        return 0
+    return ECC_FIRST_DAT_SIZE + (index - 1) * ECC_DAT_SIZE
+
+
+def correct_blocks(blocks, start, count, report):
+    """
+    Correct the blocks [start, start + count) whose syndromes are not all zero,
+    clean blocks are only checked in bulk and are never decoded one by one
+    """
+    bad = find_bad_codewords(blocks, ECC_BLOCK_SIZE, count)
+    if len(bad) == 0:
+        return blocks
+
+    blocks = bytearray(blocks)
+    for index in bad:
+        offset = index * ECC_BLOCK_SIZE
+        try:
+            block, _ = correct_codeword(blocks[offset : offset + ECC_BLOCK_SIZE])
+            blocks[offset : offset + ECC_BLOCK_SIZE] = block
+            report.add(start + index, True)
+        except ReedSolomonError:
+            report.add(start + index, False)
+    return blocks
+
+
+def strip_blocks(data, start, stop, payload_size, report=None):
+    """
+    Return the payload contained in the blocks [start, stop), the blocks are seen
+    as the rows of a (stop - start) x ECC_BLOCK_SIZE matrix and the data columns are
+    copied with strided slices, so that no Python code runs for each block.
+    If a report is given, errors are corrected before stripping the blocks
+    """
+    out = bytearray(payload_offset(stop) - payload_offset(start))
+    blocks = data[start * ECC_BLOCK_SIZE : stop * ECC_BLOCK_SIZE]
+    if report is not None:
+        blocks = correct_blocks(blocks, start, stop - start, report)
+    first = 0
+
+    if start == 0:
+        out[:ECC_FIRST_DAT_SIZE] = handle_first_block(blocks[:ECC_BLOCK_SIZE])
+        first = 1
+
+    if start + first < stop:
+        base = payload_offset(start + first) - payload_offset(start)
+        for column in range(ECC_DAT_SIZE):
+            out[base + column :: ECC_DAT_SIZE] = blocks[
+                first * ECC_BLOCK_SIZE + column :: ECC_BLOCK_SIZE
+            ]
+
+    # the last block is padded, only keep what is left of the payload
+    end = max(min(payload_offset(stop), payload_size) - payload_offset(start), 0)
+    del out[end:]
+    return out
 
 
 def handle_first_block(data):
@@ -68,17 +386,31 @@ def handle_first_block(data):
     return data[ECC_FILE_HEADER_LEN : ECC_FILE_HEADER_LEN + ECC_FIRST_DAT_SIZE]
 
 
-def handle_block(data):
-    assert (
-        data[ECC_BLOCK_TYPE_INDEX] == ECC_BLOCK_TYPE_DATA
-        or data[ECC_BLOCK_TYPE_INDEX] == ECC_BLOCK_TYPE_LAST
-    )
-    return data[:ECC_DAT_SIZE]
-
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("input_file", type=str, help="Path to the input file")
     parser.add_argument("output_file", type=str, help="Path to the output file")
+    parser.add_argument(
+        "-c",
+        "--correct",
+        action="store_true",
+        default=False,
+        help="Correct errors with the parity bytes and verify the MD5 of the payload",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of processes used to handle the blocks (default = 1)",
+    )
     args = parser.parse_args()
-    unecc(args.input_file, args.output_file)
+    try:
+        report = unecc(args.input_file, args.output_file, args.correct, args.jobs)
+    except InvalidImageError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    if report is not None:
+        print(report)
+        if report.failed > 0 or not report.md5_ok:
+            sys.exit(1)